@@ -37,18 +37,34 @@ augroup TaskpaperBufWritePre
   au!
   au BufWritePre *.taskpaper silent py run_presave()
   au BufWritePost *.taskpaper silent checktime
+  au BufUnload *.taskpaper silent py forget_buffer(int(vim.eval('expand("<abuf>")')))
+  au VimLeavePre * silent py finish_presave()
 augroup END
 
+" Record the changed lines, so that only these have to be parsed again
+function! TaskPaperRecordChanges(bufnr, start, end, added, changes)
+    call extend(getbufvar(a:bufnr, 'taskpaper_changes'),
+                \ map(copy(a:changes), '[v:val.lnum, v:val.end, v:val.added]'))
+endfunction
+
+if exists('*listener_add') && !exists('b:taskpaper_listener')
+    let b:taskpaper_changes = []
+    let b:taskpaper_listener = listener_add('TaskPaperRecordChanges')
+endif
+
 if exists("loaded_task_paper")
     finish
 endif
 let loaded_task_paper = 1
 
 command -nargs=* Filter py filter_taskpaper(r'<args>')
+command FilterCacheStats py filter_cache_stats()
 command -count AddToDate py add_to_date(<count>, 1)
 command -count SubFromDate py add_to_date(<count>, -1)
 command -range ToggleDone py toggle_done(<count>)
 command LogDone py log_current_dones()
+command LogExport py export_logbook()
+command Agenda py show_agenda()
 
 " Set up mappings
 noremap <unique> <script> <Plug>ToggleDone       :call <SID>ToggleDone()<CR>
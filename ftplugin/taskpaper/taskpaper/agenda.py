@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+One timeline over many files. Every file gives a stream of its due items,
+sorted by day, and the streams are merged lazily: only the next entry of
+every file is compared, no matter how many items there are in total. The
+entries remember the file and line they come from, so that the agenda can
+be used to jump to the items.
+"""
+
+from collections import namedtuple
+import heapq
+
+from taskpaper import Timeline, iter_timeline
+
+# 'day' is the key the timeline is sorted by, 'lines' the lines of the item
+# and its children as they appear in the timeline
+AgendaEntry = namedtuple("AgendaEntry",
+        "day heading filename lineno lines")
+
+def file_entries(filename, tpf, gtoday = None):
+    """The due items of 'tpf', which was read from 'filename', as
+    AgendaEntry, sorted by day and line"""
+    for day, heading, o, lines in Timeline().entries(tpf, gtoday):
+        yield AgendaEntry(day, heading, filename, o.lineno, lines)
+
+def load_entries(filename, load, gtoday = None):
+    """Like file_entries(), but 'filename' is only read by calling 'load'
+    with it when the first entry is asked for, and its tree is let go as
+    soon as its entries are known. Merging these parses one file at a time
+    and keeps no tree alive, but as the merge starts with the first entry
+    of every stream, the entries of all files, with their lines, are in
+    memory until they are merged."""
+    entries = list(file_entries(filename, load(filename), gtoday))
+    entries.reverse()
+    while entries:
+        yield entries.pop()
+
+def merge_sorted(streams, key):
+    """Merge the iterables 'streams', each sorted by 'key', into one sorted
+    iterator. Items with the same key keep the order of their streams."""
+    def _decorate(idx, stream):
+        for n, item in enumerate(stream):
+            yield key(item), idx, n, item
+
+    for decorated in heapq.merge(*[_decorate(idx, stream)
+            for idx, stream in enumerate(streams)]):
+        yield decorated[-1]
+
+def merge_agenda(streams):
+    """Merge streams of AgendaEntry, like the ones of file_entries(), into
+    one sorted by day. The entries of a day are in the order of the
+    streams."""
+    return merge_sorted(streams, lambda e: e.day)
+
+def iter_agenda(entries):
+    """Iterate over the lines of a timeline with the AgendaEntry 'entries'"""
+    return iter_timeline((e.day, e.heading, e.lines) for e in entries)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Processing of many files at once, for example of a whole directory tree of
+project files from cron. The files are parsed in parallel in a pool of
+processes, each of which updates the files it was given and writes their
+timelines. Everything that more than one file contributes to, the logbook
+and the merged timeline, is only written by the calling process, in the
+order of the file names. The result does therefore not depend on which
+process finished first.
+"""
+
+import multiprocessing
+import os
+from timeit import default_timer
+
+from config import TIMELINE_FILENAME, LOGBOOK_FILENAME
+from agenda import merge_sorted
+from taskpaper import TaskPaperFile, Timeline, take_finished, \
+        render_timeline, write_if_changed
+
+TIMELINE_SUFFIX = ".timeline.taskpaper"
+
+def timeline_filename(filename):
+    """Where the timeline of only 'filename' is written"""
+    return os.path.splitext(filename)[0] + TIMELINE_SUFFIX
+
+def find_files(paths):
+    """The TaskPaper files in 'paths', which can be files or directories,
+    sorted by name. Timelines and logbooks are not included."""
+    generated = set(os.path.abspath(fn) for fn in
+            (TIMELINE_FILENAME, LOGBOOK_FILENAME))
+
+    found = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            found.add(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fn in filenames:
+                fn = os.path.join(dirpath, fn)
+                if fn.endswith(".taskpaper") and \
+                        not fn.endswith(TIMELINE_SUFFIX) and \
+                        os.path.abspath(fn) not in generated:
+                    found.add(fn)
+    return sorted(found)
+
+class BatchOptions(object):
+    """What process_files does: 'log_done' moves the finished items into a
+    logbook, 'timelines' writes the timeline of every file next to it and
+    'merged_timeline' is the file name for the timeline of all files"""
+    def __init__(self, log_done = False, timelines = False,
+            merged_timeline = None, cache_directory = None,
+            cache_max_size = None, today = None):
+        self.log_done = log_done
+        self.timelines = timelines
+        self.merged_timeline = merged_timeline
+        self.cache_directory = cache_directory
+        self.cache_max_size = cache_max_size
+        self.today = today
+
+def _process_file(args):
+    """Runs in the pool. Returns the number of lines, the new content of the
+    file if it changed, the lines of the finished items by day and the days
+    of the timeline of the file."""
+    filename, options = args
+
+    if options.cache_directory is not None:
+        from parse_cache import ParseCache
+        tpf = ParseCache(options.cache_directory,
+                options.cache_max_size).load(filename)
+    else:
+        tpf = TaskPaperFile.from_file(filename)
+    nlines = tpf.line_count
+
+    # The file is written back by the calling process after the logbook, so
+    # that no finished item gets lost
+    new_text = None
+    done_lines = {}
+    if options.log_done:
+        tpf, done_items = take_finished(tpf, options.today)
+        if done_items:
+            new_text = str(tpf)
+            for day, items in done_items.iteritems():
+                done_lines[day] = [l for item in items
+                                     for l in item.iter_lines()]
+
+    days = []
+    if options.timelines or options.merged_timeline is not None:
+        timeline = Timeline()
+        days = timeline.days(tpf, options.today)
+        if options.timelines:
+            timeline.write(tpf, timeline_filename(filename), options.today)
+
+    return nlines, new_text, done_lines, \
+            days if options.merged_timeline is not None else []
+
+class BatchReport(object):
+    def __init__(self, files, lines, seconds):
+        self.files = files
+        self.lines = lines
+        self.seconds = seconds
+
+    def __str__(self):
+        seconds = max(self.seconds, 1e-6)
+        return "%i files, %i lines in %.2f s: %.1f files/s, %.0f lines/s" % (
+                self.files, self.lines, self.seconds,
+                self.files / seconds, self.lines / seconds)
+
+def process_files(filenames, options, logbook = None, processes = None):
+    """Process 'filenames' as 'options' says in a pool of 'processes'
+    processes, by default one per core; 1 processes them right here. The
+    finished items go into the LogbookStore 'logbook', which is needed if
+    options.log_done is set. Returns a BatchReport."""
+    start = default_timer()
+
+    jobs = [(fn, options) for fn in filenames]
+    if processes == 1 or len(jobs) < 2:
+        pool = None
+        results = map(_process_file, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        # imap hands out the results in the order of the jobs
+        results = pool.imap(_process_file, jobs)
+
+    try:
+        nlines = 0
+        new_texts = []
+        done_lines = {}
+        days = []
+        for filename, (file_lines, new_text, file_done_lines, file_days) in \
+                zip(filenames, results):
+            nlines += file_lines
+            if new_text is not None:
+                new_texts.append((filename, new_text))
+            for day, lines in file_done_lines.iteritems():
+                done_lines.setdefault(day, []).extend(lines)
+            days.append(file_days)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if options.log_done:
+        logbook.log_lines(done_lines)
+        for filename, new_text in new_texts:
+            with open(filename, "w") as f:
+                f.write(new_text)
+
+    if options.merged_timeline is not None:
+        # The days of every file are sorted already
+        write_if_changed(options.merged_timeline,
+                render_timeline(merge_sorted(days, lambda day: day[0])))
+
+    return BatchReport(len(filenames), nlines, default_timer() - start)
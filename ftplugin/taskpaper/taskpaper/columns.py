@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A columnar view of a TaskPaperFile for questions about the dates and
+numbers of many items at once. Every item is a row in parallel arrays of
+its line number, depth, kind and, built when they are first asked for, the
+values of its tags as date ordinals or numbers. A question is a Mask of
+rows, which are combined with &, | and ~ and mapped back to the items with
+select():
+
+    cols = Columns(tpf)
+    soon = cols.date_between("@due", today, today + dt.timedelta(14))
+    items = cols.select(soon & ~cols.has("@done"))
+
+The columns are arrays of the array module. With NumPy, masks are computed
+on them as vectorized operations; without it, the masks are bytearrays
+that are combined in C by map() and translate().
+
+Columns are a snapshot of the tree, make new ones after it changed.
+"""
+
+from array import array
+from itertools import compress
+import operator
+
+try: import numpy
+except ImportError: numpy = None
+
+from taskpaper import Project, Task, CommentLine, tag_date
+
+# The kinds of items, as they are stored in Columns.kind
+KINDS = (Project, Task, CommentLine)
+
+# The ordinals of items without the tag and of items whose tag has no date
+MISSING, UNDATED = 0, -1
+
+_NAN = float("nan")
+_INVERT = bytearray((1, 0)) + bytearray(254)
+
+def _number(value):
+    if value is None or isinstance(value, bool):
+        return _NAN
+    try:
+        return float(value)
+    except ValueError:
+        return _NAN
+
+def _as_numpy(col, dtype):
+    """The array or bytearray 'col' as a NumPy array without a copy. Older
+    NumPy versions do not take empty buffers."""
+    if not col:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.frombuffer(col, dtype=dtype)
+
+class Mask(object):
+    """The rows of Columns that a question selects"""
+    __slots__ = ("rows", )
+
+    def __init__(self, rows):
+        # A NumPy array of bools or a bytearray of 0 and 1
+        self.rows = rows
+
+    def __and__(self, other):
+        if numpy is not None:
+            return Mask(self.rows & other.rows)
+        return Mask(bytearray(map(operator.and_, self.rows, other.rows)))
+
+    def __or__(self, other):
+        if numpy is not None:
+            return Mask(self.rows | other.rows)
+        return Mask(bytearray(map(operator.or_, self.rows, other.rows)))
+
+    def __invert__(self):
+        if numpy is not None:
+            return Mask(~self.rows)
+        return Mask(self.rows.translate(_INVERT))
+
+    def __len__(self):
+        """The number of selected rows"""
+        if numpy is not None:
+            return int(self.rows.sum())
+        return self.rows.count("\x01")
+
+class Columns(object):
+    def __init__(self, tpf):
+        """The items below 'tpf' as rows, in document order"""
+        self.items = []
+        self.lineno = array('l')
+        self.depth = array('b')
+        self.kind = array('b')
+
+        depths = {tpf: -1}
+        kind_index = dict((k, i) for i, k in enumerate(KINDS))
+        add_item, add_lineno = self.items.append, self.lineno.append
+        add_depth, add_kind = self.depth.append, self.kind.append
+        for o in tpf:
+            if o is tpf: continue
+            depths[o] = depth = depths[o.parent] + 1
+            add_item(o)
+            add_lineno(o.lineno or 0)
+            add_depth(min(depth, 127))
+            add_kind(kind_index[o.__class__])
+
+        # Tag columns by tag name, built on demand from the tag index of the
+        # file if it has one
+        self._tag_index = getattr(tpf, "tag_index", None)
+        self._rows = None
+        self._has = {}
+        self._dates = {}
+        self._numbers = {}
+        # Tag value -> the ordinal of its day, shared by all date columns
+        self._ordinals = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def _date_ordinal(self, value):
+        """The ordinal of the day of the tag 'value', UNDATED if it has none"""
+        ordinal = self._ordinals.get(value)
+        if ordinal is None:
+            try:
+                ordinal = tag_date(value).toordinal()
+            except (ValueError, TypeError, IndexError):
+                ordinal = UNDATED
+            self._ordinals[value] = ordinal
+        return ordinal
+
+    def _tagged(self, name):
+        """The rows of the items with the tag 'name', with their tags"""
+        if self._tag_index is None:
+            return [(row, o.tags[name]) for row, o in enumerate(self.items)
+                    if name in o.tags]
+        if self._rows is None:
+            self._rows = dict((o, row) for row, o in enumerate(self.items))
+        return [(self._rows[o], o.tags[name])
+                for o in self._tag_index.candidates((name, ))]
+
+    def _column(self, columns, name, empty, convert):
+        col = columns.get(name)
+        if col is None:
+            col = columns[name] = empty * len(self)
+            for row, t in self._tagged(name):
+                col[row] = convert(t)
+        return col
+
+    def has_tag(self, name):
+        """A bytearray with 1 for the rows that have the tag 'name'"""
+        return self._column(self._has, name, bytearray(1), lambda t: 1)
+
+    def dates(self, name):
+        """The values of the tag 'name' as date ordinals, MISSING for rows
+        without the tag and UNDATED for rows where it is not a date"""
+        return self._column(self._dates, name, array('l', (MISSING, )),
+                lambda t: self._date_ordinal(t.value))
+
+    def numbers(self, name):
+        """The values of the tag 'name' as floats, NaN where it is missing
+        or not a number"""
+        return self._column(self._numbers, name, array('d', (_NAN, )),
+                lambda t: _number(t.value))
+
+    def _mask(self, col, typecode, test):
+        """The Mask of the rows of 'col' for which 'test' is true. 'test' is
+        given the column as a NumPy array or, without NumPy, each value."""
+        if numpy is not None:
+            return Mask(test(_as_numpy(col, typecode)))
+        return Mask(bytearray(map(test, col)))
+
+    def all(self):
+        if numpy is not None:
+            return Mask(numpy.ones(len(self), dtype=bool))
+        return Mask(bytearray((1, )) * len(self))
+
+    def has(self, name):
+        """The rows that have the tag 'name'"""
+        rows = self.has_tag(name)
+        if numpy is not None:
+            return Mask(_as_numpy(rows, numpy.uint8) != 0)
+        return Mask(rows)
+
+    def of_kind(self, kinds):
+        """The rows whose items are of one of the classes 'kinds'"""
+        if not isinstance(kinds, tuple): kinds = (kinds, )
+        wanted = set(KINDS.index(k) for k in kinds)
+        if numpy is not None:
+            return self._mask(self.kind, 'b',
+                    lambda k: numpy.isin(k, sorted(wanted)))
+        return self._mask(self.kind, 'b', wanted.__contains__)
+
+    def date_between(self, name, first, last):
+        """The rows where the tag 'name' is a date from 'first' to 'last',
+        both included"""
+        first, last = first.toordinal(), last.toordinal()
+        if numpy is not None:
+            return self._mask(self.dates(name), 'l',
+                    lambda d: (d >= first) & (d <= last))
+        return self._mask(self.dates(name), 'l',
+                lambda d: first <= d <= last)
+
+    def number_between(self, name, low, high):
+        """The rows where the tag 'name' is a number from 'low' to 'high',
+        both included"""
+        if numpy is not None:
+            return self._mask(self.numbers(name), 'd',
+                    lambda n: (n >= low) & (n <= high))
+        return self._mask(self.numbers(name), 'd',
+                lambda n: low <= n <= high)
+
+    def select(self, mask):
+        """The items of the rows in 'mask', in document order"""
+        if numpy is not None:
+            return [self.items[i] for i in numpy.flatnonzero(mask.rows)]
+        return list(compress(self.items, mask.rows))
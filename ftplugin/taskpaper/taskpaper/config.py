@@ -9,4 +9,24 @@ HOME = os.getenv("HOME")
 INBOX_FILENAME = p.join(HOME, "Dropbox", "Tasks", "01_inbox.taskpaper")
 TODO_FILENAME = p.join(HOME, "Dropbox", "Tasks", "02_todo.taskpaper")
 TIMELINE_FILENAME = p.join(HOME, "Dropbox", "Tasks", "10_timeline.taskpaper")
+PROJECTS_DIRECTORY = p.join(HOME, "Dropbox", "Tasks", "projects")
 LOGBOOK_FILENAME = p.join(HOME, "Dropbox", "Tasks", "40_logbook.taskpaper")
+LOGBOOK_STORE_FILENAME = p.join(HOME, "Dropbox", "Tasks", "40_logbook.log")
+
+# The files whose due items are shown by :Agenda, before all files in
+# PROJECTS_DIRECTORY
+AGENDA_FILENAMES = [INBOX_FILENAME, TODO_FILENAME]
+
+CACHE_DIRECTORY = p.join(HOME, ".cache", "taskpaper")
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# How many results of :Filter are kept for each buffer
+FILTER_CACHE_SIZE = 32
+
+# How many lines of results are added to the results window at a time
+RESULTS_PAGE_SIZE = 200
+
+# The types of the values of single tags: "number" and "date" only convert
+# values that look like numbers or dates, "text" keeps every value as it is
+# written. The values of all other tags become whatever they look like.
+TAG_VALUE_TYPES = {}
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Reading a file as a stream of events instead of a tree, for files that are
+larger than memory, like a multi-year archive. Like SAX does for XML,
+iter_events reports where items start and end and only remembers the
+ancestors of the current line. Filtering, the timeline and the finished
+items are available on top of the events; they only hold on to what they
+return.
+"""
+
+import datetime as dt
+from itertools import islice
+
+from query import Filter
+from tag_values import sort_key
+from taskpaper import Project, Task, Timeline, group_days, tag_date, \
+        parse_line, format_line, split_order, split_limit, order_items
+
+# The events. Empty lines have None as indent, kind and tags and '' as
+# text.
+START, END, EMPTY = "start", "end", "empty"
+
+def iter_events(lines):
+    """Iterate over the events of a file as (event, lineno, indent, kind,
+    text, tags) tuples. 'lines' is the content of the file or an iterable
+    over its lines, for example the open file. START is reported for the
+    line of every item, END for the same item after all of its children.
+    Kind, text and tags are what the item of a TaskPaperFile would have.
+
+    Empty lines come after the END of the item they follow, which is where
+    the tree writes them; as in the tree, empty lines before the first item
+    are dropped."""
+    if isinstance(lines, basestring):
+        lines = lines.splitlines()
+    else:
+        lines = (l.rstrip('\r\n') for l in lines)
+
+    # The open items as [indent, lineno, kind, text, tags, first empty line,
+    # number of empty lines], innermost last. The empty lines after the last
+    # item are counted until the next item shows where they belong.
+    stack = []
+    first_empty = nempty = 0
+    for lineno, line in enumerate(lines, 1):
+        item = parse_line(line)
+        if item is None:
+            if stack:
+                if not nempty: first_empty = lineno
+                nempty += 1
+            continue
+
+        if nempty:
+            stack[-1][5:] = first_empty, nempty
+            nempty = 0
+
+        indent, kind, text, tags = item
+        while stack and stack[-1][0] >= indent:
+            for event in _end_events(stack.pop()):
+                yield event
+
+        stack.append([indent, lineno, kind, text, tags, 0, 0])
+        yield START, lineno, indent, kind, text, tags
+
+    if nempty:
+        stack[-1][5:] = first_empty, nempty
+    while stack:
+        for event in _end_events(stack.pop()):
+            yield event
+
+def _end_events(item):
+    indent, lineno, kind, text, tags, first_empty, nempty = item
+    yield END, lineno, indent, kind, text, tags
+    for l in xrange(first_empty, first_empty + nempty):
+        yield EMPTY, l, None, None, '', None
+
+def filter_events(events, cmdline):
+    """The items that match the filter 'cmdline' as (lineno, indent, kind,
+    text, tags) tuples. Like TaskPaperFile.filter, the children of a match
+    are not looked at. The matches are found while iterating, in document
+    order; only ordering them with an o: clause keeps them all, or as many
+    as an l: clause asks for.
+
+    There is no file item among the events. Where TaskPaperFile.filter
+    returns only the file itself, because the expression is true for an
+    item without tags, like 'not @done', this returns the matching items
+    at the top level instead."""
+    cmdline, order, reverse = split_order(cmdline)
+    cmdline, limit = split_limit(cmdline)
+    matches = _filter_events(events, Filter(cmdline).evaluate)
+    if order is None:
+        return islice(matches, limit)
+
+    key = lambda m: sort_key(m[4][order].value) if order in m[4] else None
+    return iter(order_items(matches, key, reverse, limit))
+
+def _filter_events(events, evaluate):
+    # The line of the match whose children are skipped
+    skip = None
+    for event, lineno, indent, kind, text, tags in events:
+        if skip is not None:
+            if event == END and lineno == skip:
+                skip = None
+        elif event == START and evaluate(tags):
+            skip = lineno
+            yield lineno, indent, kind, text, tags
+
+def timeline_days(events, gtoday = None):
+    """The days of the timeline of the file with 'events', as Timeline.days()
+    returns them. Only the lines of the due items are kept."""
+    timeline = Timeline()
+
+    # (lineno, lines) of the due items that did not end yet
+    collecting = []
+    entries = []
+    for event, lineno, indent, kind, text, tags in events:
+        if event == END:
+            if collecting and collecting[-1][0] == lineno:
+                collecting.pop()
+            continue
+
+        if event == EMPTY:
+            line = '\n'
+        else:
+            line = format_line(text, tags, indent)
+        for due_lineno, lines in collecting:
+            lines.append(line)
+
+        if event == START and '@due' in tags and not '@done' in tags:
+            try:
+                day, heading = timeline.day(tags["@due"].value, gtoday)
+            except Exception, e:
+                raise RuntimeError("%s\n\nError in todo file in line %i: %s!" %
+                        (str(e), lineno, text))
+            # The item goes below its day without its own empty lines, its
+            # children keep their indent
+            lines = [format_line(text, tags, 1)]
+            collecting.append((lineno, lines))
+            entries.append((day, heading, lines))
+
+    # The items are in document order, a stable sort keeps it in a day
+    entries.sort(key=lambda entry: entry[0])
+    return group_days(entries)
+
+def _without_markers(kind, text):
+    """The text_without_markers of an item of 'kind' with 'text'"""
+    if kind is Task:
+        return text.lstrip()[2:]
+    if kind is Project:
+        return text.rstrip()[:-1]
+    return text
+
+class _Open(object):
+    """An item of iter_finished() that did not end yet"""
+    __slots__ = ("parent", "kind", "bare", "write", "shift", "kept_childs",
+                 "moved_empty", "ended", "finished", "owner")
+
+    def __init__(self, parent, kind, bare, write, shift):
+        self.parent = parent
+        self.kind = kind
+        # The text without markers, as it appears in the logbook
+        self.bare = bare
+        # Where the lines of the item and its children go, with their indent
+        # changed by 'shift'
+        self.write = write
+        self.shift = shift
+        # If a child before the current one stays where it is
+        self.kept_childs = False
+        # Empty lines of removed children that go after our children, once
+        # they ended
+        self.moved_empty = 0
+        self.ended = False
+        # (day, lines, finished items inside) if this item is finished
+        self.finished = None
+        # The innermost finished item this one is part of
+        self.owner = parent.owner if parent is not None else None
+
+def iter_finished(events, gtoday = None, rest = None):
+    """The finished items of the file with 'events', as (day, lines) tuples
+    in document order. These are the items and lines take_finished()
+    removes, and the lines of what it leaves are written to the file object
+    'rest'. Only the lines of finished items are kept until they ended."""
+    today = dt.date.today() if not gtoday else gtoday
+
+    write = rest.write if rest is not None else lambda line: None
+    root = _Open(None, None, None, write, 0)
+    stack = [root]
+    # The item on the last line. The file is read as the tree writes it, so
+    # the empty lines that come after it are its own.
+    last = None
+    # Finished items are handed out when no more empty lines can follow
+    done = []
+    for event, lineno, indent, kind, text, tags in events:
+        if event == START:
+            for finished in done:
+                yield finished
+            del done[:]
+
+            parent = stack[-1]
+            if kind in (Task, Project) and '@done' in tags:
+                value = tags['@done'].value
+                day = tag_date(value) if value else today
+
+                # A finished item among our parents already has their texts
+                parents = []
+                p = parent
+                while p.kind in (Task, Project):
+                    parents.append(p.bare)
+                    if p.finished is not None: break
+                    p = p.parent
+                text = ' • '.join(parents[::-1] + [_without_markers(kind,
+                    text)])
+                text = "- " + text if kind is Task else text + ":"
+
+                lines = []
+                o = _Open(parent, kind, _without_markers(kind, text),
+                        lines.append, 1 - indent)
+                o.finished = (day, lines, [])
+                o.owner = o
+            else:
+                parent.kept_childs = True
+                o = _Open(parent, kind, _without_markers(kind, text),
+                        parent.write, parent.shift)
+            o.write(format_line(text, tags, indent + o.shift))
+            stack.append(o)
+            last = o
+
+        elif event == END:
+            o = stack.pop()
+            o.ended = True
+            for i in xrange(o.moved_empty): o.write('\n')
+            if o.finished is None:
+                continue
+            day, lines, inside = o.finished
+            if o.parent.owner is not None:
+                o.parent.owner.finished[2].extend([(day, lines)] + inside)
+            else:
+                done.append((day, lines))
+                done.extend(inside)
+
+        elif last.finished is None:
+            last.write('\n')
+        # The empty lines of a removed item go to the item before it, which
+        # writes them after its children
+        elif last.parent.kept_childs:
+            last.parent.write('\n')
+        elif not last.parent.ended:
+            last.parent.moved_empty += 1
+        else:
+            last.parent.write('\n')
+
+    for i in xrange(root.moved_empty): write('\n')
+    for finished in done:
+        yield finished
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+An append-only logbook. Finished items are appended to the end of the file
+in sections of one day each, oldest first, so that logging never has to
+read or rewrite what is already in there. Items that were done on the day
+of the last section go into it, any other day starts a new section; a day
+can therefore have more than one section. A small index next to the file
+maps the days to the byte offsets of their sections. The file is memory
+mapped, so that reading a day only touches its sections.
+
+The single file logbook with the newest day on top, as it is written by
+write_logbook, is available through LogbookStore.export.
+"""
+
+from collections import defaultdict
+import datetime as dt
+import os
+
+from mapped import MappedFile
+
+DAY_FORMAT = "%A, %d. %B %Y:"
+
+def _header_day(line):
+    """The day if 'line' is the header of a section, None otherwise"""
+    if line[:1] in "\t \r\n" or not line.rstrip().endswith(':'):
+        return None
+    try:
+        return dt.datetime.strptime(line.rstrip(), DAY_FORMAT).date()
+    except ValueError:
+        return None
+
+class LogbookStore(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + ".idx"
+
+        # The (day, offset) of all sections in the order of the file
+        self._sections = []
+        self._load_index()
+
+    def _size(self):
+        if not os.path.exists(self.filename):
+            return 0
+        return os.path.getsize(self.filename)
+
+    def _load_index(self):
+        sections = []
+        if os.path.exists(self.index_filename):
+            try:
+                for line in open(self.index_filename):
+                    day, offset = line.split()
+                    sections.append((dt.date(*map(int, day.split('-'))),
+                        int(offset)))
+            except ValueError:
+                sections = []
+
+        # The index lags behind when a write was interrupted or something
+        # else appended to the file, so the file is scanned from the last
+        # known section on. If that section is not where the index says,
+        # the index is of no use and is built again.
+        tail = self._scan(sections[-1][1] if sections else 0)
+        if sections and tail[:1] != sections[-1:]:
+            sections, tail = [], self._scan(0)
+        if not sections and os.path.exists(self.index_filename):
+            os.remove(self.index_filename)
+        new = tail[1:] if sections else tail
+
+        self._sections = sections
+        self._add_sections(new)
+
+    def _scan(self, offset):
+        """The sections that start at or after 'offset', which must be the
+        start of a line"""
+        found = []
+        if offset >= self._size():
+            return found
+        with MappedFile(self.filename) as f:
+            m = f.buffer()
+            for start, end in f.line_offsets(offset):
+                # Only the lines that can be headers are made strings
+                if m[start] in "\t \r\n":
+                    continue
+                day = _header_day(f.read(start, end))
+                if day is not None:
+                    found.append((day, start))
+        return found
+
+    def _add_sections(self, sections):
+        if not sections:
+            return
+        self._sections.extend(sections)
+        with open(self.index_filename, "ab") as f:
+            f.writelines("%s %i\n" % (day.isoformat(), offset)
+                    for day, offset in sections)
+
+    def days(self):
+        """All days with finished items, the newest first"""
+        return sorted(set(day for day, offset in self._sections),
+                reverse=True)
+
+    def log(self, done_items):
+        """Append the items in 'done_items', a dictionary of lists of items by
+        the day they were done on"""
+        self.log_lines(dict((day, [l for item in items
+                                     for l in item.iter_lines()])
+                            for day, items in done_items.iteritems()))
+
+    def log_lines(self, done_lines):
+        """Like log(), but with the lines of the items by day"""
+        offset = self._size()
+        last_day = self._sections[-1][0] if self._sections else None
+
+        chunks = []
+        sections = []
+        for day in sorted(done_lines):
+            # Empty lines would end the section
+            lines = [l for l in done_lines[day] if l != '\n']
+            if not lines:
+                continue
+            if day != last_day:
+                if offset:
+                    chunks.append('\n')
+                    offset += 1
+                sections.append((day, offset))
+                lines.insert(0, day.strftime(DAY_FORMAT) + '\n')
+                last_day = day
+            chunk = ''.join(lines)
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        if not chunks:
+            return
+        with open(self.filename, "ab") as f:
+            f.write(''.join(chunks))
+        self._add_sections(sections)
+
+    def import_logbook(self, logbook):
+        """Append the items of a single file logbook like the one written by
+        write_logbook"""
+        done_items = defaultdict(list)
+        for p in logbook.childs:
+            day = dt.datetime.strptime(p.text, DAY_FORMAT).date()
+            done_items[day].extend(p.childs)
+        self.log(done_items)
+
+    def _ranges(self):
+        """The (start, end) byte ranges of the sections by day"""
+        ends = [offset for day, offset in self._sections[1:]] + [self._size()]
+        ranges = defaultdict(list)
+        for (day, start), end in zip(self._sections, ends):
+            ranges[day].append((start, end))
+        return ranges
+
+    def _read_sections(self, f, ranges):
+        lines = []
+        for start, end in ranges:
+            section = list(f.lines(start, end))[1:]
+            while section and not section[-1].strip():
+                section.pop()
+            lines.extend(section)
+        return lines
+
+    def read_day(self, day):
+        """The lines of all items that were done on 'day'"""
+        ranges = self._ranges().get(day)
+        if not ranges:
+            return []
+        with MappedFile(self.filename) as f:
+            return self._read_sections(f, ranges)
+
+    def export(self, fileobj):
+        """Write the whole logbook as a single file logbook to 'fileobj', the
+        newest day first"""
+        ranges = self._ranges()
+        if not ranges:
+            return
+        with MappedFile(self.filename) as f:
+            for idx, day in enumerate(sorted(ranges, reverse=True)):
+                if idx: fileobj.write('\n')
+                fileobj.write(day.strftime(DAY_FORMAT) + '\n')
+                fileobj.writelines(self._read_sections(f, ranges[day]))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Reading files through a memory map instead of into one string. Line
+boundaries are found with find() on the map and a line only becomes a
+string when it is asked for, so that reading a part of a large file, like
+one day of the logbook, costs only that part. A MappedFile iterates over
+its lines like an open file does, which is what TaskPaperFile and
+iter_events take:
+
+    with MappedFile(filename) as f:
+        tpf = TaskPaperFile(f)
+"""
+
+import mmap
+import os
+
+class MappedFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # Empty files can not be mapped, but an empty string does the
+            # same for them
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                    if self.size else ""
+
+    def close(self):
+        if self.size:
+            self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def buffer(self):
+        """The content of the file as an object with the buffer interface,
+        for example for hashlib, without copying it"""
+        return self._map
+
+    def read(self, start = 0, end = None):
+        """The bytes from 'start' up to but excluding 'end' as a string"""
+        return self._map[start:self.size if end is None else end]
+
+    def line_offsets(self, start = 0, end = None):
+        """Iterate over the (start, end) offsets of the lines between 'start',
+        which must be the start of a line, and 'end', including their
+        newlines"""
+        m = self._map
+        if end is None: end = self.size
+        find = m.find
+        while start < end:
+            nl = find('\n', start, end)
+            next_start = end if nl < 0 else nl + 1
+            yield start, next_start
+            start = next_start
+
+    def lines(self, start = 0, end = None):
+        """Iterate over the lines between 'start' and 'end', see
+        line_offsets(), including their newlines"""
+        # The same as line_offsets(), but this is what parsing spends its
+        # time in
+        m = self._map
+        if end is None: end = self.size
+        find = m.find
+        while start < end:
+            nl = find('\n', start, end)
+            next_start = end if nl < 0 else nl + 1
+            yield m[start:next_start]
+            start = next_start
+    __iter__ = lines
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A cache of parsed files on disk. The tree of every file is stored in
+marshal format in a file of its own, together with the modification time,
+size and content hash of the file it belongs to. A file whose time and size
+did not change is not even read; if only the time changed, its hash
+decides. When the cache grows beyond its size, the entries that were used
+the longest time ago are removed.
+"""
+
+import hashlib
+import marshal
+import os
+
+from mapped import MappedFile
+from taskpaper import TaskPaperFile
+
+# Changes whenever the format of the entries changes
+_VERSION = 2
+
+class ParseCache(object):
+    def __init__(self, directory, max_size = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_filename(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.directory, key + ".tpc")
+
+    def _read_entry(self, entry_fn):
+        try:
+            with open(entry_fn, "rb") as f:
+                entry = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 5 or \
+                entry[0] != _VERSION:
+            return None
+        return entry
+
+    def load(self, filename, tag_index = True):
+        """The TaskPaperFile of 'filename', from the cache if it is up to
+        date, else it is parsed and stored in the cache"""
+        st = os.stat(filename)
+        entry_fn = self._entry_filename(filename)
+        entry = self._read_entry(entry_fn)
+
+        digest = None
+        if entry is not None and entry[2] == st.st_size:
+            if entry[1] != st.st_mtime:
+                with MappedFile(filename) as f:
+                    digest = hashlib.sha1(f.buffer()).hexdigest()
+                if digest != entry[3]:
+                    entry = None
+                else:
+                    # Only touched, remember the new time
+                    self._write_entry(entry_fn, (_VERSION, st.st_mtime,
+                        st.st_size, entry[3], entry[4]))
+            if entry is not None:
+                self.hits += 1
+                # The time of an entry is the time of its last use
+                os.utime(entry_fn, None)
+                return TaskPaperFile.from_records(entry[4], tag_index)
+
+        self.misses += 1
+        with MappedFile(filename) as f:
+            if digest is None:
+                digest = hashlib.sha1(f.buffer()).hexdigest()
+            tpf = TaskPaperFile(f, tag_index)
+        self._write_entry(entry_fn, (_VERSION, st.st_mtime, st.st_size,
+            digest, tpf.records()))
+        self._evict()
+        return tpf
+
+    def _write_entry(self, entry_fn, entry):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Written under another name first, so that a reader never sees a
+        # partial entry
+        tmp_fn = "%s.%i.tmp" % (entry_fn, os.getpid())
+        with open(tmp_fn, "wb") as f:
+            marshal.dump(entry, f, 2)
+        os.rename(tmp_fn, entry_fn)
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is not
+        larger than max_size"""
+        entries = []
+        total = 0
+        for fn in os.listdir(self.directory):
+            if not fn.endswith(".tpc"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, fn))
+            except OSError: # Removed by someone else
+                continue
+            entries.append((st.st_mtime, fn, st.st_size))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, fn, size in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, fn))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries"""
+        if not os.path.isdir(self.directory):
+            return
+        for fn in os.listdir(self.directory):
+            if fn.endswith(".tpc"):
+                os.remove(os.path.join(self.directory, fn))
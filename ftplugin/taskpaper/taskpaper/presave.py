@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Work that is done when a file is saved, but that the save does not have to
+wait for. A TimelineWriter gets a copy of the lines of the file and writes
+its timeline in a background thread. If more lines come in while it is
+busy, only the last ones are used.
+"""
+
+import threading
+
+from taskpaper import TaskPaperFile, Timeline
+
+def _changed_range(old, new):
+    """A single change that turns the lines 'old' into 'new', as (start, end,
+    added) in the convention of TaskPaperFile.reparse. None if they are
+    equal."""
+    if old == new:
+        return None
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    return prefix + 1, len(old) - suffix + 1, len(new) - len(old)
+
+class TimelineWriter(object):
+    def __init__(self, filename, gtoday = None):
+        self.filename = filename
+        self.gtoday = gtoday
+
+        # The last exception of the background thread, if any
+        self.error = None
+
+        self._cond = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._thread = None
+
+        # Only used by the background thread
+        self._lines = None
+        self._tpf = None
+        self._timeline = Timeline()
+
+    def submit(self, lines):
+        """Write the timeline of the file with 'lines' soon. The lines must
+        not change afterwards."""
+        with self._cond:
+            self._pending = lines
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                        name="TimelineWriter")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def wait(self):
+        """Block until everything submitted was written"""
+        with self._cond:
+            while self._pending is not None or self._busy:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                lines, self._pending = self._pending, None
+                self._busy = True
+            try:
+                self._update(lines)
+            except Exception, e:
+                self.error = e
+                self._tpf = None
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _update(self, lines):
+        # Successive saves mostly differ in a few lines, so the tree of the
+        # last one is brought up to date instead of parsing again
+        if self._tpf is None:
+            self._tpf = TaskPaperFile(lines)
+        else:
+            change = _changed_range(self._lines, lines)
+            if change is not None:
+                self._tpf.reparse(lines, *change)
+        self._lines = lines
+
+        self._timeline.write(self._tpf, self.filename, self.gtoday)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The expressions that are understood by TaskPaperFile.filter. They look like
+Python expressions over tags, for example
+
+    @today or (@due <= 2011-04-01 and not @done)
+
+A tag evaluates to its value or True if it has no value and to something
+false if the item does not have it. Values can be compared with ==, !=, <,
+<=, > and >= to numbers, dates, quoted strings or bare words, which are
+read just like tag values, so '2011-04-10 12:00' is a date with a time. A
+missing tag is not equal to anything and not ordered with anything, and
+neither are values of types that have no order, like dates and text.
+Expressions are compiled once into a Python function that is then called
+with the tags of each item.
+"""
+
+import operator
+import re
+
+from _ordered_dict import OrderedDict
+from tag_values import typed_value, compare
+
+class FilterSyntaxError(ValueError):
+    def __init__(self, msg, expr, pos):
+        ValueError.__init__(self, "%s at column %i: %s" % (msg, pos + 1, expr))
+        self.expr = expr
+        self.pos = pos
+
+_TOKENS = re.compile(r"""\s*(?:
+    (?P<tag>@\w+)(?:\([^)]*\))? |
+    (?P<op>==|!=|<=|>=|<|>) |
+    (?P<paren>[()]) |
+    (?P<string>'[^']*'|"[^"]*") |
+    (?P<word>[^\s()@'"=!<>]+)
+)""", re.X)
+
+_KEYWORDS = ("and", "or", "not")
+_CONSTANTS = { "True": True, "False": False }
+_COMPARISONS = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+}
+
+# The value of a tag that an item does not have. Tags without a value
+# evaluate to True, so None is free for this.
+_MISSING = None
+
+def _tokenize(expr):
+    """Returns a list of (kind, value, column) tuples"""
+    tokens = []
+    pos = 0
+    while pos < len(expr):
+        if not expr[pos:].strip():
+            break
+        m = _TOKENS.match(expr, pos)
+        if m is None:
+            start = len(expr) - len(expr[pos:].lstrip())
+            if expr[start] in "'\"":
+                raise FilterSyntaxError("Unterminated string", expr, start)
+            raise FilterSyntaxError("Unexpected character %r" % expr[start],
+                    expr, start)
+
+        kind = m.lastgroup
+        value = m.group(kind)
+        col = m.start(kind)
+        if kind == "word" and value in _KEYWORDS:
+            kind = value
+        tokens.append((kind, value, col))
+        pos = m.end()
+    return tokens
+
+def _literal(word):
+    if word in _CONSTANTS:
+        return _CONSTANTS[word]
+    return typed_value(word)
+
+class _Parser(object):
+    """A recursive descent parser with the precedence rules of Python. The
+    syntax tree is made of tuples:
+
+        ("tag", name), ("literal", value), ("not", node),
+        ("and", [node, ...]), ("or", [node, ...]),
+        ("compare", node, [(operator, node), ...])
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = _tokenize(expr)
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+
+    def _peek_paren(self, paren):
+        return self._peek() == "paren" and self.tokens[self.pos][1] == paren
+
+    def _next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def _error(self, msg):
+        if self.pos < len(self.tokens):
+            kind, value, col = self.tokens[self.pos]
+            msg = "%s, got %r" % (msg, value)
+        else:
+            col = len(self.expr)
+            msg = "%s, got end of expression" % msg
+        raise FilterSyntaxError(msg, self.expr, col)
+
+    def parse(self):
+        if not self.tokens:
+            return None
+        node = self._or()
+        if self._peek() is not None:
+            self._error("Expected an operator")
+        return node
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._peek() == "or":
+            self._next()
+            nodes.append(self._and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def _and(self):
+        nodes = [self._not()]
+        while self._peek() == "and":
+            self._next()
+            nodes.append(self._not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def _not(self):
+        if self._peek() == "not":
+            self._next()
+            return ("not", self._not())
+        return self._comparison()
+
+    def _comparison(self):
+        first = self._atom()
+        rest = []
+        while self._peek() == "op":
+            op = self._next()[1]
+            rest.append((op, self._atom()))
+        return ("compare", first, rest) if rest else first
+
+    def _atom(self):
+        kind = self._peek()
+        if kind == "tag":
+            return ("tag", self._next()[1])
+        if self._peek_paren("("):
+            self._next()
+            node = self._or()
+            if not self._peek_paren(")"):
+                self._error("Expected ')'")
+            self._next()
+            return node
+        if kind == "string":
+            return ("literal", typed_value(self._next()[1][1:-1]))
+        if kind == "word":
+            return ("literal", _literal(self._next()[1]))
+        self._error("Expected a tag or a value")
+
+class _Compiler(object):
+    """Turns a syntax tree into the source of a single Python expression
+    over 'tags'. Only tag names, which are plain words, go into the source;
+    literals are passed in as names in the namespace. Where only the truth
+    of a node matters, its code is simpler than where its value is used."""
+
+    def __init__(self):
+        self.namespace = { "_compare": _COMPARE }
+        self.tag_names = set()
+
+    def _constant(self, value):
+        name = "_c%i" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def truth(self, node):
+        kind = node[0]
+        if kind == "tag":
+            self.tag_names.add(node[1])
+            t = "tags[%r]" % node[1]
+            return "(%r in tags and (%s.value is None or %s.value))" % (
+                    node[1], t, t)
+        if kind == "not":
+            return "(not %s)" % self.truth(node[1])
+        if kind in ("and", "or"):
+            return "(%s)" % (" %s " % kind).join(self.truth(n) for n in node[1])
+        return self.value(node)
+
+    def value(self, node):
+        kind = node[0]
+        if kind == "tag":
+            self.tag_names.add(node[1])
+            t = "tags[%r]" % node[1]
+            return "(None if %r not in tags else True if %s.value is None " \
+                   "else %s.value)" % (node[1], t, t)
+        if kind == "literal":
+            return self._constant(node[1])
+        if kind == "not":
+            return "(not %s)" % self.truth(node[1])
+        if kind in ("and", "or"):
+            return "(%s)" % (" %s " % kind).join(self.value(n) for n in node[1])
+
+        # A chain like 'a < b < c' means 'a < b and b < c'
+        left = self.value(node[1])
+        parts = []
+        for op, n in node[2]:
+            right = self.value(n)
+            parts.append("_compare[%r](%s, %s)" % (op, left, right))
+            left = right
+        return "(%s)" % " and ".join(parts)
+
+def _comparison(op):
+    if op is operator.ne:
+        return lambda a, b: a is _MISSING or b is _MISSING or a != b
+    return lambda a, b: a is not _MISSING and b is not _MISSING and \
+            compare(op, a, b)
+_COMPARE = dict((k, _comparison(op)) for k, op in _COMPARISONS.items())
+
+class Filter(object):
+    """A compiled filter expression. 'evaluate' takes the tags dictionary of
+    an item and returns if the expression is true for it, 'tag_names' are
+    all tags the expression looks at."""
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tree = _Parser(expr).parse()
+
+        compiler = _Compiler()
+        code = compiler.truth(self.tree) if self.tree else "False"
+        self.tag_names = compiler.tag_names
+        self.evaluate = eval("lambda tags: %s" % code, compiler.namespace)
+
+def normalize(expr):
+    """The same for expressions that only differ in white space, redundant
+    parentheses or the quotes of values"""
+    return repr(_Parser(expr).parse())
+
+class FilterCache(object):
+    """The results of the last 'max_entries' filters that were used, the
+    least recently used is dropped first. Every result is kept with the
+    names of the tags it depends on, and it is dropped when an item with one
+    of them changes. 'hits' and 'misses' count the lookups."""
+
+    def __init__(self, max_entries = 32):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        # key -> (tag names, result), the most recently used last
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The result for 'key', None if there is none"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, names, result):
+        """Keep 'result' for 'key' until a tag in 'names' changes"""
+        self._entries.pop(key, None)
+        self._entries[key] = (frozenset(names), result)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, names):
+        """Drop the results that depend on any of the tags 'names'"""
+        for key, (depends, result) in self._entries.items():
+            if not depends.isdisjoint(names):
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __str__(self):
+        lookups = max(self.hits + self.misses, 1)
+        return "%i of %i filters cached, %i hits, %i misses (%.0f%% hits)" % (
+                len(self), self.max_entries, self.hits, self.misses,
+                100. * self.hits / lookups)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+An inverted index from tags to the items that carry them. TaskPaperFile
+keeps one up to date, so that questions like 'which items are @due' do not
+need to walk the whole tree.
+"""
+
+from tag_values import typed_value
+
+_by_lineno = lambda o: o.lineno
+
+class TagIndex(object):
+    def __init__(self):
+        self._by_name = {}
+        self._by_value = {}
+
+        # name -> the items in document order, built on demand
+        self._sorted = {}
+
+    def add(self, item, tag):
+        self._by_name.setdefault(tag.name, set()).add(item)
+        if tag.value is not None:
+            self._by_value.setdefault((tag.name, tag.value), set()).add(item)
+        self._sorted.pop(tag.name, None)
+
+    def remove(self, item, tag):
+        items = self._by_name.get(tag.name)
+        if items is not None:
+            items.discard(item)
+            if not items: del self._by_name[tag.name]
+        if tag.value is not None:
+            key = (tag.name, tag.value)
+            items = self._by_value.get(key)
+            if items is not None:
+                items.discard(item)
+                if not items: del self._by_value[key]
+        self._sorted.pop(tag.name, None)
+
+    def add_all(self, by_name, by_value):
+        """Add many items at once. 'by_name' maps tag names to the items with
+        the tag, 'by_value' (name, value) pairs to the items with the tag
+        set to that value."""
+        for name, items in by_name.iteritems():
+            self._by_name.setdefault(name, set()).update(items)
+        for key, items in by_value.iteritems():
+            self._by_value.setdefault(key, set()).update(items)
+        self._sorted.clear()
+
+    def add_item(self, item):
+        for t in item.tags.values():
+            self.add(item, t)
+
+    def remove_item(self, item):
+        for t in item.tags.values():
+            self.remove(item, t)
+
+    def names(self):
+        return self._by_name.keys()
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def count(self, name):
+        return len(self._by_name.get(name, ()))
+
+    def items(self, name):
+        """All items with the tag 'name', in document order"""
+        items = self._sorted.get(name)
+        if items is None:
+            items = sorted(self._by_name.get(name, ()), key=_by_lineno)
+            self._sorted[name] = items
+        return items
+
+    def items_with_value(self, name, value):
+        """All items with the tag 'name' set to 'value', in document order.
+        'value' can also be given as it is written."""
+        value = typed_value(value, name)
+        return sorted(self._by_value.get((name, value), ()), key=_by_lineno)
+
+    def candidates(self, names):
+        """The set of items which have at least one of the tags 'names'"""
+        found = set()
+        for name in names:
+            found.update(self._by_name.get(name, ()))
+        return found
+
+    def all_items(self):
+        """The set of items which have any tag at all"""
+        return self.candidates(self._by_name)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The types of tag values. When a tag is read, values that look like an
+integer, a decimal number, an ISO date or an ISO date with a time become an
+int, a float, a date or a datetime, so that filters and sorting compare
+them as what they are. Dates are parsed once per distinct value and shared
+by all tags with that value. TAG_VALUE_TYPES in config.py can declare the
+type of single tags instead.
+"""
+
+import datetime as dt
+import operator
+import re
+
+from config import TAG_VALUE_TYPES
+
+_VALUE = re.compile(r"""(?:
+    (?P<int>[-+]?\d+) |
+    (?P<float>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+    (?P<date>(?P<y>\d{4})-(?P<m>\d\d)-(?P<d>\d\d)
+        (?:[\ T](?P<time>(?P<H>\d\d):(?P<M>\d\d)(?::(?P<S>\d\d))?))?)
+)\Z""", re.X)
+
+# Which matches of _VALUE are converted for the types of TAG_VALUE_TYPES
+_KINDS = {
+    "auto": ("int", "float", "date"),
+    "number": ("int", "float"),
+    "date": ("date", ),
+    "text": (),
+}
+
+class DateTime(dt.datetime):
+    """A date with a time that is written back as it was read"""
+    __slots__ = ("text", )
+
+    def __str__(self):
+        return self.text
+
+# Text -> date or DateTime, or the text itself if it is not a valid one. It
+# is emptied when it has _MAX_DATES entries, so that a long session does not
+# keep every date it ever read.
+_dates = {}
+_MAX_DATES = 4096
+
+def _date(m):
+    text = m.group("date")
+    value = _dates.get(text)
+    if value is None:
+        if len(_dates) >= _MAX_DATES:
+            _dates.clear()
+        ymd = [int(g) for g in m.group("y", "m", "d")]
+        try:
+            if m.group("time") is None:
+                value = dt.date(*ymd)
+            else:
+                value = DateTime(*(ymd + [int(g or 0)
+                                   for g in m.group("H", "M", "S")]))
+                value.text = text
+        except ValueError:
+            value = text
+        _dates[text] = value
+    return value
+
+def _kinds(name):
+    """The matches of _VALUE that are converted for the tag 'name'"""
+    declared = TAG_VALUE_TYPES.get(name, "auto")
+    try:
+        return _KINDS[declared]
+    except KeyError:
+        raise ValueError("TAG_VALUE_TYPES[%r] is %r, not one of %s" % (
+            name, declared, ", ".join(sorted(_KINDS))))
+
+def typed_value(value, name = None):
+    """The tag value 'value' as the type that it looks like, or that
+    TAG_VALUE_TYPES declares for the tag 'name'. Values that are not text
+    are returned as they are. A type in TAG_VALUE_TYPES that is not known
+    raises a ValueError."""
+    if not isinstance(value, basestring):
+        return value
+    kinds = _kinds(name)
+    m = _VALUE.match(value)
+    if m is None:
+        return value
+    kind = m.lastgroup
+    if kind not in kinds:
+        return value
+    if kind == "int":
+        return int(value)
+    if kind == "float":
+        return float(value)
+    return _date(m)
+
+def _as_datetime(value):
+    if isinstance(value, dt.datetime):
+        return value
+    return dt.datetime.combine(value, dt.time())
+
+def _kind(value):
+    """The kind of a tag value: 0 for True, which tags without a value
+    evaluate to, then numbers, dates and times, and text"""
+    if value is True or value is None:
+        return 0
+    if isinstance(value, (int, long, float)):
+        return 1
+    if isinstance(value, dt.date):
+        return 2
+    return 3
+
+_ORDERINGS = frozenset((operator.lt, operator.le, operator.gt, operator.ge))
+
+def compare(op, a, b):
+    """'op' applied to the tag values 'a' and 'b'. Values of different
+    kinds, like numbers and text, are not ordered, so that an ordering 'op'
+    is False for them. Dates are ordered with datetimes as if they were
+    midnight."""
+    if a.__class__ is not b.__class__:
+        if op in _ORDERINGS and _kind(a) != _kind(b):
+            return False
+        if isinstance(a, dt.date) and isinstance(b, dt.date):
+            return op(_as_datetime(a), _as_datetime(b))
+    return op(a, b)
+
+def sort_key(value):
+    """A key that orders tag values of all kinds, see _kind()"""
+    kind = _kind(value)
+    if kind == 0:
+        return (0, )
+    if kind == 2:
+        return (2, _as_datetime(value))
+    return (kind, value)
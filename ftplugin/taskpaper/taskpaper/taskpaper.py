@@ -3,29 +3,257 @@
 
 import re
 from collections import defaultdict
+import gc
+import heapq
+from itertools import islice
 import sys
 
 from config import *
 
 from _ordered_dict import OrderedDict
+from query import Filter, FilterCache, FilterSyntaxError, normalize
+from tag_index import TagIndex
+from tag_values import typed_value, sort_key
+from logbook import LogbookStore, DAY_FORMAT
+from mapped import MappedFile
+
+class TagDict(object):
+    """The tags of an item by name, in the order they were written. Items
+    only have a handful of tags, so they are kept in a tuple. Changes are
+    reported to the item, so that the tag index of its file stays up to
+    date."""
+    __slots__ = ("_tags", "_owner")
+
+    def __init__(self, tags = ()):
+        self._tags = tuple(tags)
+        self._owner = None
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __iter__(self):
+        return (t.name for t in self._tags)
+    iterkeys = __iter__
+
+    def __contains__(self, name):
+        for t in self._tags:
+            if t.name == name: return True
+        return False
+    has_key = __contains__
+
+    def get(self, name, default = None):
+        for t in self._tags:
+            if t.name == name: return t
+        return default
+
+    def __getitem__(self, name):
+        for t in self._tags:
+            if t.name == name: return t
+        raise KeyError(name)
+
+    def keys(self):
+        return [t.name for t in self._tags]
+
+    def values(self):
+        return list(self._tags)
+
+    def itervalues(self):
+        return iter(self._tags)
+
+    def items(self):
+        return [(t.name, t) for t in self._tags]
+
+    def __setitem__(self, name, tag):
+        if tag.name != name:
+            raise ValueError("Tag %r stored as %r!" % (tag.name, name))
+        old = self.get(name)
+        if old is None:
+            self._tags += (tag,)
+        else:
+            self._tags = tuple(tag if t is old else t for t in self._tags)
+        if self._owner is not None:
+            self._owner._tag_changed(old, tag)
+
+    def __delitem__(self, name):
+        old = self[name]
+        self._tags = tuple(t for t in self._tags if t is not old)
+        if self._owner is not None:
+            self._owner._tag_changed(old, None)
+
+    def pop(self, name, *default):
+        tag = self.get(name)
+        if tag is None:
+            if default: return default[0]
+            raise KeyError(name)
+        del self[name]
+        return tag
+
+    def clear(self):
+        for name in self.keys():
+            del self[name]
+
+    def reorder(self, names):
+        """Put the tags in the order of 'names'. This does not change which
+        tags there are and is therefore not reported."""
+        self._tags = tuple(self[n] for n in names)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.items())
+
+class _NoTags(TagDict):
+    """The tags of an item without tags. They are handed out afresh and not
+    kept, so that untagged items need no TagDict of their own; the first
+    tag that is set gives the item one."""
+    __slots__ = ()
+
+    def __setitem__(self, name, tag):
+        if tag.name != name:
+            raise ValueError("Tag %r stored as %r!" % (tag.name, name))
+        owner = self._owner
+        if owner is None:
+            raise TypeError("Tags of lines without an item can not be changed")
+        owner.add_tag(tag)
+        self._tags = owner._tags._tags
+
+    # Once a tag was set, the item has its own TagDict and we only pass on
+    # to it what is done to us
+    def __delitem__(self, name):
+        if self._owner is None or self._owner._tags is None:
+            raise KeyError(name)
+        del self._owner._tags[name]
+        self._tags = self._owner.tags._tags
+
+    def reorder(self, names):
+        if self._owner is not None and self._owner._tags is not None:
+            self._owner._tags.reorder(names)
+            self._tags = self._owner._tags._tags
+
+# The tags of lines that are not items, like the results of parse_line()
+_NO_TAGS = _NoTags()
+
+_new = object.__new__
+
+class _Childs(list):
+    """The children of an item as TextItem.childs hands them out. They are
+    kept in sibling links, so changing the list would lose them; it can only
+    be read."""
+    __slots__ = ()
+
+    def _frozen(self, *args):
+        raise TypeError("Use append_child(), insert_child(), delete() or "
+                        "assign childs to change the children of an item")
+    append = extend = insert = remove = pop = sort = reverse = _frozen
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _frozen
+    __iadd__ = __imul__ = _frozen
+
+# The children of all items without children
+_NO_CHILDS = _Childs()
 
 _TAGS = re.compile(r"\s*(@\w+)(\([^)]*\))?\s*")
+_unchanged = lambda s: s
 def _extract_tags(text):
-    tags = OrderedDict()
-
-    def _found(m):
-        name = m.group(1).strip()
-        value = m.group(2)
-        if value: value = value[1:-1].strip()
+    if '@' not in text:
+        return text, _NO_TAGS
+
+    # split() hands out text, tag name and tag value in turns and is a lot
+    # cheaper than a callback per tag. Names and values repeat a lot, so
+    # they are interned, which only works for byte strings.
+    _intern = intern if type(text) is str else _unchanged
+    parts = _TAGS.split(text)
+    tags = TagDict()
+    for i in range(1, len(parts), 3):
+        name, value = _intern(parts[i]), parts[i+1]
+        if value: value = _intern(value[1:-1].strip())
         tags[name] = Tag(name, value)
-        return ""
-    new_text = _TAGS.subn(_found, text)[0]
 
-    return new_text, tags
+    return ''.join(parts[::3]), tags
+
+# Task lines that are written back exactly as they are read, so that their
+# tags can be extracted when they are needed: every tag once, separated by
+# single spaces at the end, with values that Tag reads back unchanged.
+_CANONICAL_TASK = re.compile(r"""
+    (?!.*?(@\w+)(?!\w).*\ \1(?!\w))     # no tag twice
+    -[^@]*[^@\s]                        # the text
+    (?:\ @\w+(?:\(                      # the tags, with values that are
+        (?:\d{4}-\d\d-\d\d(?:[ T][\d:]+)?   # dates, numbers or words
+        | [1-9]\d{0,17}
+        | (?!(?:nan|inf|infinity)\))[a-z][\w-]*
+        )\))?)+\Z
+    """, re.X | re.I)
+
+# The tags of an item that were not extracted from its text yet
+_UNPARSED = object()
+
+def _classify(content):
+    """Decide what kind of item the (indent stripped) 'content' of a line is.
+    Returns the item class, its text and its tags, so that the tags have only
+    to be extracted once."""
+    if content[0] == '-':
+        text, tags = _extract_tags(content)
+        return Task, text, tags
+
+    if '@' not in content:
+        text, tags = content.strip(), None
+    else:
+        text, tags = _extract_tags(content)
+        text = text.strip()
+    if text[-1:] == ':':
+        if tags is None: tags = _NO_TAGS
+        return Project, text, tags
+    return CommentLine, content, None
+
+def _path_key(text):
+    """What find_path() compares: 'text' without markers and surrounding
+    white space"""
+    text = text.strip()
+    if text[:1] == '-':
+        return text[1:].lstrip()
+    if text[-1:] == ':':
+        return text[:-1].rstrip()
+    return text
+
+def _child_keys(item):
+    """The children of 'item' by their _path_key(), as lists in document
+    order"""
+    keys = {}
+    for c in item.childs:
+        keys.setdefault(_path_key(c.text), []).append(c)
+    return keys
+
+def parse_line(line):
+    """The indent, class, text and tags of the item on 'line', as
+    TaskPaperFile parses it. None for an empty line."""
+    content = line.lstrip('\t')
+    if not content.strip():
+        return None
+    line_type, text, tags = _classify(content)
+    return len(line) - len(content), line_type, text, tags or _NO_TAGS
+
+def format_line(text, tags, indent = 0):
+    """The line of an item with 'text', 'tags' and 'indent' as it is written
+    to a file"""
+    s = "\t" * indent + (text or "")
+    if len(tags):
+        s += " " + ' '.join(str(t) for t in tags.values())
+    s += '\n'
+    return s
 
 class TextItem(object):
+    # There is one item per line, so they are kept small: no __dict__, and
+    # items without children or tags share empty ones.
+    #
+    # The children are a doubly linked list, so that an item finds its
+    # siblings and leaves them in constant time. 'childs' is a list of them
+    # that is built again after an item was inserted or deleted and kept
+    # while children are only appended, which is all that parsing does.
+    __slots__ = ("_childs", "_first_child", "_last_child", "_prev_sibling",
+                 "_next_sibling", "lineno", "parent", "indent", "_text",
+                 "_tags", "_trailing_empty_lines")
+
     def __init__(self, indent, text, prev, lineno):
-        self.childs = []
+        self._childs = _NO_CHILDS
+        self._first_child = self._last_child = None
+        self._prev_sibling = self._next_sibling = None
         self.lineno = lineno
 
         # Search the parent
@@ -35,27 +263,142 @@ class TextItem(object):
         self.parent = pparent
 
         if self.parent:
-            self.parent.childs.append(self)
+            self.parent._append_child(self)
 
         self.indent = indent
-        self.text = text
+        self._text = text
 
-        self.tags = {}
+        self._tags = None
 
         self._trailing_empty_lines = 0
 
     def append_trailing_empty_line(self):
         self._trailing_empty_lines += 1
 
-    def _extract_tags(self):
-        self.text, self.tags = _extract_tags(self.text)
+    def _append_child(self, child):
+        last = self._last_child
+        child._prev_sibling = last
+        child._next_sibling = None
+        self._last_child = child
+        if last is None:
+            self._first_child = child
+            self._childs = _Childs((child, ))
+        else:
+            last._next_sibling = child
+            if self._childs is not None:
+                list.append(self._childs, child)
+
+    def _get_childs(self):
+        childs = self._childs
+        if childs is None:
+            childs = _Childs()
+            c = self._first_child
+            while c is not None:
+                list.append(childs, c)
+                c = c._next_sibling
+            self._childs = childs = childs or _NO_CHILDS
+        return childs
+
+    def _relink(self, childs):
+        self._first_child = self._last_child = None
+        self._childs = _NO_CHILDS
+        for c in childs:
+            self._append_child(c)
+
+    def _set_childs(self, childs):
+        self._relink(childs)
+        self.root._reorder(self)
+
+    # The list can not be changed, use the methods below or assign a new one
+    childs = property(_get_childs, _set_childs)
 
-    def deep_iterate(self):
-        """Iterate over all children, including their children"""
-        yield self
-        for c in self.childs:
-            for sc in c.deep_iterate():
-                yield sc
+    def _extract_tags(self):
+        self._text, tags = _extract_tags(self._text)
+        self._set_tags(tags)
+
+    # Task lines that are read back unchanged keep their tags in their text
+    # until either of them is used, see _CANONICAL_TASK
+    def _get_text(self):
+        if self._tags is _UNPARSED: self._extract_tags()
+        return self._text
+
+    def _set_text(self, text):
+        # Items that are not created by __init__ may not have tags or a
+        # parent yet
+        if getattr(self, "_tags", None) is _UNPARSED: self._extract_tags()
+        old, self._text = getattr(self, "_text", None), text
+        if getattr(self, "parent", None) is not None:
+            self.root._retext(self, old)
+
+    text = property(_get_text, _set_text)
+
+    def _get_tags(self):
+        if self._tags is _UNPARSED: self._extract_tags()
+        if self._tags is None:
+            tags = _new(_NoTags)
+            tags._tags, tags._owner = (), self
+            return tags
+        return self._tags
+
+    def _set_tags(self, tags):
+        if isinstance(tags, TagDict):
+            if not tags:
+                tags = None
+            else:
+                tags._owner = self
+        self._tags = tags
+
+    tags = property(_get_tags, _set_tags)
+
+    def add_tag(self, tag):
+        """Add 'tag' or replace the tag of the same name"""
+        if self._tags is _UNPARSED: self._extract_tags()
+        if self._tags is None:
+            self._tags = TagDict()
+            self._tags._owner = self
+        self._tags[tag.name] = tag
+
+    def _tag_changed(self, old, new):
+        """Called by our TagDict when the tag 'old' was replaced by 'new'.
+        Either of them can be None."""
+        root = self.root
+        if old is not None: root._untag(self, old)
+        if new is not None: root._tag(self, new)
+
+    def deep_iterate(self, post_order = False, prune = None, kinds = None):
+        """Iterate over self and all children, including their children.
+        Parents come before their children, or after them with
+        'post_order'. The children of items for which 'prune' returns true
+        are skipped, and only items that are instances of 'kinds', a class
+        or a tuple of classes, are returned."""
+        # An explicit stack instead of recursion: nested generators would
+        # hand every item up through all its parents, and deep trees would
+        # hit the recursion limit.
+        if post_order:
+            # Items are pushed a second time once their children are on the
+            # stack, as (item, ) tuples
+            stack = [self]
+            pop, push = stack.pop, stack.append
+            while stack:
+                o = pop()
+                if o.__class__ is tuple:
+                    o = o[0]
+                elif o.childs and (prune is None or not prune(o)):
+                    push((o, ))
+                    stack.extend(reversed(o.childs))
+                    continue
+                if kinds is None or isinstance(o, kinds):
+                    yield o
+            return
+
+        stack = [self]
+        pop, push = stack.pop, stack.extend
+        while stack:
+            o = pop()
+            if kinds is None or isinstance(o, kinds):
+                yield o
+            if o.childs and (prune is None or not prune(o)):
+                push(reversed(o.childs))
     __iter__ = deep_iterate
 
     def flat_iterate(self):
@@ -66,135 +409,712 @@ class TextItem(object):
 
     @property
     def prev(self):
+        """The sibling before us or, for the first child, the parent"""
         if self.parent:
-            idx = self.parent.childs.index(self)
-            if idx == 0: return self.parent
-            return self.parent.childs[idx-1]
+            if self._prev_sibling is None: return self.parent
+            return self._prev_sibling
+
+    @property
+    def next(self):
+        """The sibling after us, None for the last child"""
+        return self._next_sibling
+
+    def find_path(self, path):
+        """The item below us at 'path', None if there is none. 'path' is a
+        sequence of the texts of the items on the way down or a string of
+        them separated by '/', like "Work:/Client A:/- Call Bob". Markers
+        can be left out, "Work/Client A/Call Bob" finds the same item.
+        Where siblings have the same text, the first of them is taken.
+
+        A TaskPaperFile keeps the children of the items that were looked
+        at in an index, so that this only takes one lookup per text."""
+        if isinstance(path, basestring):
+            path = path.split('/')
+        root = self.root
+        o = self
+        for text in path:
+            found = root._children_by_key(o).get(_path_key(text))
+            if not found: return None
+            o = found[0]
+        return o
+
+    @property
+    def root(self):
+        o = self
+        while o.parent is not None:
+            o = o.parent
+        return o
+
+    def _link(self, child, before):
+        """Link 'child' into our children before 'before', at the end if it
+        is None"""
+        if before is None:
+            self._append_child(child)
+        else:
+            prev = before._prev_sibling
+            child._prev_sibling, child._next_sibling = prev, before
+            before._prev_sibling = child
+            if prev is None:
+                self._first_child = child
+            else:
+                prev._next_sibling = child
+            self._childs = None
+        child.parent = self
+        self.root._index_subtree(child)
+
+    def insert_child(self, idx, child):
+        """Insert 'child', which must not have a parent, together with its
+        children at position 'idx' of our childs"""
+        childs = self.childs
+        if idx < 0: idx = max(0, idx + len(childs))
+        self._link(child, childs[idx] if idx < len(childs) else None)
+
+    def append_child(self, child):
+        self._link(child, None)
+
+    def insert_before(self, item):
+        """Insert 'item', which must not have a parent, together with its
+        children as the sibling before us"""
+        self.parent._link(item, self)
+
+    def insert_after(self, item):
+        """Insert 'item', which must not have a parent, together with its
+        children as the sibling after us"""
+        self.parent._link(item, self._next_sibling)
 
     def delete(self):
-        if self.prev:
+        parent = self.parent
+        if parent:
             self.prev._trailing_empty_lines += self._trailing_empty_lines
-        if self.parent:
-            self.parent.childs.remove(self)
+            self.root._unindex_subtree(self)
+
+            prev, next = self._prev_sibling, self._next_sibling
+            if prev is None:
+                parent._first_child = next
+            else:
+                prev._next_sibling = next
+            if next is None:
+                parent._last_child = prev
+            else:
+                next._prev_sibling = prev
+            self._prev_sibling = self._next_sibling = None
+            parent._childs = None
 
         self._trailing_empty_lines = 0
         self.parent = None
 
+    def _children_by_key(self, item):
+        """Called on the root for the children of 'item' below it, as
+        _child_keys() returns them"""
+        return _child_keys(item)
+
+    def _retext(self, item, old_text):
+        """Called on the root when the text of 'item' below it changed from
+        'old_text'"""
+        pass
+
+    def _reorder(self, item):
+        """Called on the root when the children of 'item' below it were
+        replaced"""
+        pass
+
+    def _index_subtree(self, item):
+        """Called on the root when 'item' was added somewhere below it"""
+        pass
+
+    def _unindex_subtree(self, item):
+        """Called on the root when 'item' is about to be removed from below
+        it"""
+        pass
+
+    def _tag(self, item, tag):
+        """Called on the root when 'item' below it got 'tag'"""
+        pass
+
+    def _untag(self, item, tag):
+        """Called on the root when 'item' below it lost 'tag'"""
+        pass
+
     @property
     def text_with_tags(self):
-        s = self.text or ""
-        if len(self.tags):
-            s += " " + ' '.join(str(t) for t in self.tags.values())
-        s += '\n'
-        return s
+        if self._tags is _UNPARSED:
+            return self._text + '\n'
+        return format_line(self._text, self.tags)
 
     def __getitem__(self, text):
+        """The first of us and the items below us with 'text'. This walks the
+        tree, find_path() does not."""
         for c in self:
             if c.text == text: return c
         raise KeyError("No child with text %r!" % text)
 
-    def __str__(self):
-        s = "" if not self.indent else "\t" * self.indent
+    def iter_lines(self):
+        """Iterate over the lines of this item and all its children as they
+        are written to a file. Every line includes its newline."""
+        # An explicit stack of what is still to be written: either items or
+        # the number of empty lines that follow a finished subtree.
+        stack = [self]
+        while stack:
+            o = stack.pop()
+            if isinstance(o, int):
+                for i in range(o): yield '\n'
+                continue
 
-        if self.text:
-            s += self.text_with_tags
+            if o._tags is _UNPARSED:
+                yield "\t" * o.indent + o._text + '\n'
+            elif o._text:
+                yield "\t" * (o.indent or 0) + o.text_with_tags
+            if o._trailing_empty_lines:
+                stack.append(o._trailing_empty_lines)
+            stack.extend(reversed(o.childs))
 
-        for c in self.childs:
-            s += str(c)
+    def write_to(self, fileobj):
+        """Write this item and all its children to 'fileobj'"""
+        fileobj.writelines(self.iter_lines())
 
-        s += '\n' * self._trailing_empty_lines
-        return s
+    def __str__(self):
+        return ''.join(self.iter_lines())
 
     def __lt__(self, o):
         return self.lineno < o.lineno
     def __le__(self, o):
         return self.lineno <= o.lineno
 
-class TaskPaperFile(TextItem):
-    __INDENT = re.compile(r"^(\t*)(.*)")
-    __ORDER = re.compile(r"o:(\S+)")
+_ORDER = re.compile(r"o:(\S+)")
+def split_order(cmdline):
+    """Take the o: clause out of a filter 'cmdline'. Returns the rest, the
+    name of the tag to order by or None and if the order is reversed."""
+    m = _ORDER.search(cmdline)
+    if m is None:
+        return cmdline, None, False
+
+    cmdline = cmdline[:m.span(0)[0]] + cmdline[m.span(0)[1]:]
+    ocmd = m.group(1)
+    reverse = False
+    if ocmd[0] in '+-':
+        if ocmd[0] == '-':
+            reverse = True
+        ocmd = ocmd[1:]
+    if ocmd[0] != '@':
+        ocmd = '@' + ocmd
+    return cmdline, ocmd, reverse
+
+def _position(item):
+    """The place of 'item' in document order, by its line number. Items
+    that were added after the file was parsed do not have one and come
+    first, like TextItem.__lt__ orders them."""
+    return item.lineno or 0
+
+_LIMIT = re.compile(r"\bl:(\S+)")
+def split_limit(cmdline):
+    """Take the l: clause out of a filter 'cmdline'. Returns the rest and
+    the number of items to keep or None."""
+    m = _LIMIT.search(cmdline)
+    if m is None:
+        return cmdline, None
+    if not m.group(1).isdigit():
+        raise FilterSyntaxError("Expected a number of items", cmdline,
+                m.start(1))
+    return cmdline[:m.start(0)] + cmdline[m.end(0):], int(m.group(1))
+
+def order_items(items, key, reverse = False, limit = None, position = None):
+    """'items' sorted by key(item), stable. Items whose key is None, because
+    they do not have the tag to order by, come last in the order they were
+    given, whichever way the others are sorted. With a 'limit', only the
+    first that many are returned, which takes a heap of that size instead of
+    sorting all items. If 'position' is given, position(item) is the place
+    of an item in the order to keep, instead of the order of 'items'."""
+    # The position keeps equal keys in order and items from being compared
+    sign = -1 if reverse else 1
+    keyed, missing = [], []
+    for idx, item in enumerate(items):
+        k = key(item)
+        if position is not None:
+            idx = position(item)
+        if k is None:
+            missing.append((idx, item))
+        else:
+            keyed.append((k, sign * idx, item))
+
+    if limit is None:
+        keyed.sort(reverse=reverse)
+    elif reverse:
+        keyed = heapq.nlargest(limit, keyed)
+    else:
+        keyed = heapq.nsmallest(limit, keyed)
+    ordered = [item for k, idx, item in keyed]
+    if limit is None:
+        missing.sort()
+    else:
+        missing = heapq.nsmallest(limit - len(ordered), missing)
+    ordered.extend(item for idx, item in missing)
+    return ordered
 
-    def __init__(self, text):
+class TaskPaperFile(TextItem):
+    def __init__(self, text, tag_index = True):
+        """'text' is either the content of a file or an iterable over its
+        lines, for example another items iter_lines() or a MappedFile. If
+        'tag_index' is set, a TagIndex of all items is kept in
+        'tag_index'."""
         TextItem.__init__(self, None, None, None, None)
 
+        self._tag_index = TagIndex() if tag_index else None
+        # Items whose tags were not extracted, they are added to the tag
+        # index when it is used
+        self._unindexed = []
+        # The _child_keys() of the items find_path() went through
+        self._child_index = {}
+        self.filter_cache = FilterCache(FILTER_CACHE_SIZE)
+        self._build(self._parse, text)
+
+    @classmethod
+    def from_file(cls, filename, tag_index = True):
+        """Parse the file 'filename' through a MappedFile, which does not
+        need a copy of its content"""
+        with MappedFile(filename) as f:
+            return cls(f, tag_index)
+
+    @classmethod
+    def from_records(cls, records, tag_index = True):
+        """Build the tree from what records() returned, without parsing"""
+        tpf = cls.__new__(cls)
+        TextItem.__init__(tpf, None, None, None, None)
+        tpf._tag_index = TagIndex() if tag_index else None
+        tpf._unindexed = []
+        tpf._child_index = {}
+        tpf.filter_cache = FilterCache(FILTER_CACHE_SIZE)
+        tpf._build(tpf._load_records, records)
+        return tpf
+
+    @property
+    def tag_index(self):
+        """The TagIndex of all items, None if there is none"""
+        if self._unindexed:
+            self._build(self._index_unindexed, self._unindexed)
+        return self._tag_index
+
+    def _index_unindexed(self, items):
+        self._unindexed = []
+        by_name, by_value = defaultdict(list), defaultdict(list)
+        for o in items:
+            for t in o.tags.values():
+                by_name[t.name].append(o)
+                if t.value is not None:
+                    by_value[t.name, t.value].append(o)
+        self._tag_index.add_all(by_name, by_value)
+
+    def _build(self, func, arg):
+        # Building the tree allocates a lot of objects but none of them is
+        # garbage, so the cyclic garbage collector would only slow us down
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            func(arg)
+        finally:
+            if gc_was_enabled: gc.enable()
+
+    def _parse(self, text):
+        # Maps line numbers to the items on these lines, None for empty lines
+        self._lines = [None]
+
+        # The ancestors of the current line, innermost last. Their indents
+        # are strictly increasing, so the parent of a new line is the last
+        # one with a smaller indent.
+        stack = []
         le = None
-        for lidx,line in enumerate(text.splitlines()):
-            if not len(line.strip()):
+        if isinstance(text, basestring):
+            lines = text.splitlines()
+        else:
+            lines = (l.rstrip('\r\n') for l in text)
+        for lidx,line in enumerate(lines):
+            to = self._add_line(line, lidx + 1, stack)
+            if to is None:
                 if le: le.append_trailing_empty_line()
+            else:
+                le = to
+            self._lines.append(to)
+
+    def records(self):
+        """The items as a list of simple values, one entry per line: None for
+        an empty line, else a tuple of the kind, indent and text of the item
+        and its tags as a flat tuple of names and values. This is what parse
+        caches store, see from_records(). Like at_line(), it describes the
+        lines the tree was parsed from."""
+        records = []
+        for o in self._lines[1:]:
+            if o is None:
+                records.append(None)
+                continue
+            tags = None
+            if o.tags:
+                # marshal knows no dates, they are stored as text
+                tags = tuple(v for t in o.tags.values() for v in
+                             (t.name, t.value if not isinstance(t.value,
+                                 dt.date) else str(t.value)))
+            records.append((_KINDS.index(o.__class__), o.indent, o.text, tags))
+        return records
+
+    def _load_records(self, records):
+        # The same as _parse() and _add_item(), but records are trusted to
+        # come from a parse, so the items are filled in directly. The tag
+        # index is built in one go at the end.
+        self._lines = lines = [None]
+        stack = []
+        le = None
+        by_name, by_value = defaultdict(list), defaultdict(list)
+        new = object.__new__
+        for lineno, record in enumerate(records, 1):
+            if record is None:
+                if le is not None: le._trailing_empty_lines += 1
+                lines.append(None)
                 continue
 
-            m = self.__INDENT.match(line)
-            indent = len(m.group(1))
-            content = m.group(2)
-
-            line_type = CommentLine
-            if content[0] == '-':
-                line_type = Task
-            elif _extract_tags(content)[0].strip()[-1] == ':':
-                content = content.strip()
-                line_type = Project
-
-            to = line_type(indent, content, le, lidx + 1)
+            kind, indent, text, tags = record
+            while stack and stack[-1].indent >= indent:
+                stack.pop()
+            parent = stack[-1] if stack else self
+
+            o = new(_KINDS[kind])
+            o._childs = _NO_CHILDS
+            o._first_child = o._last_child = None
+            o.lineno = lineno
+            o.parent = parent
+            o.indent = indent
+            o._text = text
+            o._trailing_empty_lines = 0
+            o._tags = None
+            if tags is not None:
+                tag_objs = []
+                for i in range(0, len(tags), 2):
+                    t = new(Tag)
+                    t.name, t.value = tags[i], tags[i+1]
+                    if t.value.__class__ is str:
+                        t.value = typed_value(t.value, t.name)
+                    tag_objs.append(t)
+                    by_name[t.name].append(o)
+                    if t.value is not None:
+                        by_value[t.name, t.value].append(o)
+                o._tags = TagDict(tag_objs)
+                o._tags._owner = o
+            parent._append_child(o)
+
+            stack.append(o)
+            lines.append(o)
+            le = o
+
+        if self._tag_index is not None:
+            self._tag_index.add_all(by_name, by_value)
+
+    def _add_line(self, line, lineno, stack):
+        """Create the item for 'line' as a descendant of the items in 'stack',
+        which is updated to the ancestors of the next line. Returns None for
+        empty lines."""
+        content = line.lstrip('\t')
+        if not content.strip():
+            return None
+        indent = len(line) - len(content)
+        if content[0] == '-' and '@' in content and \
+                _CANONICAL_TASK.match(content):
+            line_type, tags = Task, _UNPARSED
+        else:
+            line_type, content, tags = _classify(content)
+        return self._add_item(line_type, indent, content, tags, lineno, stack)
+
+    def _add_item(self, line_type, indent, content, tags, lineno, stack):
+        while stack and stack[-1].indent >= indent:
+            stack.pop()
+
+        to = line_type(indent, content, stack[-1] if stack else None,
+                lineno, tags)
+
+        if not to.parent:
+            self._append_child(to)
+            to.parent = self
+
+        if self._tag_index is not None:
+            if tags is _UNPARSED:
+                self._unindexed.append(to)
+            elif tags:
+                self._tag_index.add_item(to)
+
+        stack.append(to)
+        return to
+
+    def reparse(self, lines, start, end, added):
+        """Bring the tree up to date after the lines 'start' up to but
+        excluding 'end' were replaced and 'added' lines were added (negative
+        for deleted lines), like Vim reports changes. 'lines' is the
+        complete new content, indexed from 0 like a Vim buffer.
+
+        Only the changed lines are parsed again, and the lines after them
+        until one is found that keeps its old parent. Everything from there
+        on is kept and only has its line number shifted."""
+        old_lines = self._lines
+        end = min(end, len(old_lines))
+        start = max(1, min(start, end))
+
+        # The item before the change and its ancestors are the parse state
+        prev_lineno = start - 1
+        while prev_lineno > 0 and old_lines[prev_lineno] is None:
+            prev_lineno -= 1
+        le = old_lines[prev_lineno] if prev_lineno else None
+        stack = []
+        o = le
+        while o is not None and o is not self:
+            stack.append(o)
+            o = o.parent
+        stack.reverse()
+        if le is not None:
+            le._trailing_empty_lines = start - 1 - prev_lineno
+
+        new_entries = []
+        new_items = set()
+        removed = set(o for o in old_lines[start:end] if o is not None)
+        def _add(line, lineno):
+            to = self._add_line(line, lineno, stack)
+            if to is not None:
+                new_items.add(to)
+            new_entries.append(to)
+            return to
+
+        for lineno in range(start, end + added):
+            to = _add(lines[lineno - 1], lineno)
+            if to is None:
+                if le: le.append_trailing_empty_line()
+            else:
+                le = to
 
-            if not to.parent:
-                self.childs.append(to)
-                to.parent = self
+        # Parse on until a line would get the same parent as before
+        sync = end
+        while sync < len(old_lines):
+            o = old_lines[sync]
+            if o is None:
+                if le: le.append_trailing_empty_line()
+                new_entries.append(None)
+                sync += 1
+                continue
 
-            le = to
+            while stack and stack[-1].indent >= o.indent:
+                stack.pop()
+            if (stack[-1] if stack else self) is o.parent:
+                break
+
+            removed.add(o)
+            le = _add(lines[sync + added - 1], sync + added)
+            sync += 1
+
+        # Splice the new items into the children of the kept items
+        touched = set(o.parent for o in removed) | \
+                  set(o.parent for o in new_items)
+        for p in touched:
+            if p in removed or p in new_items: continue
+            childs = [c for c in p.childs if c not in removed]
+            # The kept children stay in their order
+            p._relink([c for c in childs if c not in new_items and
+                           c.lineno < start] +
+                      [c for c in childs if c in new_items] +
+                      [c for c in childs if c not in new_items and
+                           c.lineno >= start])
+            self._child_index.pop(p, None)
+
+        if self.tag_index is not None:
+            for o in removed:
+                self.tag_index.remove_item(o)
+        for o in removed:
+            self._child_index.pop(o, None)
+        if self.filter_cache:
+            self.filter_cache.invalidate(_tag_names(removed | new_items))
+
+        old_lines[start:sync] = new_entries
+        if added:
+            for o in old_lines[start + len(new_entries):]:
+                if o is not None: o.lineno += added
 
     def filter(self, cmdline):
-        m = self.__ORDER.search(cmdline)
-        key = None
-        reverse = False
-
-        if m is not None:
-            cmdline = cmdline[:m.span(0)[0]] + cmdline[m.span(0)[1]:]
-            ocmd = m.group(1)
-            if ocmd[0] in '+-':
-                if ocmd[0] == '-':
-                    reverse = True
-                ocmd = ocmd[1:]
-            if ocmd[0] != '@':
-                ocmd = '@' + ocmd
-            key = lambda a: a.tags[ocmd].value if (ocmd in a.tags) else None
-
-        def _eval(o):
-            def _sub(m):
-                t = m.group(1)
-                if t in o.tags:
-                    if o.tags[t].value is not None:
-                        return " %r " % o.tags[t].value
-                    return " True "
-                return " False "
-
-            eval_str = _TAGS.sub(_sub, cmdline).strip()
-            return eval(eval_str) if eval_str else False
-
-        matches = set()
-        def _recurse(obj):
-            if _eval(obj):
-                matches.add(obj)
-            else:
-                for c in obj.childs:
-                    _recurse(c)
-
-        _recurse(self)
-
-        return sorted(matches, key=key, reverse=reverse)
+        """The items that match the filter expression 'cmdline', which can
+        end with an o: clause to order them by a tag and an l: clause to
+        keep only the first that many. The children of a match are not
+        looked at.
+
+        The results are kept in 'filter_cache' until an item with one of
+        the tags of the expression changes."""
+        return list(self._matches(cmdline, False))
+
+    def iter_filter(self, cmdline):
+        """Like filter(), but an iterator over the matches. If they are
+        found by walking the tree, which is without a tag index or for
+        expressions that are true for items without tags, and are not
+        ordered by an o: clause, every match is only looked for when it is
+        taken. These results are not kept in 'filter_cache'."""
+        return self._matches(cmdline, True)
+
+    def _matches(self, cmdline, lazy):
+        cmdline, ocmd, reverse = split_order(cmdline)
+        cmdline, limit = split_limit(cmdline)
+        key = (normalize(cmdline), ocmd, reverse, limit)
+        matches = self.filter_cache.get(key)
+        if matches is None:
+            f = Filter(cmdline)
+            if lazy and ocmd is None and self._walks(f):
+                return islice(self._walk_matches(f), limit)
+            matches = self._filter(f, ocmd, reverse, limit)
+            names = set(f.tag_names)
+            if ocmd is not None: names.add(ocmd)
+            self.filter_cache.put(key, names, matches)
+        return iter(matches)
+
+    def _walks(self, f):
+        """If the matches of the Filter 'f' are found by walking the tree
+        instead of through the tag index"""
+        # An item without any of the tags of the expression evaluates just
+        # like our empty tags, so only tagged items can match otherwise.
+        return self.tag_index is None or f.evaluate(self.tags)
+
+    def _walk_matches(self, f):
+        # Children of a match are not looked at
+        is_match = lambda o: f.evaluate(o.tags)
+        return (o for o in self.deep_iterate(prune=is_match) if is_match(o))
+
+    def _filter(self, f, ocmd, reverse, limit):
+        if not self._walks(f):
+            evaluate = f.evaluate
+            found = set(o for o in self.tag_index.candidates(f.tag_names)
+                    if evaluate(o.tags))
+
+            # Children of a match are not looked at
+            def _is_top(o):
+                p = o.parent
+                while p is not None and p not in found:
+                    p = p.parent
+                return p is None
+            # The matches are put in document order by their line numbers
+            # only as far as it is needed
+            matches = [o for o in found if _is_top(o)]
+            position = _position
+            if ocmd is None:
+                if limit is None:
+                    matches.sort(key=position)
+                    return matches
+                return heapq.nsmallest(limit, matches, key=position)
+        else:
+            matches = self._walk_matches(f)
+            position = None
+            if ocmd is None:
+                return list(islice(matches, limit))
+
+        def key(a):
+            t = a.tags.get(ocmd)
+            return sort_key(t.value) if t is not None else None
+        return order_items(matches, key, reverse, limit, position)
 
+    @property
+    def line_count(self):
+        """The number of lines the tree was parsed from"""
+        return len(self._lines) - 1
 
     def at_line(self, lineno):
         if lineno <= 0:
             raise IndexError("Line numbers start at 1!")
 
-        for c in self:
-            if c.lineno == lineno: return c
+        if lineno < len(self._lines):
+            return self._lines[lineno]
+
+    def at_lines(self, first, last):
+        """Return the items on the lines first up to but excluding last"""
+        if first <= 0:
+            raise IndexError("Line numbers start at 1!")
+
+        return [o for o in self._lines[first:last] if o is not None]
+
+    # Items keep the line number they were parsed from. Added items only take
+    # a line which is not occupied already.
+    def _children_by_key(self, item):
+        keys = self._child_index.get(item)
+        if keys is None:
+            keys = self._child_index[item] = _child_keys(item)
+        return keys
+
+    def _add_key(self, item):
+        keys = self._child_index.get(item.parent)
+        if keys is None: return
+        key = _path_key(item.text)
+        if key in keys:
+            # Where the item goes among the others with its text is not
+            # known here, they are sorted out when they are looked up again
+            del self._child_index[item.parent]
+        else:
+            keys[key] = [item]
+
+    def _remove_key(self, item, text):
+        keys = self._child_index.get(item.parent)
+        if keys is None: return
+        key = _path_key(text)
+        found = keys.get(key)
+        if found is not None and item in found:
+            found.remove(item)
+            if not found: del keys[key]
+
+    def _retext(self, item, old_text):
+        if self._child_index and old_text is not None:
+            self._remove_key(item, old_text)
+            self._add_key(item)
+
+    def _reorder(self, item):
+        self._child_index.pop(item, None)
+        # Matches are found in the order of the children without a tag
+        # index
+        self.filter_cache.clear()
+
+    def _index_subtree(self, item):
+        if self._child_index:
+            self._add_key(item)
+        if self.filter_cache:
+            self.filter_cache.invalidate(_tag_names(item))
+        for o in item:
+            if self.tag_index is not None:
+                self.tag_index.add_item(o)
+
+            if o.lineno is None or o.lineno <= 0: continue
+            if o.lineno >= len(self._lines):
+                self._lines.extend([None] * (o.lineno - len(self._lines) + 1))
+            if self._lines[o.lineno] is None:
+                self._lines[o.lineno] = o
+
+    def _unindex_subtree(self, item):
+        if self._child_index:
+            self._remove_key(item, item.text)
+            for o in item:
+                self._child_index.pop(o, None)
+        if self.filter_cache:
+            self.filter_cache.invalidate(_tag_names(item))
+        for o in item:
+            if self.tag_index is not None:
+                self.tag_index.remove_item(o)
+
+            if o.lineno is not None and 0 < o.lineno < len(self._lines) \
+                    and self._lines[o.lineno] is o:
+                self._lines[o.lineno] = None
+
+    def _tag(self, item, tag):
+        if self.tag_index is not None:
+            self.tag_index.add(item, tag)
+        if self.filter_cache:
+            self.filter_cache.invalidate((tag.name, ))
+
+    def _untag(self, item, tag):
+        if self.tag_index is not None:
+            self.tag_index.remove(item, tag)
+        if self.filter_cache:
+            self.filter_cache.invalidate((tag.name, ))
 
 class Project(TextItem):
-    def __init__(self, *args):
-        TextItem.__init__(self, *args)
+    __slots__ = ()
+
+    def __init__(self, indent, text, prev, lineno, tags = None):
+        TextItem.__init__(self, indent, text, prev, lineno)
 
-        self._extract_tags()
+        if tags is None: self._extract_tags()
+        else: self._set_tags(tags)
 
     @property
     def text_without_markers(self):
@@ -202,107 +1122,235 @@ class Project(TextItem):
 
 
 class Task(TextItem):
-    def __init__(self, *args):
-        TextItem.__init__(self, *args)
+    __slots__ = ()
+
+    def __init__(self, indent, text, prev, lineno, tags = None):
+        TextItem.__init__(self, indent, text, prev, lineno)
 
-        self._extract_tags()
+        if tags is None: self._extract_tags()
+        else: self._set_tags(tags)
 
     @property
     def text_without_markers(self):
         return self.text.lstrip()[2:]
 
 class CommentLine(TextItem):
-    def __init__(self, *args):
-        TextItem.__init__(self, *args)
+    __slots__ = ()
+
+    def __init__(self, indent, text, prev, lineno, tags = None):
+        TextItem.__init__(self, indent, text, prev, lineno)
 
     @property
     def text_without_markers(self):
         return self.text
 
 class Tag(object):
+    __slots__ = ("name", "value")
+
     def __init__(self, name, value = None):
         self.name = name
-        self.value = value
-        if value is not None:
-            for t in (int, float):
-                try:
-                    self.value = t(value)
-                    break
-                except ValueError:
-                    pass
+        self.value = typed_value(value, name)
 
     def __str__(self):
         return self.name if not self.value else "%s(%s)" % \
                 (self.name, self.value)
 
+# The kinds of items in parse cache records
+_KINDS = (Project, Task, CommentLine)
+
 import datetime as dt
-from copy import copy
 
-str2date = lambda sdate: dt.date(*map(int,sdate.split('-')))
-date2str = lambda date: date.strftime("%Y-%m-%d")
+def _tag_names(items):
+    """The names of all tags of 'items'"""
+    return set(name for o in items for name in o.tags.keys())
 
-def extract_timeline(tpf, gtoday = None):
-    tl = TaskPaperFile("")
-    today = dt.date.today() if not gtoday else gtoday
-    today_str = date2str(today)
+def _tagged(tpf, name):
+    """The items of 'tpf' that have the tag 'name', in document order"""
+    if getattr(tpf, "tag_index", None) is not None:
+        return tpf.tag_index.items(name)
+    return [o for o in tpf if name in o.tags]
 
-    projects = {}
-    for o in tpf:
-        try:
-            if "@due" in o.tags and not '@done' in o.tags:
-                dd = o.tags["@due"].value.split()[0]
-                other_date = str2date(dd)
-                diff_days = (other_date - today).days
+def _iter_blocks(items):
+    """Iterate over the lines of all 'items', separated by an empty line"""
+    for idx,item in enumerate(items):
+        if idx: yield '\n'
+        for l in item.iter_lines():
+            yield l
+
+str2date = lambda sdate: dt.date(*map(int,sdate.split('-')))
+date2str = lambda date: date.strftime("%Y-%m-%d")
 
-                text = "%s (+%i day%s):" % (
+def tag_date(value):
+    """The day of the tag value 'value': its date if it is a date or a date
+    with a time, else the date at the start of its text"""
+    if isinstance(value, dt.datetime):
+        return value.date()
+    if isinstance(value, dt.date):
+        return value
+    return str2date(str(value).split()[0])
+
+class Timeline(object):
+    """Creates the timeline of the due items of a file. What every item
+    contributed is remembered together with the lines of the item and its
+    children it was made from, so that only changed items are processed
+    again on the next call."""
+
+    def __init__(self):
+        # item -> (its subtree, due day key, timeline lines)
+        self._entries = {}
+        # due date -> (day key, project line), valid for _today only
+        self._days = {}
+        self._today = None
+        self._text = None
+
+    def _set_today(self, gtoday):
+        today = dt.date.today() if not gtoday else gtoday
+        if today != self._today:
+            self._today = today
+            self._days = {}
+            self._entries = {}
+
+    def day(self, due, gtoday = None):
+        """The day key and heading that an item with the @due value 'due'
+        goes below"""
+        self._set_today(gtoday)
+        return self._day(due)
+
+    def _day(self, due):
+        day = self._days.get(due)
+        if day is None:
+            other_date = tag_date(due)
+            diff_days = (other_date - self._today).days
+            if diff_days < 0:
+                day = (".00_overdue", "Overdue:\n")
+            elif diff_days == 0:
+                day = (".01_today", "Today:\n")
+            else:
+                day = (date2str(other_date), "%s (+%i day%s):\n" % (
                     other_date.strftime("%A, %d. %B %Y"),
-                    diff_days, "s" if diff_days != 1 else ""
-                )
-                if today_str > dd:
-                    text = "Overdue:"
-                    dd = ".00_overdue"
-                if today_str == dd:
-                    text = "Today:"
-                    dd = ".01_today"
-
-                if dd not in projects:
-                    p = Project(0, text, None, 0)
-                    tl.childs.append(p)
-
-                    p.due = dd
-                    projects[dd] = p
-
-                ad = copy(o)
-                ad._trailing_empty_lines = 0
-                ad.indent = 1
-                projects[dd].childs.append(ad)
-                ad.parent = projects[dd]
-        except Exception, e:
-                raise RuntimeError("%s\n\nError in todo file in line %i: %s!" %
-                        (str(e), o.lineno, o.text))
-
-    outstr = '\n'.join(str(c) for c in sorted(tl.childs, key=lambda p: p.due))
-    outstr = re.sub(r"\n{3,100}", "\n\n", outstr, re.M)
-    outstr += '\n\n vim:ro\n'
-
-    return outstr
+                    diff_days, "s" if diff_days != 1 else ""))
+            self._days[due] = day
+        return day
+
+    def _entry(self, o):
+        # What the lines of the item and its children are made of. This is
+        # much cheaper to compare than the lines themselves.
+        source = [(c, c.text, c.indent, c._trailing_empty_lines,
+                   c.tags.values()) for c in o]
+        cached = self._entries.get(o)
+        if cached is not None and cached[0] == source:
+            return cached
+
+        # The item goes below its day without its own empty lines, its
+        # children keep their indent
+        lines = list(o.iter_lines())
+        del lines[len(lines) - o._trailing_empty_lines:]
+        lines[0] = "\t" + o.text_with_tags
+        return (source, self._day(o.tags["@due"].value)[0], lines)
+
+    def entries(self, tpf, gtoday = None):
+        """The due items of 'tpf' as (day key, heading, item, lines) tuples,
+        sorted by day and then line"""
+        self._set_today(gtoday)
+
+        entries = {}
+        result = []
+        for o in _tagged(tpf, "@due"):
+            try:
+                if not '@done' in o.tags:
+                    entries[o] = entry = self._entry(o)
+                    result.append((entry[1], o, entry[2]))
+            except Exception, e:
+                    raise RuntimeError("%s\n\nError in todo file in line %i: %s!" %
+                            (str(e), o.lineno, o.text))
+        self._entries = entries
+
+        # The items are in document order, a stable sort keeps it in a day
+        result.sort(key=lambda entry: entry[0])
+        headings = dict(self._days.values())
+        return [(day, headings[day], o, lines) for day, o, lines in result]
+
+    def days(self, tpf, gtoday = None):
+        """The days of the timeline of 'tpf' in order, as (key, heading,
+        lines) tuples"""
+        return group_days((day, heading, lines)
+                for day, heading, o, lines in self.entries(tpf, gtoday))
+
+    def extract(self, tpf, gtoday = None):
+        """The timeline of 'tpf' as a string"""
+        return render_timeline(self.days(tpf, gtoday))
+
+    def write(self, tpf, filename, gtoday = None):
+        """Write the timeline of 'tpf' to 'filename' unless the file already
+        contains it. Returns if the file was written."""
+        text = self.extract(tpf, gtoday)
+        if text == self._text:
+            return False
+        self._text = text
+        return write_if_changed(filename, text)
+
+def group_days(entries):
+    """Put the lines of the (day key, heading, lines) 'entries', which are
+    sorted by day, together by day"""
+    days = []
+    for day, heading, lines in entries:
+        if days and days[-1][0] == day:
+            days[-1][2].extend(lines)
+        else:
+            days.append((day, heading, list(lines)))
+    return days
+
+def iter_timeline(days):
+    """Iterate over the lines of a timeline with the (key, heading, lines)
+    'days' as returned by Timeline.days(). They must be sorted by key, the
+    lines of days with the same key are put below one heading."""
+    last_key = None
+    last_line = None
+    for key, heading, day_lines in days:
+        # Days are separated by an empty line, but there is never more than
+        # one in a row
+        if key != last_key:
+            if last_line is not None and last_line != '\n': yield '\n'
+            yield heading
+            last_key, last_line = key, heading
+        for l in day_lines:
+            if l == '\n' and last_line == '\n': continue
+            yield l
+            last_line = l
+    yield '\n\n vim:ro\n'
+
+def render_timeline(days):
+    """The text of a timeline, see iter_timeline()"""
+    return ''.join(iter_timeline(days))
+
+def write_if_changed(filename, text):
+    """Write 'text' to 'filename' unless it already contains it. Returns if
+    the file was written."""
+    if os.path.exists(filename) and os.path.getsize(filename) == len(text) \
+            and open(filename).read() == text:
+        return False
+    with open(filename, "w") as f:
+        f.write(text)
+    return True
 
-def log_finished(tpf, logbook = None, gtoday = None):
-    if logbook is None:
-        logbook = TaskPaperFile("") if not os.path.exists(LOGBOOK_FILENAME) \
-                else TaskPaperFile(open(LOGBOOK_FILENAME).read())
+def extract_timeline(tpf, gtoday = None):
+    return Timeline().extract(tpf, gtoday)
 
-    new_tpf = TaskPaperFile(str(tpf))
-    new_logbook = TaskPaperFile(str(logbook))
+def take_finished(tpf, gtoday = None):
+    """Remove all finished items from a copy of 'tpf'. Returns the copy and
+    the removed items in lists by the day they were done on. The text of the
+    removed items starts with the texts of their parents, like it appears in
+    the logbook."""
+    new_tpf = TaskPaperFile(tpf.iter_lines())
 
     today = dt.date.today() if not gtoday else gtoday
 
     # Important, we remove elements from the TPF, so we have to make a lists of
     # them first, otherwise the tree changes while traversing
     done_items = defaultdict(list)
-    for e in list(new_tpf):
-        if isinstance(e, (Task, Project)) and '@done' in e.tags:
-            done_date = str2date(e.tags['@done'].value) if \
+    for e in list(_tagged(new_tpf, '@done')):
+        if isinstance(e, (Task, Project)):
+            done_date = tag_date(e.tags['@done'].value) if \
                     e.tags['@done'].value else today
             done_items[done_date].append(e)
             parents = []
@@ -319,44 +1367,85 @@ def log_finished(tpf, logbook = None, gtoday = None):
             for c in e: c.indent += indent_diff
             e.delete()
 
+    return new_tpf, done_items
+
+def log_finished(tpf, logbook = None, gtoday = None):
+    """Move the finished items of 'tpf' into a single file 'logbook'. This
+    reads and writes the whole logbook, LogbookStore only appends."""
+    if logbook is None:
+        logbook = TaskPaperFile("") if not os.path.exists(LOGBOOK_FILENAME) \
+                else TaskPaperFile.from_file(LOGBOOK_FILENAME)
+
+    new_tpf, done_items = take_finished(tpf, gtoday)
+    new_logbook = TaskPaperFile(logbook.iter_lines())
+
+    # The day of each day project and the first project of each day
+    days, projects = {}, {}
+    for p in new_logbook.childs:
+        days[p] = dt.datetime.strptime(p.text, DAY_FORMAT).date()
+        projects.setdefault(days[p], p)
+
     for date in sorted(done_items.keys(), reverse=True):
-        proj_name = date.strftime("%A, %d. %B %Y:")
-        proj = None
-        try:
-            proj = new_logbook[proj_name]
-        except KeyError:
-            proj = Project(0, proj_name, None, 1)
-            new_logbook.childs.insert(0, proj)
+        proj = projects.get(date)
+        if proj is None:
+            proj = Project(0, date.strftime(DAY_FORMAT), None, 1)
+            new_logbook.insert_child(0, proj)
+            days[proj], projects[date] = date, proj
 
         for task in done_items[date]:
-            proj.childs.append(task)
-            task.parent = proj
+            proj.append_child(task)
 
-    new_logbook.childs.sort(
-        key=lambda a: dt.datetime.strptime(a.text, "%A, %d. %B %Y:").date(),
-        reverse=True,
-    )
+    new_logbook.childs = sorted(new_logbook.childs, key=days.get, reverse=True)
     for c in new_logbook: c._trailing_empty_lines = 0
 
-    return new_tpf, TaskPaperFile('\n'.join(str(c) for c in new_logbook.childs))
+    return new_tpf, TaskPaperFile(_iter_blocks(new_logbook.childs))
+
+def write_logbook(logbook, fileobj):
+    """Write a logbook as returned by log_finished to 'fileobj'"""
+    fileobj.writelines(_iter_blocks(logbook.childs))
+
+def open_logbook_store(filename = LOGBOOK_STORE_FILENAME,
+        legacy_filename = LOGBOOK_FILENAME):
+    """The LogbookStore in 'filename'. A new one starts out with the items of
+    the single file logbook 'legacy_filename' if there is one."""
+    store = LogbookStore(filename)
+    if not store.days() and os.path.exists(legacy_filename):
+        store.import_logbook(TaskPaperFile.from_file(legacy_filename))
+    return store
 
 def reorder_tags(tpf):
-    for obj in tpf:
+    items = tpf if getattr(tpf, "tag_index", None) is None else \
+            tpf.tag_index.all_items()
+    for obj in items:
+        if len(obj.tags) < 2: continue
         tag_order = sorted([t.name for t in obj.tags.values() if not t.value]) + \
                     sorted([t.name for t in obj.tags.values() if t.value])
-        for tn in tag_order:
-            obj.tags[tn] = obj.tags.pop(tn)
+        obj.tags.reorder(tag_order)
 
 
 if __name__ == '__main__':
     from optparse import OptionParser
 
     def parse_args():
-        parser = OptionParser("%prog [options] <input file>")
+        parser = OptionParser("%prog [options] <input file or directory> ...")
         parser.add_option("-t", "--timeline", action="store_true",
                 default=False, help="create a timeline", metavar="FILE")
         parser.add_option("-l", "--logbook", action="store_true",
                 default=False, help="update the logbook with done items", metavar="FILE")
+        parser.add_option("-e", "--export-logbook", action="store_true",
+                default=False, help="write the logbook as a single file")
+        parser.add_option("--no-cache", action="store_false", dest="cache",
+                default=True, help="always parse the input file")
+        parser.add_option("--per-file-timelines", action="store_true",
+                default=False, help="with more than one input file, write "
+                "the timeline of each file next to it")
+        parser.add_option("-j", "--jobs", type="int", default=None,
+                help="with more than one input file, the number of "
+                "processes; one per core by default")
+        parser.add_option("--stream", action="store_true", default=False,
+                help="read a single input file line by line instead of "
+                "building its tree, for files larger than memory; it is only "
+                "written back to remove done items")
 
         o, a = parser.parse_args()
 
@@ -365,18 +1454,76 @@ if __name__ == '__main__':
 
         return o,a
 
+    def main_batch(o, a):
+        from batch import BatchOptions, find_files, process_files
+
+        options = BatchOptions(
+            log_done = o.logbook,
+            timelines = o.per_file_timelines,
+            merged_timeline = TIMELINE_FILENAME if o.timeline else None,
+            cache_directory = CACHE_DIRECTORY if o.cache else None,
+            cache_max_size = CACHE_MAX_SIZE,
+            today = dt.date.today(),
+        )
+        logbook = open_logbook_store() if o.logbook else None
+        print process_files(find_files(a), options, logbook, o.jobs)
+
+        if o.export_logbook:
+            with open(LOGBOOK_FILENAME, "w") as f:
+                open_logbook_store().export(f)
+
+    def main_stream(o, filename):
+        from events import iter_events, iter_finished, timeline_days
+
+        if o.logbook:
+            # What is left is written next to the file and replaces it once
+            # the logbook has the done items
+            done_lines = {}
+            tmp_filename = filename + ".tmp"
+            with open(filename) as f:
+                with open(tmp_filename, "w") as rest:
+                    for day, lines in iter_finished(iter_events(f),
+                            rest=rest):
+                        done_lines.setdefault(day, []).extend(lines)
+            open_logbook_store().log_lines(done_lines)
+            os.rename(tmp_filename, filename)
+
+        if o.export_logbook:
+            with open(LOGBOOK_FILENAME, "w") as f:
+                open_logbook_store().export(f)
+
+        if o.timeline:
+            with open(filename) as f:
+                write_if_changed(TIMELINE_FILENAME,
+                        render_timeline(timeline_days(iter_events(f))))
+
     def main():
         o, a = parse_args()
 
-        tpf = TaskPaperFile(open(a[0]).read())
+        if len(a) > 1 or os.path.isdir(a[0]):
+            return main_batch(o, a)
+
+        if o.stream:
+            return main_stream(o, a[0])
+
+        if o.cache:
+            from parse_cache import ParseCache
+            tpf = ParseCache(CACHE_DIRECTORY, CACHE_MAX_SIZE).load(a[0])
+        else:
+            tpf = TaskPaperFile.from_file(a[0])
 
         if o.logbook:
-            tpf = log_finished(tpf)
+            tpf, done_items = take_finished(tpf)
+            open_logbook_store().log(done_items)
+
+        if o.export_logbook:
+            with open(LOGBOOK_FILENAME, "w") as f:
+                open_logbook_store().export(f)
 
         if o.timeline:
-            open(TIMELINE_FILENAME, "w").write(extract_timeline(tpf))
+            Timeline().write(tpf, TIMELINE_FILENAME)
 
-        open(a[0], "w").write(str(tpf))
+        with open(a[0], "w") as f:
+            tpf.write_to(f)
 
     main()
-
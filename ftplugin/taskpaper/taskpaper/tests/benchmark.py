@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks for the TaskPaper library on generated files. These are not part
+of the test suite, run them directly:
+
+    python tests/benchmark.py [-s 1000,10000,100000] [benchmark ...]
+"""
+
+import os, sys
+sys.path.append(os.path.dirname(__file__) + os.path.sep + '..')
+
+import random
+from timeit import default_timer
+
+from taskpaper import *
+
+_WORDS = ("call", "mail", "write", "review", "buy", "fix", "plan", "meet",
+          "report", "slides", "budget", "bike", "garden", "taxes", "client",
+          "server", "draft", "book", "milk", "tickets")
+_TAGS = ("@home", "@work", "@phone", "@errand", "@waiting", "@today",
+         "@computer", "@next")
+
+def make_corpus(nlines, seed = 0):
+    """Generate a TaskPaper file with roughly 'nlines' lines: projects with
+    nested subprojects, tasks, notes, blank lines and tags, including @due
+    and @done dates around the year 2011."""
+    rnd = random.Random(seed)
+
+    def _words(n):
+        return ' '.join(rnd.choice(_WORDS) for i in range(n))
+
+    def _date():
+        return "2011-%02i-%02i" % (rnd.randint(1, 12), rnd.randint(1, 28))
+
+    def _tags():
+        tags = rnd.sample(_TAGS, rnd.randint(0, 2))
+        if rnd.random() < .2: tags.append("@due(%s)" % _date())
+        if rnd.random() < .3: tags.append("@done(%s)" % _date())
+        if rnd.random() < .1: tags.append("@priority(%i)" % rnd.randint(1, 5))
+        return (" " + ' '.join(tags)) if tags else ""
+
+    lines = []
+    while len(lines) < nlines:
+        lines.append("%s:%s" % (_words(2).capitalize(), _tags()))
+        depth = 1
+        for i in range(rnd.randint(5, 40)):
+            r = rnd.random()
+            if r < .05 and depth < 4:
+                lines.append("\t" * depth + "%s:%s" % (_words(2), _tags()))
+                depth += 1
+                continue
+            if r < .1 and depth > 1:
+                depth -= 1
+            if r < .75:
+                lines.append("\t" * depth + "- %s%s" % (_words(4), _tags()))
+            elif r < .95:
+                lines.append("\t" * depth + _words(8))
+            else:
+                # Blank lines only ever follow leafs, this keeps the file
+                # unchanged when it is written back.
+                lines.append("\t" * depth + "- %s" % _words(3))
+                lines.append("")
+        lines.append("")
+
+    return '\n'.join(lines[:nlines]) + '\n'
+
+def make_logbook(nlines, seed = 0):
+    """Generate a logbook with roughly 'nlines' lines: one project per day,
+    newest first, with the finished tasks of that day."""
+    import datetime as dt
+    rnd = random.Random(seed)
+
+    lines = []
+    day = dt.date(2011, 12, 31)
+    while len(lines) < nlines:
+        lines.append(day.strftime("%A, %d. %B %Y:"))
+        for i in range(rnd.randint(3, 30)):
+            tags = rnd.sample(_TAGS, rnd.randint(0, 2)) + \
+                    ["@done(%s)" % day.strftime("%Y-%m-%d")]
+            lines.append("\t- %s \xe2\x80\xa2 %s %s" % (
+                rnd.choice(_WORDS).capitalize(),
+                ' '.join(rnd.choice(_WORDS) for i in range(4)),
+                ' '.join(tags)))
+        lines.append("")
+        day -= dt.timedelta(days=1)
+
+    return '\n'.join(lines[:nlines]) + '\n'
+
+def _best_of(func, repeat = 3):
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        func()
+        took = default_timer() - start
+        best = took if best is None else min(best, took)
+    return best
+
+BENCHMARKS = []
+def _benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+@_benchmark
+def parse(nlines, text):
+    took = _best_of(lambda: TaskPaperFile(text))
+    # Tags are extracted when they are first used, the tag index uses all
+    took_tags = _best_of(lambda: TaskPaperFile(text).tag_index)
+    assert str(TaskPaperFile(text)) == text, "Round trip is not exact!"
+    return [("parse", took), ("parse and extract all tags", took_tags)]
+
+@_benchmark
+def serialize(nlines, text):
+    tpf = TaskPaperFile(text)
+    nodes = sum(1 for o in tpf)
+    devnull = open(os.devnull, "w")
+    took_str = _best_of(lambda: str(tpf))
+    took_write = _best_of(lambda: tpf.write_to(devnull))
+    return [
+        ("str (%.2f us/node)" % (took_str / nodes * 1e6), took_str),
+        ("write_to (%.2f us/node)" % (took_write / nodes * 1e6), took_write),
+    ]
+
+def _old_filter(tpf, cmdline):
+    """TaskPaperFile.filter as it was before filters were compiled: the tags
+    are substituted into the expression which is eval'ed for every item"""
+    import datetime, re
+    tags_re = re.compile(r"\s*(@\w+)(\([^)]*\))?\s*")
+    def _eval(o):
+        def _sub(m):
+            t = m.group(1)
+            if t in o.tags:
+                if o.tags[t].value is not None:
+                    return " %r " % o.tags[t].value
+                return " True "
+            return " False "
+        return eval(tags_re.sub(_sub, cmdline).strip(),
+                {"datetime": datetime})
+
+    matches = set()
+    def _recurse(obj):
+        if _eval(obj): matches.add(obj)
+        else:
+            for c in obj.childs: _recurse(c)
+    _recurse(tpf)
+    return sorted(matches)
+
+@_benchmark
+def filter(nlines, text):
+    tpf = TaskPaperFile(text)
+    walk_tpf = TaskPaperFile(text, tag_index=False)
+    cmdline = "(@today or @next) and not @done and @priority > 2"
+    assert _old_filter(tpf, cmdline) == tpf.filter(cmdline)
+    assert [o.lineno for o in walk_tpf.filter(cmdline)] == \
+           [o.lineno for o in tpf.filter(cmdline)]
+    def _uncached(t, cmdline = cmdline):
+        t.filter_cache.clear()
+        return t.filter(cmdline)
+    return [
+        ("eval per item", _best_of(lambda: _old_filter(tpf, cmdline), 1)),
+        ("compiled, walk", _best_of(lambda: _uncached(walk_tpf))),
+        ("compiled, tag index", _best_of(lambda: _uncached(tpf))),
+        ("cached", _best_of(lambda: tpf.filter(cmdline))),
+        ("dates, tag index", _best_of(lambda: _uncached(tpf,
+            "@due < 2011-06-01 and not @done"))),
+    ]
+
+@_benchmark
+def timeline(nlines, text):
+    import datetime as dt
+    today = dt.date(2011, 6, 1)
+    tpf = TaskPaperFile(text)
+    walk_tpf = TaskPaperFile(text, tag_index=False)
+    timeline = Timeline()
+    timeline.extract(tpf, today)
+    return [
+        ("walk", _best_of(lambda: extract_timeline(walk_tpf, today))),
+        ("tag index", _best_of(lambda: extract_timeline(tpf, today))),
+        ("cached", _best_of(lambda: timeline.extract(tpf, today))),
+    ]
+
+@_benchmark
+def topk(nlines, text):
+    """The next 20 items by @due, against ordering all of them"""
+    tpf = TaskPaperFile(text)
+    items = list(tpf)[1:]
+    key = lambda o: sort_key(o.tags["@due"].value) if "@due" in o.tags \
+            else None
+    cmdline = "@due or @priority or @today o:due"
+    def _uncached(cmdline):
+        tpf.filter_cache.clear()
+        return tpf.filter(cmdline)
+    assert _uncached(cmdline)[:20] == _uncached(cmdline + " l:20")
+    return [
+        ("order_items, all", _best_of(lambda: order_items(items, key))),
+        ("order_items, top 20", _best_of(lambda:
+            order_items(items, key, limit=20))),
+        ("filter, all", _best_of(lambda: _uncached(cmdline))),
+        ("filter, top 20", _best_of(lambda: _uncached(cmdline + " l:20"))),
+    ]
+
+def _date_between(o, name, first, last):
+    value = o.tags[name].value
+    try:
+        return first <= tag_date(value) <= last
+    except (AttributeError, ValueError, TypeError, IndexError):
+        return False
+
+@_benchmark
+def columns(nlines, text):
+    """Tasks due in the next 14 days and not done and tasks done in March,
+    by walking the tree and with Columns"""
+    import datetime as dt
+    from columns import Columns
+    today = dt.date(2011, 6, 1)
+    soon = today + dt.timedelta(14)
+    march, april = dt.date(2011, 3, 1), dt.date(2011, 3, 31)
+    tpf = TaskPaperFile(text)
+
+    def _walk():
+        return [o for o in tpf if "@due" in o.tags and
+                not "@done" in o.tags and
+                _date_between(o, "@due", today, soon)], \
+               [o for o in tpf if "@done" in o.tags and
+                _date_between(o, "@done", march, april)]
+    def _columns(cols):
+        return cols.select(cols.date_between("@due", today, soon) &
+                           ~cols.has("@done")), \
+               cols.select(cols.date_between("@done", march, april))
+    def _build():
+        cols = Columns(tpf)
+        cols.dates("@due"), cols.dates("@done"), cols.has_tag("@done")
+        return cols
+
+    cols = _build()
+    assert _walk() == _columns(cols)
+    return [
+        ("walk", _best_of(_walk)),
+        ("build columns", _best_of(_build)),
+        ("columns", _best_of(lambda: _columns(cols))),
+    ]
+
+@_benchmark
+def cache(nlines, text):
+    """Load a file through the parse cache"""
+    import shutil, tempfile
+    from parse_cache import ParseCache
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, "todo.taskpaper")
+        open(fn, "w").write(text)
+        cache = ParseCache(os.path.join(tmpdir, "cache"))
+        cache.load(fn)
+        assert str(cache.load(fn)) == text
+        def _touched():
+            os.utime(fn, None)
+            cache.load(fn)
+        return [
+            ("parse", _best_of(lambda: TaskPaperFile(open(fn).read()))),
+            ("hit", _best_of(lambda: cache.load(fn))),
+            ("hit, touched file", _best_of(_touched)),
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+@_benchmark
+def batch(nlines, text):
+    """Make timelines for 'nlines' lines in 40 files"""
+    import datetime as dt
+    import multiprocessing, shutil, tempfile
+    from batch import BatchOptions, find_files, process_files
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for i in range(40):
+            open(os.path.join(tmpdir, "%02i.taskpaper" % i), "w").write(
+                    make_corpus(nlines // 40, i))
+        options = BatchOptions(merged_timeline=os.path.join(tmpdir, "tl"),
+                today=dt.date(2011, 6, 1))
+        filenames = find_files([tmpdir])
+        return [
+            ("1 process", _best_of(
+                lambda: process_files(filenames, options, processes=1))),
+            ("pool of %i" % multiprocessing.cpu_count(), _best_of(
+                lambda: process_files(filenames, options))),
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+@_benchmark
+def reparse(nlines, text):
+    """Toggle @done on a task in the middle of the file"""
+    lines = text.splitlines()
+    tpf = TaskPaperFile(lines)
+    lineno = next(o.lineno for o in tpf.at_lines(nlines // 2, nlines)
+                  if isinstance(o, Task))
+    old, new = lines[lineno - 1], lines[lineno - 1] + " @done"
+    def _toggle():
+        lines[lineno - 1] = new if lines[lineno - 1] == old else old
+        tpf.reparse(lines, lineno, lineno + 1, 0)
+    return [
+        ("full parse", _best_of(lambda: TaskPaperFile(lines))),
+        ("one line", _best_of(_toggle)),
+    ]
+
+@_benchmark
+def logdone(nlines, text):
+    """Log the finished items of a small file into a logbook of 'nlines'"""
+    import datetime as dt
+    import shutil, tempfile
+    today = dt.date(2012, 1, 1)
+    todo = TaskPaperFile("Project:\n" + ''.join(
+        "\t- Task %i @done\n" % i for i in range(10)))
+    logbook_text = make_logbook(nlines)
+    devnull = open(os.devnull, "w")
+
+    def _single_file():
+        tpf, logbook = log_finished(todo, TaskPaperFile(logbook_text), today)
+        write_logbook(logbook, devnull)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, "logbook.log")
+        LogbookStore(fn).import_logbook(TaskPaperFile(logbook_text))
+        def _store():
+            tpf, done_items = take_finished(todo, today)
+            LogbookStore(fn).log(done_items)
+        return [
+            ("single file", _best_of(_single_file)),
+            ("store", _best_of(_store)),
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+@_benchmark
+def archive(nlines, text):
+    """Archive 'nlines' finished tasks from a single project, between as many
+    open ones"""
+    import datetime as dt
+    today = dt.date(2012, 1, 1)
+    todo = TaskPaperFile("Project:\n" + ''.join(
+        "\t- Task %i\n\t- Task %i @done(2011-01-01)\n" % (i, i)
+        for i in range(nlines)))
+    return [
+        ("take_finished", _best_of(lambda: take_finished(todo, today))),
+        ("log_finished", _best_of(lambda:
+            log_finished(todo, TaskPaperFile(""), today))),
+    ]
+
+_MEASURE_MEMORY = """
+import sys
+sys.path.insert(0, %r)
+from taskpaper import *
+
+def rss():
+    return int(open("/proc/self/statm").read().split()[1]) * 4096
+
+text = open(%r).read()
+before = rss()
+tpf = TaskPaperFile(text)
+after = rss()
+print after - before, sum(1 for o in tpf)
+"""
+
+@_benchmark
+def memory(nlines, text):
+    """Memory of the tree of a logbook, measured in a fresh interpreter"""
+    import subprocess, tempfile
+    with tempfile.NamedTemporaryFile(suffix=".taskpaper") as f:
+        f.write(make_logbook(nlines))
+        f.flush()
+        out = subprocess.check_output([sys.executable, "-c", _MEASURE_MEMORY %
+            (os.path.join(os.path.dirname(__file__), '..'), f.name)])
+    used, nodes = [int(v) for v in out.split()]
+    return [("logbook", float(used) / nodes, "bytes/node")]
+
+_MEASURE_PEAK = """
+import sys
+sys.path.insert(0, %r)
+from taskpaper import *
+from events import iter_events, timeline_days
+
+def peak():
+    for line in open("/proc/self/status"):
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1])
+
+before = peak()
+if %r == "tree":
+    Timeline().days(TaskPaperFile(open(%r)))
+else:
+    timeline_days(iter_events(open(%r)))
+print peak() - before
+"""
+
+@_benchmark
+def stream(nlines, text):
+    """The timeline of a file from its tree and from its events: time and
+    peak memory, measured in a fresh interpreter"""
+    import subprocess, tempfile
+    from events import iter_events, timeline_days
+
+    results = [
+        ("tree", _best_of(lambda: Timeline().days(TaskPaperFile(text)))),
+        ("events", _best_of(lambda: timeline_days(iter_events(text)))),
+    ]
+    with tempfile.NamedTemporaryFile(suffix=".taskpaper") as f:
+        f.write(text)
+        f.flush()
+        for how in ("tree", "events"):
+            out = subprocess.check_output([sys.executable, "-c",
+                _MEASURE_PEAK % (os.path.join(os.path.dirname(__file__), '..'),
+                    how, f.name, f.name)])
+            results.append(("%s peak" % how, int(out), "kB"))
+    return results
+
+_MEASURE_READ = """
+import sys
+sys.path.insert(0, %r)
+from taskpaper import *
+
+def peak():
+    for line in open("/proc/self/status"):
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1])
+
+before = peak()
+if %r == "read":
+    tpf = TaskPaperFile(open(%r).read())
+else:
+    tpf = TaskPaperFile.from_file(%r)
+print peak() - before
+"""
+
+@_benchmark
+def mapped(nlines, text):
+    """Parsing a logbook from its content and through a memory map: time
+    and peak memory, measured in a fresh interpreter"""
+    import subprocess, tempfile
+    with tempfile.NamedTemporaryFile(suffix=".taskpaper") as f:
+        f.write(make_logbook(nlines))
+        f.flush()
+        results = [
+            ("read", _best_of(lambda: TaskPaperFile(open(f.name).read()))),
+            ("map", _best_of(lambda: TaskPaperFile.from_file(f.name))),
+        ]
+        for how in ("read", "map"):
+            out = subprocess.check_output([sys.executable, "-c",
+                _MEASURE_READ % (os.path.join(os.path.dirname(__file__), '..'),
+                    how, f.name, f.name)])
+            results.append(("%s peak" % how, int(out), "kB"))
+    return results
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser("%prog [options] [benchmark ...]")
+    parser.add_option("-s", "--sizes", default="1000,10000,100000",
+            help="comma separated list of file sizes in lines")
+    o, a = parser.parse_args()
+
+    sizes = [int(s) for s in o.sizes.split(',')]
+    benchmarks = [b for b in BENCHMARKS if not a or b.__name__ in a]
+
+    for nlines in sizes:
+        text = make_corpus(nlines)
+        for bench in benchmarks:
+            for result in bench(nlines, text):
+                name = "%s/%s" % (bench.__name__, result[0])
+                if len(result) == 3:
+                    print "%-40s %7i lines %9.1f %s" % ((name, nlines) +
+                            result[1:])
+                    continue
+                took = result[1]
+                print "%-40s %7i lines %9.2f ms %11.0f lines/s" % (
+                    name, nlines, took * 1000., nlines / took)
+
+if __name__ == '__main__':
+    main()
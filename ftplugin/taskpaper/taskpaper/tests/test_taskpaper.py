@@ -3,7 +3,12 @@
 
 import unittest
 
+import datetime as dt
 import os, sys
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
 sys.path.append(os.path.dirname(__file__) + os.path.sep + '..')
 
 from taskpaper import *
@@ -22,6 +27,67 @@ class TestTag(unittest.TestCase):
     def test_str(self):
         eq_("@done", str(self.t1))
         eq_("@due(2011-09-14)", str(self.t2))
+
+class TestTagValues(unittest.TestCase):
+    def _value(self, value, name = "@x"):
+        return Tag(name, value).value
+
+    def test_types(self):
+        eq_(3, self._value("3"))
+        eq_(1.5, self._value("1.5"))
+        eq_(dt.date(2011, 9, 14), self._value("2011-09-14"))
+        eq_(dt.datetime(2011, 9, 14, 12, 30), self._value("2011-09-14 12:30"))
+        eq_("2011-02-30", self._value("2011-02-30"))
+        eq_("nan", self._value("nan"))
+
+    def test_dates_are_shared(self):
+        ok_(self._value("2011-09-14") is Tag("@due", "2011-09-14").value)
+
+    def test_time_is_written_as_read(self):
+        eq_("@due(2011-09-14T12:30)", str(Tag("@due", "2011-09-14T12:30")))
+
+    def test_declared_type(self):
+        TAG_VALUE_TYPES["@version"] = "text"
+        try:
+            eq_("1.10", self._value("1.10", "@version"))
+        finally:
+            del TAG_VALUE_TYPES["@version"]
+        eq_(1.1, self._value("1.10", "@version"))
+
+    def test_unknown_declared_type(self):
+        TAG_VALUE_TYPES["@version"] = "txt"
+        try:
+            self._value("1.10", "@version")
+        except ValueError, e:
+            ok_("TAG_VALUE_TYPES['@version'] is 'txt'" in str(e))
+        else:
+            ok_(False, "Should not be accepted")
+        finally:
+            del TAG_VALUE_TYPES["@version"]
+
+    def test_parsed_dates_are_bounded(self):
+        tag_values = sys.modules[typed_value.__module__]
+        max_dates = tag_values._MAX_DATES
+        tag_values._MAX_DATES = 2
+        try:
+            for day in range(1, 6):
+                self._value("2011-09-%02i" % day)
+                ok_(len(tag_values._dates) <= 2)
+        finally:
+            tag_values._MAX_DATES = max_dates
+        eq_(dt.date(2011, 9, 5), self._value("2011-09-05"))
+
+    def test_compare_dates_and_times(self):
+        tpf = TaskPaperFile("- a @due(2011-09-14 12:30)\n- b @due(2011-09-14)\n"
+                            "- c @due(someday)\n")
+        eq_(["- a"], [o.text for o in tpf.filter("@due > 2011-09-14")])
+        eq_(["- b"], [o.text for o in
+                      tpf.filter("@due < '2011-09-14 08:00'")])
+
+    def test_text_is_not_ordered_with_numbers(self):
+        tpf = TaskPaperFile("- a @p(high)\n- b @p(1)\n- c @p(3)\n")
+        eq_(["- c"], [o.text for o in tpf.filter("@p > 2")])
+        eq_(["- a"], [o.text for o in tpf.filter("@p < low")])
 # End: Tag class  }}}
 # Parsing of Tags  {{{
 class _DummyTextItem(TextItem):
@@ -48,6 +114,10 @@ class TestParsingOfTags(unittest.TestCase):
         d = _DummyTextItem("Blah @ka2wi @andAnother")
         eq_(["@ka2wi", "@andAnother"], d.tags.keys())
 
+    def test_unicode(self):
+        d = _DummyTextItem(u"Hello @done @uuid(abc)")
+        eq_([u"@done", u"@uuid"], d.tags.keys())
+        eq_(u"abc", d.tags[u"@uuid"].value)
 
 # End: Parsing of Tags  }}}
 
@@ -156,7 +226,7 @@ class TestParsingWithTags(TestParsingSimple):
         eq_(["@btag", "@atag", "@due"],
             [t.name for t in p.tags.values()]
         )
-        eq_([None, None, "2011-09-13"],
+        eq_([None, None, dt.date(2011, 9, 13)],
             [t.value for t in p.tags.values()]
         )
 
@@ -165,7 +235,70 @@ class TestParsingWithTags(TestParsingSimple):
 
         eq_(1, len(p.childs[2].tags))
         eq_(1, len(p.childs[3].tags))
+
+class TestParsingIndentationJumps(_KeepContentIntactTPFBaseTest):
+    text = \
+"""One project:
+			A deeply indented comment
+		- A task
+	- Back to the project
+	Subproject: @atag
+		- Its task
+Second project:
+"""
+
+    def test_tree(self):
+        p1, p2 = self.tpf.childs
+        eq_(["A deeply indented comment", "- A task", "- Back to the project",
+             "Subproject:"], [c.text for c in p1.childs])
+        eq_(["- Its task"], [c.text for c in p1.childs[3].childs])
+        eq_(0, len(p2.childs))
+        eq_(self.tpf, p2.parent)
+
+class TestParsingLineWithOnlyTags(_KeepContentIntactTPFBaseTest):
+    text = \
+"""One project:
+	@atag @btag(1)
+	- A task
+"""
+
+    def test_is_comment(self):
+        c = self.tpf.childs[0].childs[0]
+        eq_("CommentLine", c.__class__.__name__)
+        eq_("@atag @btag(1)", c.text)
+        eq_(0, len(c.tags))
 # End: Parsing Tests  }}}
+# Serialization  {{{
+class TestSerialization(_TPFBaseTest):
+    text = \
+"""One project: @atag
+	- Task one @done(2011-04-01)
+		Comment for task one
+
+	Subproject:
+		- Task two
+
+
+Another project:
+"""
+
+    def test_iter_lines(self):
+        lines = list(self.tpf.iter_lines())
+        eq_(self.text.splitlines(True), lines)
+
+    def test_iter_lines_of_subtree(self):
+        eq_(["\tSubproject:\n", "\t\t- Task two\n", "\n", "\n"],
+            list(self.tpf.childs[0].childs[1].iter_lines()))
+
+    def test_write_to(self):
+        from StringIO import StringIO
+        f = StringIO()
+        self.tpf.write_to(f)
+        eq_(self.text, f.getvalue())
+
+    def test_parse_from_lines(self):
+        eq_(self.text, str(TaskPaperFile(self.tpf.iter_lines())))
+# End: Serialization  }}}
 # Access Elements by Line Numbers  {{{
 class TestAccessByLineNumbers(_KeepContentIntactTPFBaseTest):
     text = \
@@ -207,6 +340,39 @@ class TestAccessByLineNumbers(_KeepContentIntactTPFBaseTest):
     def test_access_out_of_bounds_too_high_returns_None(self):
         eq_(None, self.tpf.at_line(10))
 
+    def test_empty_line_returns_None(self):
+        eq_(None, self.tpf.at_line(5))
+
+    def test_range(self):
+        eq_(["A comment", "Another", "- A Task", "- Another"],
+            [o.text for o in self.tpf.at_lines(2, 7)])
+
+    def test_range_too_high(self):
+        eq_(["- And one more task"],
+            [o.text for o in self.tpf.at_lines(9, 100)])
+
+    @raises(IndexError)
+    def test_range_out_of_bounds_zero(self):
+        self.tpf.at_lines(0, 3)
+
+    def test_delete_removes_subtree(self):
+        self.tpf.at_line(7).delete()
+        eq_(None, self.tpf.at_line(7))
+        eq_(None, self.tpf.at_line(8))
+        eq_(None, self.tpf.at_line(9))
+        eq_("- Another", self.tpf.at_line(6).text)
+
+    def test_append_child(self):
+        t = Task(1, "- A new task", None, 12)
+        self.tpf.at_line(1).append_child(t)
+        eq_(t, self.tpf.at_line(12))
+        eq_(self.tpf.at_line(1), t.parent)
+
+    def test_append_child_does_not_replace(self):
+        t = Task(1, "- A new task", None, 4)
+        self.tpf.at_line(1).append_child(t)
+        eq_("- A Task", self.tpf.at_line(4).text)
+
 # End: Access Element by Line Numbers }}}
 # Access Elements by Text {{{
 class TestAccessByText(_KeepContentIntactTPFBaseTest):
@@ -268,6 +434,653 @@ Another Project: @ctags
         self.tpf['This does not exist!']
 
 # End: Access Element by Text }}}
+# Siblings  {{{
+class TestSiblings(_TPFBaseTest):
+    text = \
+"""Project:
+	- One
+	- Two
+
+	- Three
+"""
+
+    def setUp(self):
+        _TPFBaseTest.setUp(self)
+        self.p = self.tpf.childs[0]
+        self.one, self.two, self.three = self.p.childs
+
+    def test_prev(self):
+        eq_(self.p, self.one.prev)
+        eq_(self.one, self.two.prev)
+        eq_(None, self.tpf.prev)
+
+    def test_next(self):
+        eq_(self.two, self.one.next)
+        eq_(None, self.three.next)
+        eq_(None, self.p.next)
+
+    def test_delete(self):
+        self.two.delete()
+        eq_([self.one, self.three], self.p.childs)
+        eq_(self.one, self.three.prev)
+        eq_(self.three, self.one.next)
+        eq_("Project:\n\t- One\n\n\t- Three\n", str(self.tpf))
+
+    def test_delete_all(self):
+        for o in (self.two, self.one, self.three):
+            o.delete()
+        eq_([], self.p.childs)
+        eq_("Project:\n\n", str(self.tpf))
+
+    @raises(TypeError)
+    def test_childs_can_not_be_changed(self):
+        self.p.childs.append(Task(1, "- New", None, None))
+
+    @raises(TypeError)
+    def test_childs_of_leafs_can_not_be_changed(self):
+        self.one.childs.append(Task(2, "- New", None, None))
+
+    def test_insert_before(self):
+        t = Task(1, "- New", None, None)
+        self.one.insert_before(t)
+        eq_([t, self.one, self.two, self.three], self.p.childs)
+        eq_(self.p, t.parent)
+        eq_(t, self.one.prev)
+
+    def test_insert_after(self):
+        t = Task(1, "- New", None, None)
+        self.two.insert_after(t)
+        # The empty line stays with the item before it
+        eq_("Project:\n\t- One\n\t- Two\n\n\t- New\n\t- Three\n",
+            str(self.tpf))
+        eq_(self.three, t.next)
+
+    def test_insert_child(self):
+        new = [Task(1, "- New %i" % i, None, None) for i in range(3)]
+        self.p.insert_child(-1, new[0])
+        self.p.insert_child(10, new[1])
+        self.p.insert_child(0, new[2])
+        eq_([new[2], self.one, self.two, new[0], self.three, new[1]],
+            self.p.childs)
+
+    def test_insert_deleted(self):
+        self.three.delete()
+        self.one.insert_before(self.three)
+        eq_([self.three, self.one, self.two], self.p.childs)
+        eq_(self.three, self.tpf.at_line(5))
+
+# End: Siblings  }}}
+# Traversal  {{{
+class TestTraversal(_TPFBaseTest):
+    text = \
+"""Project:
+	- One
+		A note
+	Subproject: @done
+		- Two
+- Three
+"""
+
+    def _texts(self, items):
+        return [o.text for o in items if o is not self.tpf]
+
+    def test_pre_order(self):
+        eq_(["Project:", "- One", "A note", "Subproject:", "- Two",
+             "- Three"], self._texts(self.tpf))
+
+    def test_post_order(self):
+        eq_(["A note", "- One", "- Two", "Subproject:", "Project:",
+             "- Three"], self._texts(self.tpf.deep_iterate(post_order=True)))
+        eq_(self.tpf, list(self.tpf.deep_iterate(post_order=True))[-1])
+
+    def test_prune(self):
+        prune = lambda o: "@done" in o.tags or o.text == "- One"
+        eq_(["Project:", "- One", "Subproject:", "- Three"],
+            self._texts(self.tpf.deep_iterate(prune=prune)))
+        eq_(["- One", "Subproject:", "Project:", "- Three"],
+            self._texts(self.tpf.deep_iterate(post_order=True,
+                prune=prune)))
+
+    def test_kinds(self):
+        eq_(["- One", "- Two", "- Three"],
+            self._texts(self.tpf.deep_iterate(kinds=Task)))
+        eq_(["Project:", "A note", "Subproject:"],
+            self._texts(self.tpf.deep_iterate(kinds=(Project, CommentLine))))
+
+    def test_deep_tree(self):
+        text = ''.join("\t" * i + "- Task\n" for i in range(5000))
+        tpf = TaskPaperFile(text)
+        eq_(5001, len(list(tpf)))
+        eq_(5001, len(list(tpf.deep_iterate(post_order=True))))
+        eq_(text, str(tpf))
+
+# End: Traversal  }}}
+# Paths  {{{
+class TestFindPath(_TPFBaseTest):
+    text = \
+"""Work:
+	Client A: @home
+		- Call Bob
+		A note
+	- Call Bob
+Work:
+	- Second
+"""
+
+    def test_path(self):
+        eq_(self.tpf.at_line(3),
+            self.tpf.find_path("Work:/Client A:/- Call Bob"))
+        eq_(self.tpf.at_line(5), self.tpf.find_path(["Work:", "- Call Bob"]))
+
+    def test_without_markers(self):
+        eq_(self.tpf.at_line(3), self.tpf.find_path("Work/Client A/Call Bob"))
+        eq_(self.tpf.at_line(4), self.tpf.find_path("Work/Client A/A note"))
+
+    def test_relative(self):
+        eq_(self.tpf.at_line(3),
+            self.tpf.at_line(1).find_path("Client A:/- Call Bob"))
+
+    def test_first_of_same_text(self):
+        eq_(None, self.tpf.find_path("Work:/- Second"))
+
+    def test_not_found(self):
+        eq_(None, self.tpf.find_path("Work:/Client B:"))
+        eq_(None, self.tpf.find_path("Work:/- Call Bob/x"))
+
+    def test_insert_and_delete(self):
+        work = self.tpf.find_path("Work")
+        t = Task(1, "- New", None, None)
+        work.append_child(t)
+        eq_(t, self.tpf.find_path("Work/New"))
+
+        self.tpf.find_path("Work/Client A").delete()
+        eq_(None, self.tpf.find_path("Work/Client A/Call Bob"))
+        client = Project(1, "Client A:", None, None)
+        t.insert_before(client)
+        eq_(client, self.tpf.find_path("Work/Client A"))
+
+    def test_set_text(self):
+        t = self.tpf.find_path("Work/Call Bob")
+        t.text = "- Call Alice"
+        eq_(None, self.tpf.find_path("Work/Call Bob"))
+        eq_(t, self.tpf.find_path("Work/Call Alice"))
+
+    def test_reparse(self):
+        self.tpf.find_path("Work/Client A/Call Bob")
+        lines = self.text.splitlines()
+        lines[2] = "\t\t- Call Carol"
+        self.tpf.reparse(lines, 3, 4, 0)
+        eq_(None, self.tpf.find_path("Work/Client A/Call Bob"))
+        eq_(self.tpf.at_line(3),
+            self.tpf.find_path("Work/Client A/Call Carol"))
+
+# End: Paths  }}}
+
+# Filter Tests  {{{
+class TestFilter(_TPFBaseTest):
+    text = \
+"""Home: @home
+	- Wash the dishes @today
+	- Buy milk @errand @priority(2)
+Work:
+	- Write report @due(2011-04-02) @priority(1)
+	- Call client @phone @due(2011-03-30) @done
+	Old stuff: @done
+		- Something @today
+	- Prepare slides @priority(3) @due(2011-04-10)
+"""
+
+    def _texts(self, cmdline):
+        return [o.text for o in self.tpf.filter(cmdline)]
+
+    def test_tag(self):
+        eq_(["- Call client", "Old stuff:"], self._texts("@done"))
+
+    def test_matches_do_not_descend(self):
+        eq_(["Home:", "- Something"], self._texts("@home or @today"))
+
+    def test_and_not(self):
+        eq_(["- Write report", "- Prepare slides"],
+            self._texts("@due and not @done"))
+
+    def test_parentheses(self):
+        eq_(["- Buy milk", "- Call client"],
+            self._texts("(@errand or @phone) and not @today"))
+
+    def test_compare_number(self):
+        eq_(["- Buy milk", "- Prepare slides"], self._texts("@priority >= 2"))
+
+    def test_compare_chain(self):
+        eq_(["- Buy milk"], self._texts("1 < @priority < 3"))
+
+    def test_compare_quoted_string(self):
+        eq_(["- Write report"], self._texts("@due == '2011-04-02'"))
+
+    def test_compare_bare_date(self):
+        eq_(["- Write report", "- Call client"],
+            self._texts("@due < 2011-04-10"))
+
+    def test_tag_value_is_ignored(self):
+        eq_(["- Call client", "Old stuff:"], self._texts("@done(2011-01-01)"))
+
+    def test_order(self):
+        eq_(["- Write report", "- Buy milk", "- Prepare slides"],
+            self._texts("@priority o:priority"))
+
+    def test_order_reverse(self):
+        eq_(["- Prepare slides", "- Write report", "- Call client"],
+            self._texts("@due o:-@due"))
+
+    def test_order_missing_last(self):
+        eq_(["- Write report", "- Buy milk", "- Prepare slides",
+             "- Call client"], self._texts("@priority or @due o:priority"))
+        eq_(["- Prepare slides", "- Buy milk", "- Write report",
+             "- Call client"], self._texts("@priority or @due o:-priority"))
+
+    def test_limit(self):
+        eq_(["- Buy milk", "- Write report"], self._texts("@priority l:2"))
+
+    def test_limit_with_order(self):
+        eq_(["- Prepare slides", "- Buy milk"],
+            self._texts("@priority o:-priority l:2"))
+        eq_(["- Write report", "- Buy milk", "- Prepare slides"],
+            self._texts("@priority or @due o:priority l:3"))
+
+    @raises(FilterSyntaxError)
+    def test_limit_not_a_number(self):
+        self.tpf.filter("@today l:some")
+
+    def test_empty(self):
+        eq_([], self._texts(""))
+
+    @raises(FilterSyntaxError)
+    def test_syntax_error_missing_paren(self):
+        self.tpf.filter("(@home or @work")
+
+    @raises(FilterSyntaxError)
+    def test_syntax_error_operator(self):
+        self.tpf.filter("@home @work")
+
+    @raises(FilterSyntaxError)
+    def test_syntax_error_unterminated_string(self):
+        self.tpf.filter("@due == '2011")
+
+    def test_no_code_execution(self):
+        try:
+            self.tpf.filter("__import__('os')")
+        except FilterSyntaxError, e:
+            eq_(10, e.pos)
+        else:
+            ok_(False, "Should not be accepted")
+
+    def test_everything_matches_root(self):
+        eq_([self.tpf], self.tpf.filter("not @nothere"))
+
+    def test_iter_filter(self):
+        for cmdline in ("@done", "@home or @today", "@priority l:2",
+                "@priority or @due o:-priority l:3", "not @done",
+                "not @nothere", "@today l:0", ""):
+            eq_(self.tpf.filter(cmdline),
+                list(self.tpf.iter_filter(cmdline)))
+
+    @raises(FilterSyntaxError)
+    def test_iter_filter_syntax_error(self):
+        self.tpf.iter_filter("(@home or @work")
+
+class TestFilterWithoutTagIndex(TestFilter):
+    def setUp(self):
+        self.tpf = TaskPaperFile(self.text, tag_index=False)
+
+    def test_iter_filter_finds_matches_when_taken(self):
+        matches = self.tpf.iter_filter("@today")
+        eq_("- Wash the dishes", next(matches).text)
+        t = Task(1, "- Added", None, None)
+        t.add_tag(Tag("@today"))
+        self.tpf.at_line(4).append_child(t)
+        eq_(["- Something", "- Added"], [o.text for o in matches])
+
+class TestOrderItems(unittest.TestCase):
+    items = ["bb", "a", "x", "cc", "d"]
+
+    def _key(self, s):
+        return len(s) if s != "x" else None
+
+    def test_stable(self):
+        eq_(["a", "d", "bb", "cc", "x"], order_items(self.items, self._key))
+        eq_(["bb", "cc", "a", "d", "x"],
+            order_items(self.items, self._key, reverse=True))
+
+    def test_limit(self):
+        for limit in range(7):
+            for reverse in (False, True):
+                eq_(order_items(self.items, self._key, reverse)[:limit],
+                    order_items(self.items, self._key, reverse, limit))
+
+    def test_position(self):
+        # Items are kept in the order of their position, not as given
+        position = ["x", "d", "cc", "a", "bb"].index
+        eq_(["d", "a", "cc", "bb", "x"],
+            order_items(self.items, self._key, position=position))
+        eq_(["cc", "bb", "d", "a", "x"],
+            order_items(self.items, self._key, True, position=position))
+        for limit in range(7):
+            eq_(order_items(self.items, self._key, True,
+                            position=position)[:limit],
+                order_items(self.items, self._key, True, limit, position))
+
+class TestFilterCache(_TPFBaseTest):
+    text = TestFilter.text
+
+    def _texts(self, cmdline):
+        return [o.text for o in self.tpf.filter(cmdline)]
+
+    def test_hit(self):
+        self._texts("@today")
+        eq_(["- Wash the dishes", "- Something"],
+            self._texts(" ( @today ) "))
+        eq_((1, 1), (self.tpf.filter_cache.hits, self.tpf.filter_cache.misses))
+
+    def test_order_is_part_of_the_key(self):
+        self._texts("@priority")
+        eq_(["- Prepare slides", "- Buy milk", "- Write report"],
+            self._texts("@priority o:-@priority"))
+        eq_(0, self.tpf.filter_cache.hits)
+
+    def test_tag_change(self):
+        self._texts("@today")
+        self._texts("@phone")
+        self.tpf["- Buy milk"].add_tag(Tag("@today"))
+        eq_(["- Wash the dishes", "- Buy milk", "- Something"],
+            self._texts("@today"))
+        self._texts("@phone")
+        eq_(1, self.tpf.filter_cache.hits)
+
+    def test_tag_removed_from_match(self):
+        self._texts("@priority > 1")
+        del self.tpf["- Prepare slides"].tags["@priority"]
+        eq_(["- Buy milk"], self._texts("@priority > 1"))
+
+    def test_delete(self):
+        self._texts("@today")
+        self.tpf["Old stuff:"].delete()
+        eq_(["- Wash the dishes"], self._texts("@today"))
+
+    def test_insert(self):
+        self._texts("@today")
+        t = Task(1, "- New", None, 10)
+        t.add_tag(Tag("@today"))
+        self.tpf["Work:"].append_child(t)
+        eq_(["- Wash the dishes", "- Something", "- New"],
+            self._texts("@today"))
+
+    def test_reparse(self):
+        self._texts("@errand")
+        lines = self.text.splitlines()
+        lines[1] += " @errand"
+        self.tpf.reparse(lines, 2, 3, 0)
+        eq_(["- Wash the dishes", "- Buy milk"], self._texts("@errand"))
+
+    def test_results_can_be_changed(self):
+        self.tpf.filter("@today").pop()
+        eq_(2, len(self.tpf.filter("@today")))
+
+    def test_least_recently_used_is_dropped(self):
+        self.tpf.filter_cache.max_entries = 2
+        for cmdline in ("@today", "@phone", "@today", "@done"):
+            self._texts(cmdline)
+        self._texts("@today")
+        self._texts("@phone")
+        eq_((2, 4), (self.tpf.filter_cache.hits, self.tpf.filter_cache.misses))
+# End: Filter Tests  }}}
+# Tag Index  {{{
+class TestTagIndex(_KeepContentIntactTPFBaseTest):
+    text = \
+"""Home: @home
+	- Wash the dishes @today
+	- Buy milk @errand @due(2011-04-01)
+	A note with @today
+Work: @due(2011-04-01)
+	- Write report @due(2011-04-02) @today
+"""
+
+    def _texts(self, items):
+        return [o.text for o in items]
+
+    def test_items(self):
+        eq_(["- Wash the dishes", "- Write report"],
+            self._texts(self.tpf.tag_index.items("@today")))
+
+    def test_items_with_value(self):
+        eq_(["- Buy milk", "Work:"], self._texts(
+            self.tpf.tag_index.items_with_value("@due", "2011-04-01")))
+
+    def test_comments_are_not_indexed(self):
+        eq_(2, self.tpf.tag_index.count("@today"))
+
+    def test_unknown(self):
+        ok_("@nothere" not in self.tpf.tag_index)
+        eq_([], self.tpf.tag_index.items("@nothere"))
+
+    def test_toggle(self):
+        t = self.tpf.at_line(3)
+        t.tags['@done'] = Tag('@done', '2011-04-03')
+        eq_(["- Buy milk"], self._texts(self.tpf.tag_index.items("@done")))
+        t.tags.pop('@done')
+        ok_("@done" not in self.tpf.tag_index)
+
+    def test_change_value(self):
+        t = self.tpf.at_line(3)
+        t.tags['@due'] = Tag('@due', '2011-05-01')
+        eq_(["Work:"], self._texts(
+            self.tpf.tag_index.items_with_value("@due", "2011-04-01")))
+        eq_(["- Buy milk"], self._texts(
+            self.tpf.tag_index.items_with_value("@due", "2011-05-01")))
+
+    def test_delete(self):
+        self.tpf.at_line(5).delete()
+        eq_(["- Wash the dishes"],
+            self._texts(self.tpf.tag_index.items("@today")))
+        eq_(["- Buy milk"], self._texts(self.tpf.tag_index.items("@due")))
+
+    def test_deleted_items_are_not_reported(self):
+        t = self.tpf.at_line(2)
+        t.delete()
+        t.tags.pop('@today')
+        t.tags['@done'] = Tag('@done')
+        eq_(["- Write report"],
+            self._texts(self.tpf.tag_index.items("@today")))
+        ok_("@done" not in self.tpf.tag_index)
+
+    def test_append_child(self):
+        t = Task(1, "- New one @today", None, 10)
+        self.tpf.at_line(1).append_child(t)
+        eq_(["- Wash the dishes", "- Write report", "- New one"],
+            self._texts(self.tpf.tag_index.items("@today")))
+
+    def test_reorder_keeps_index(self):
+        reorder_tags(self.tpf)
+        eq_("- Buy milk @errand @due(2011-04-01)", str(self.tpf.at_line(3)).strip())
+        eq_(["- Buy milk"], self._texts(self.tpf.tag_index.items("@errand")))
+
+    def test_add_tag_to_untagged_item(self):
+        t = Task(1, "- Untagged", None, 10)
+        self.tpf.at_line(1).append_child(t)
+        t.add_tag(Tag('@today'))
+        eq_(["- Wash the dishes", "- Write report", "- Untagged"],
+            self._texts(self.tpf.tag_index.items("@today")))
+        eq_("\t- Untagged @today\n", str(t))
+
+    def test_set_tag_of_untagged_item(self):
+        t = Task(1, "- Untagged", None, 10)
+        self.tpf.at_line(1).append_child(t)
+        tags = t.tags
+        tags['@today'] = Tag('@today')
+        tags['@errand'] = Tag('@errand')
+        eq_(["- Wash the dishes", "- Write report", "- Untagged"],
+            self._texts(self.tpf.tag_index.items("@today")))
+        eq_(["@today", "@errand"], tags.keys())
+        eq_("\t- Untagged @today @errand\n", str(t))
+# End: Tag Index  }}}
+# Columns  {{{
+import columns
+from columns import Columns, KINDS, MISSING, UNDATED
+
+class TestColumns(_TPFBaseTest):
+    # The masks are computed without NumPy here, and with it, if it is
+    # installed, by TestColumnsWithNumPy
+    numpy = None
+    text = \
+"""Home:
+	- Wash the dishes @due(2011-04-01) @priority(2)
+	- Buy milk @due(2011-04-20) @done(2011-04-02)
+		A note
+	- Call mum @due(someday) @priority(high)
+Work: @done
+	- Write report @due(2011-04-10 12:00) @priority(1.5)
+"""
+    today = dt.date(2011, 4, 1)
+
+    def setUp(self):
+        self._numpy = columns.numpy
+        columns.numpy = self.numpy
+        _TPFBaseTest.setUp(self)
+        self.cols = Columns(self.tpf)
+
+    def tearDown(self):
+        columns.numpy = self._numpy
+
+    def _texts(self, mask):
+        return [o.text for o in self.cols.select(mask)]
+
+    def test_rows(self):
+        eq_([1, 2, 3, 4, 5, 6, 7], list(self.cols.lineno))
+        eq_([0, 1, 1, 2, 1, 0, 1], list(self.cols.depth))
+        eq_([Project, Task, Task, CommentLine, Task, Project, Task],
+            [KINDS[k] for k in self.cols.kind])
+
+    def test_dates(self):
+        eq_([MISSING, dt.date(2011, 4, 1).toordinal(),
+             dt.date(2011, 4, 20).toordinal(), MISSING, UNDATED, MISSING,
+             dt.date(2011, 4, 10).toordinal()], list(self.cols.dates("@due")))
+        eq_(UNDATED, self.cols.dates("@done")[5])
+
+    def test_parsed_dates_are_kept_by_the_columns(self):
+        self.cols.dates("@due")
+        ok_(self.cols._ordinals)
+        eq_({}, Columns(self.tpf)._ordinals)
+
+    def test_due_soon_and_not_done(self):
+        cols = self.cols
+        soon = cols.date_between("@due", self.today,
+                self.today + dt.timedelta(14))
+        eq_(["- Wash the dishes", "- Write report"],
+            self._texts(soon & ~cols.has("@done")))
+
+    def test_done_between(self):
+        eq_(["- Buy milk"], self._texts(self.cols.date_between("@done",
+            self.today, self.today + dt.timedelta(1))))
+
+    def test_numbers(self):
+        eq_(["- Wash the dishes", "- Write report"],
+            self._texts(self.cols.number_between("@priority", 1, 2)))
+
+    def test_kinds(self):
+        cols = self.cols
+        eq_(["Home:", "- Call mum", "Work:"], self._texts(
+            cols.of_kind(Project) | (cols.of_kind(Task) &
+                ~cols.date_between("@due", self.today, dt.date(2011, 12, 31)))))
+        eq_(4, len(cols.of_kind(Task)))
+
+    def test_without_tag_index(self):
+        cols = Columns(TaskPaperFile(self.text, tag_index=False))
+        eq_(list(self.cols.dates("@due")), list(cols.dates("@due")))
+        eq_(list(self.cols.has_tag("@done")), list(cols.has_tag("@done")))
+
+    def test_empty(self):
+        cols = Columns(TaskPaperFile(""))
+        eq_(0, len(cols))
+        eq_(0, len(cols.all()))
+        eq_([], cols.select(cols.has("@done")))
+        eq_([], cols.select(cols.of_kind(Task) | ~cols.all()))
+        eq_([], cols.select(cols.date_between("@due", self.today,
+                self.today)))
+        eq_([], cols.select(cols.number_between("@priority", 1, 2)))
+
+    def test_len_of_masks(self):
+        cols = self.cols
+        eq_(7, len(cols.all()))
+        eq_(2, len(cols.has("@done")))
+        eq_(5, len(~cols.has("@done")))
+        eq_(1, len(cols.of_kind(CommentLine)))
+
+class TestColumnsWithNumPy(TestColumns):
+    numpy = columns.numpy
+
+    def setUp(self):
+        if self.numpy is None:
+            raise unittest.SkipTest("NumPy is not installed")
+        TestColumns.setUp(self)
+
+    def test_masks_are_arrays(self):
+        ok_(isinstance(self.cols.has("@done").rows, self.numpy.ndarray))
+# End: Columns  }}}
+# Lazy Tags  {{{
+_UNPARSED = sys.modules[TextItem.__module__]._UNPARSED
+
+class TestLazyTags(_KeepContentIntactTPFBaseTest):
+    text = \
+"""Home: @home
+	- Wash the dishes @today
+	- Buy milk @errand @due(2011-04-01) @prio(2)
+	- Call mom  @phone
+	- Mail bob@example.com
+"""
+    wanted = \
+"""Home: @home
+	- Wash the dishes @today
+	- Buy milk @errand @due(2011-04-01) @prio(2)
+	- Call mom @phone
+	- Mail bob.com @example
+"""
+
+    def _unparsed(self):
+        return [o.lineno for o in self.tpf.childs[0].childs
+                if o._tags is _UNPARSED]
+
+    def test_only_lines_that_read_back_unchanged_are_lazy(self):
+        eq_([2, 3], self._unparsed())
+
+    def test_serialization_does_not_extract(self):
+        str(self.tpf)
+        eq_([2, 3], self._unparsed())
+
+    def test_text_extracts(self):
+        eq_("- Buy milk", self.tpf.at_line(3).text)
+        eq_([2], self._unparsed())
+        eq_(2, self.tpf.at_line(3).tags["@prio"].value)
+
+    def test_set_text_keeps_tags(self):
+        self.tpf.at_line(2).text = "- Wash the cups"
+        eq_("\t- Wash the cups @today\n", str(self.tpf.at_line(2)))
+
+    def test_add_tag(self):
+        self.tpf.at_line(2).add_tag(Tag("@done"))
+        eq_("\t- Wash the dishes @today @done\n", str(self.tpf.at_line(2)))
+        eq_(["- Wash the dishes"],
+            [o.text for o in self.tpf.tag_index.items("@done")])
+
+    def test_tag_index(self):
+        eq_(["- Buy milk"],
+            [o.text for o in self.tpf.tag_index.items("@errand")])
+        eq_([], self._unparsed())
+
+    def test_reparse(self):
+        lines = self.text.splitlines()
+        lines[1] = "\t- Dry the dishes @today @home"
+        self.tpf.reparse(lines, 2, 3, 0)
+        eq_(["Home:", "- Dry the dishes"],
+            [o.text for o in self.tpf.tag_index.items("@home")])
+# End: Lazy Tags  }}}
 
 # Timeline Tests  {{{
 class _CreateTimelineBase(unittest.TestCase):
@@ -346,6 +1159,55 @@ Today:
 
  vim:ro\n"""
 
+class TestTimelineCache(unittest.TestCase):
+    text = """My cool Project:
+	- This was due @due(2011-03-20)
+	- This is due tomorrow @due(2011-04-02)
+		A note
+	- This is not due
+"""
+
+    def setUp(self):
+        self.lines = self.text.splitlines()
+        self.tpf = TaskPaperFile(self.lines)
+        self.timeline = Timeline()
+        self.today = dt.date(2011, 04, 01)
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "timeline.taskpaper")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _change(self, lineno, line):
+        self.lines[lineno - 1] = line
+        self.tpf.reparse(self.lines, lineno, lineno + 1, 0)
+
+    def _check(self):
+        eq_(extract_timeline(TaskPaperFile(self.lines), self.today),
+            self.timeline.extract(self.tpf, self.today))
+
+    def test_changes(self):
+        self._check()
+        self._change(4, "\t\tAnother note")
+        self._check()
+        self._change(5, "\t- This is due now @due(2011-04-01)")
+        self._check()
+        self._change(2, "\t- This was due @due(2011-03-20) @done")
+        self._check()
+
+    def test_other_day(self):
+        self._check()
+        self.today = dt.date(2011, 04, 02)
+        self._check()
+
+    def test_written_only_when_changed(self):
+        ok_(self.timeline.write(self.tpf, self.fn, self.today))
+        eq_(self.timeline.extract(self.tpf, self.today), open(self.fn).read())
+        ok_(not self.timeline.write(self.tpf, self.fn, self.today))
+        ok_(not Timeline().write(self.tpf, self.fn, self.today))
+        self._change(5, "\t- This is due now @due(2011-04-01)")
+        ok_(self.timeline.write(self.tpf, self.fn, self.today))
+        eq_(self.timeline.extract(self.tpf, self.today), open(self.fn).read())
 # End: Timeline Tests  }}}
 # Logbook Tests  {{{
 class _CreateLogbookBase(_TPFBaseTest):
@@ -544,12 +1406,567 @@ class TestLogBook_RealLifeExample(_CreateLogbookBase):
 	- Privat • Verschiedenes • Sabine Danke für Ihren Pulli sagen @mail @done(2011-04-08) @due(2011-04-08)
 """
 # End: Logbook Tests  }}}
+# Mapped Files  {{{
+from mapped import MappedFile
+
+class TestMappedFile(unittest.TestCase):
+    text = "Project:\r\n\t- Task @due(2011-04-01)\n\n\tA note"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "todo.taskpaper")
+        open(self.fn, "wb").write(self.text)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lines(self):
+        with MappedFile(self.fn) as f:
+            eq_(self.text.splitlines(True), list(f))
+            eq_(len(self.text), len(f))
+
+    def test_part(self):
+        with MappedFile(self.fn) as f:
+            offsets = list(f.line_offsets())
+            eq_([(0, 10), (10, 35), (35, 36), (36, 43)], offsets)
+            eq_(["\t- Task @due(2011-04-01)\n", "\n"], list(f.lines(10, 36)))
+            eq_("Project:", f.read(0, 8))
+
+    def test_empty_file(self):
+        open(self.fn, "wb").close()
+        with MappedFile(self.fn) as f:
+            eq_([], list(f))
+            eq_("", str(TaskPaperFile(f)))
+
+    def test_parse(self):
+        tpf = TaskPaperFile.from_file(self.fn)
+        eq_(str(TaskPaperFile(self.text)), str(tpf))
+        eq_("A note", tpf.at_line(4).text)
+        eq_([2], [o.lineno for o in tpf.tag_index.items("@due")])
+# End: Mapped Files  }}}
+# Parse Cache  {{{
+from parse_cache import ParseCache
+
+class TestRecords(_TPFBaseTest):
+    text = """
+
+One project: @atag
+	- Task one @done(2011-04-01) @prio(2) @weight(1.5)
+		Comment for task one
+
+	Subproject:
+		- Task two @today
+Another project:
+"""
+
+    def _items(self, tpf):
+        return [(o.lineno, o.__class__, o.indent, o.text,
+                 [(t.name, t.value) for t in o.tags.values()],
+                 o.parent.lineno, o._trailing_empty_lines) for o in tpf
+                 if o is not tpf]
+
+    def test_round_trip(self):
+        tpf = TaskPaperFile.from_records(self.tpf.records())
+        eq_(str(self.tpf), str(tpf))
+        eq_(self._items(self.tpf), self._items(tpf))
+        eq_("- Task two", tpf.at_line(8).text)
+        eq_(["- Task one"], [o.text for o in tpf.filter("@prio == 2")])
+
+    def test_owner_of_tags(self):
+        tpf = TaskPaperFile.from_records(self.tpf.records())
+        tpf.at_line(4).tags.pop("@done")
+        ok_("@done" not in tpf.tag_index)
+
+class TestParseCache(unittest.TestCase):
+    text = "Project:\n\t- Task @due(2011-04-01)\n"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "todo.taskpaper")
+        open(self.fn, "w").write(self.text)
+        self.cache = ParseCache(os.path.join(self.dir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _load(self, wanted):
+        eq_(wanted, str(self.cache.load(self.fn)))
+
+    def test_hit(self):
+        self._load(self.text)
+        self._load(self.text)
+        eq_((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_changed_file(self):
+        self._load(self.text)
+        text = self.text + "\t- Another\n"
+        open(self.fn, "w").write(text)
+        self._load(text)
+        eq_((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_same_size_other_time(self):
+        self._load(self.text)
+        text = self.text.replace("Task", "Work")
+        open(self.fn, "w").write(text)
+        os.utime(self.fn, (1, 1))
+        self._load(text)
+        eq_((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_only_touched(self):
+        self._load(self.text)
+        os.utime(self.fn, (1, 1))
+        self._load(self.text)
+        self._load(self.text)
+        eq_((2, 1), (self.cache.hits, self.cache.misses))
+
+    def test_broken_entry(self):
+        self._load(self.text)
+        for fn in os.listdir(self.cache.directory):
+            open(os.path.join(self.cache.directory, fn), "w").write("junk")
+        self._load(self.text)
+        eq_((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_least_recently_used_are_evicted(self):
+        names = []
+        for i in range(3):
+            fn = os.path.join(self.dir, "%i.taskpaper" % i)
+            open(fn, "w").write(self.text * 10)
+            names.append(fn)
+        for i, fn in enumerate(names):
+            self.cache.load(fn)
+            entry = self.cache._entry_filename(fn)
+            os.utime(entry, (i, i))
+        size = os.path.getsize(entry)
+
+        # Using the first one makes the second one the oldest
+        self.cache.load(names[0])
+        self.cache.max_size = 2 * size
+        self.cache._evict()
+        eq_([True, False, True], [os.path.exists(self.cache._entry_filename(fn))
+                                  for fn in names])
+# End: Parse Cache  }}}
+# Logbook Store Tests  {{{
+class TestLogbookStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "logbook.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _log(self, text, today = dt.date(2011, 04, 03)):
+        tpf, done_items = take_finished(TaskPaperFile(text), today)
+        LogbookStore(self.fn).log(done_items)
+        return tpf
+
+    def _export(self):
+        f = StringIO()
+        LogbookStore(self.fn).export(f)
+        return f.getvalue()
+
+    def test_nothing_logged(self):
+        eq_([], LogbookStore(self.fn).days())
+        eq_("", self._export())
+
+    def test_export_is_like_log_finished(self):
+        texts = [
+            "My Project:\n\t- Over @done(2011-05-12)\n\t- Not\n",
+            "- Before @done(2011-05-11)\n- Same day @done(2011-05-12)\n",
+            "Sub: @done\n\t- child\n- Old one @done(2011-03-01)\n",
+        ]
+        logbook = TaskPaperFile("")
+        for text in texts:
+            tpf, logbook = log_finished(TaskPaperFile(text), logbook,
+                    dt.date(2011, 04, 03))
+            eq_(str(tpf), str(self._log(text)))
+        eq_(str(logbook), self._export())
+
+    def test_last_day_is_continued(self):
+        self._log("- One @done(2011-05-12)\n")
+        self._log("- Two @done(2011-05-12)\n")
+        eq_("""Thursday, 12. May 2011:
+	- One @done(2011-05-12)
+	- Two @done(2011-05-12)
+""", open(self.fn).read())
+        eq_(1, len(open(self.fn + ".idx").readlines()))
+
+    def test_older_day_is_appended(self):
+        self._log("- One @done(2011-05-12)\n")
+        self._log("- Two @done(2011-05-11)\n- Three @done(2011-05-12)\n")
+        eq_("""Thursday, 12. May 2011:
+	- One @done(2011-05-12)
+
+Wednesday, 11. May 2011:
+	- Two @done(2011-05-11)
+
+Thursday, 12. May 2011:
+	- Three @done(2011-05-12)
+""", open(self.fn).read())
+        store = LogbookStore(self.fn)
+        eq_([dt.date(2011, 05, 12), dt.date(2011, 05, 11)], store.days())
+        eq_(["\t- One @done(2011-05-12)\n", "\t- Three @done(2011-05-12)\n"],
+            store.read_day(dt.date(2011, 05, 12)))
+        eq_("""Thursday, 12. May 2011:
+	- One @done(2011-05-12)
+	- Three @done(2011-05-12)
+
+Wednesday, 11. May 2011:
+	- Two @done(2011-05-11)
+""", self._export())
+
+    def test_index_is_rebuilt(self):
+        self._log("- One @done(2011-05-12)\n- Two @done(2011-05-11)\n")
+        exported = self._export()
+        os.remove(self.fn + ".idx")
+        eq_(exported, self._export())
+        open(self.fn + ".idx", "w").write("garbage\n")
+        eq_(exported, self._export())
+
+    def test_appended_sections_are_found(self):
+        self._log("- One @done(2011-05-11)\n")
+        open(self.fn, "a").write("\nThursday, 12. May 2011:\n\t- Two\n")
+        eq_(["\t- Two\n"], LogbookStore(self.fn).read_day(dt.date(2011, 05, 12)))
+        eq_(2, len(open(self.fn + ".idx").readlines()))
+
+    def test_legacy_logbook_is_imported(self):
+        legacy = os.path.join(self.dir, "logbook.taskpaper")
+        open(legacy, "w").write("""Thursday, 12. May 2011:
+	- Two
+
+Wednesday, 11. May 2011:
+	- One
+""")
+        open_logbook_store(self.fn, legacy)
+        eq_(open(legacy).read(), self._export())
+        os.remove(legacy)
+        eq_(2, len(open_logbook_store(self.fn, legacy).days()))
+# End: Logbook Store Tests  }}}
+# Batch Mode  {{{
+from batch import BatchOptions, find_files, process_files, timeline_filename
+
+class TestBatch(unittest.TestCase):
+    files = {
+        "a.taskpaper": "A:\n\t- One @done(2011-05-12)\n"
+                       "\t- Due @due(2011-04-02)\n",
+        "sub/b.taskpaper": "B:\n\t- Two @done(2011-05-12)\n"
+                           "\t- Also due @due(2011-04-02)\n"
+                           "\t- Overdue @due(2011-03-01)\n",
+        "sub/c.taskpaper": "C:\n\t- Three @done(2011-05-11)\n",
+        "notes.txt": "Not: @done\n",
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for fn, text in self.files.items():
+            fn = os.path.join(self.dir, fn)
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            open(fn, "w").write(text)
+        self.logbook_fn = os.path.join(self.dir, "logbook.log")
+        self.timeline_fn = os.path.join(self.dir, "timeline")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _path(self, fn):
+        return os.path.join(self.dir, fn)
+
+    def _run(self, processes, **kwargs):
+        options = BatchOptions(today = dt.date(2011, 04, 01), **kwargs)
+        return process_files(find_files([self.dir]), options,
+                LogbookStore(self.logbook_fn), processes)
+
+    def test_find_files(self):
+        open(timeline_filename(self._path("a.taskpaper")), "w").write("")
+        eq_([self._path("a.taskpaper"), self._path("sub/b.taskpaper"),
+             self._path("sub/c.taskpaper")], find_files([self.dir]))
+
+    def _check(self, processes):
+        report = self._run(processes, log_done = True,
+                merged_timeline = self.timeline_fn)
+        eq_((3, 9), (report.files, report.lines))
+
+        eq_("A:\n\t- Due @due(2011-04-02)\n",
+            open(self._path("a.taskpaper")).read())
+        f = StringIO()
+        LogbookStore(self.logbook_fn).export(f)
+        eq_("""Thursday, 12. May 2011:
+	- A \xe2\x80\xa2 One @done(2011-05-12)
+	- B \xe2\x80\xa2 Two @done(2011-05-12)
+
+Wednesday, 11. May 2011:
+	- C \xe2\x80\xa2 Three @done(2011-05-11)
+""", f.getvalue())
+        eq_("""Overdue:
+	- Overdue @due(2011-03-01)
+
+Saturday, 02. April 2011 (+1 day):
+	- Due @due(2011-04-02)
+	- Also due @due(2011-04-02)
+
+
+ vim:ro\n""", open(self.timeline_fn).read())
+
+    def test_in_process(self):
+        self._check(1)
+
+    def test_in_pool(self):
+        self._check(2)
+
+    def test_per_file_timelines(self):
+        self._run(2, timelines = True)
+        eq_(extract_timeline(TaskPaperFile(self.files["sub/b.taskpaper"]),
+                dt.date(2011, 04, 01)),
+            open(timeline_filename(self._path("sub/b.taskpaper"))).read())
+        eq_(self.files["a.taskpaper"], open(self._path("a.taskpaper")).read())
+        ok_(not os.path.exists(self.logbook_fn))
+
+    def test_report(self):
+        report = self._run(1)
+        ok_(str(report).startswith("3 files, 9 lines in "))
+# End: Batch Mode  }}}
+# Agenda  {{{
+from agenda import file_entries, load_entries, merge_agenda, merge_sorted, \
+        iter_agenda
+
+class TestAgenda(unittest.TestCase):
+    inbox = """- Call Bob @due(2011-04-02)
+- Old @due(2011-03-01)
+"""
+    todo = """Work:
+	- Report @due(2011-04-02)
+		With a note
+	- Done @due(2011-03-01) @done
+	- Today @due(2011-04-01)
+"""
+
+    def setUp(self):
+        today = dt.date(2011, 04, 01)
+        self.entries = list(merge_agenda([
+            file_entries("inbox", TaskPaperFile(self.inbox), today),
+            file_entries("todo", TaskPaperFile(self.todo), today),
+        ]))
+
+    def test_sources(self):
+        eq_([("inbox", 2), ("todo", 5), ("inbox", 1), ("todo", 2)],
+            [(e.filename, e.lineno) for e in self.entries])
+
+    def test_lines(self):
+        eq_("""Overdue:
+	- Old @due(2011-03-01)
+
+Today:
+	- Today @due(2011-04-01)
+
+Saturday, 02. April 2011 (+1 day):
+	- Call Bob @due(2011-04-02)
+	- Report @due(2011-04-02)
+		With a note
+
+
+ vim:ro\n""", ''.join(iter_agenda(self.entries)))
+
+    def test_merge_is_lazy(self):
+        def _stream(name, n):
+            for i in range(n):
+                yield (i, name)
+            raise AssertionError("Read too far")
+        merged = merge_sorted([_stream("a", 3), _stream("b", 3)],
+                lambda v: v[0])
+        eq_([(0, "a"), (0, "b"), (1, "a")],
+            [next(merged) for i in range(3)])
+
+    def test_files_are_loaded_when_merged(self):
+        loaded = []
+        def _load(fn):
+            loaded.append(fn)
+            return TaskPaperFile(getattr(self, fn))
+        today = dt.date(2011, 04, 01)
+        merged = merge_agenda([load_entries(fn, _load, today)
+                               for fn in ("inbox", "todo")])
+        eq_([], loaded)
+        eq_(self.entries, list(merged))
+        eq_(["inbox", "todo"], loaded)
+# End: Agenda  }}}
+# Events  {{{
+from events import START, END, EMPTY, iter_events, filter_events, \
+        timeline_days, iter_finished
+
+class TestEvents(unittest.TestCase):
+    text = """Work:
+	- Report @due(2011-04-02)
+		With a note
+
+	- Done @due(2011-03-01) @done(2011-03-30)
+		- Nested @done
+- Call Bob @phone
+
+Home:
+	- Garden @due(2011-03-01)
+"""
+    today = dt.date(2011, 04, 01)
+
+    def setUp(self):
+        self.tpf = TaskPaperFile(self.text)
+
+    def test_events(self):
+        eq_([
+            (START, 1, 0, Project, "Work:"),
+            (START, 2, 1, Task, "- Report"),
+            (START, 3, 2, CommentLine, "With a note"),
+            (END, 3, 2, CommentLine, "With a note"),
+            (EMPTY, 4, None, None, ''),
+            (END, 2, 1, Task, "- Report"),
+            (START, 5, 1, Task, "- Done"),
+            (START, 6, 2, Task, "- Nested"),
+            (END, 6, 2, Task, "- Nested"),
+            (END, 5, 1, Task, "- Done"),
+            (END, 1, 0, Project, "Work:"),
+            (START, 7, 0, Task, "- Call Bob"),
+            (END, 7, 0, Task, "- Call Bob"),
+            (EMPTY, 8, None, None, ''),
+            (START, 9, 0, Project, "Home:"),
+            (START, 10, 1, Task, "- Garden"),
+            (END, 10, 1, Task, "- Garden"),
+            (END, 9, 0, Project, "Home:"),
+        ], [e[:5] for e in iter_events(self.text)])
+
+    def test_tags(self):
+        events = [e for e in iter_events(StringIO(self.text)) if e[0] == START]
+        eq_([["@due", "@done"], ["@done"]],
+            [e[5].keys() for e in events if e[1] in (5, 6)])
+        eq_(dt.date(2011, 3, 30), events[3][5]["@done"].value)
+        eq_(0, len(events[2][5]))
+
+    def test_same_lines_as_tree(self):
+        text = "\n\tLeading:\n\t\t- A\n\n\n\t\t\tNote\n\t- B @x(1)\n"
+        lines = []
+        for event, lineno, indent, kind, t, tags in iter_events(text):
+            if event == START:
+                lines.append("\t" * indent + t +
+                        ''.join(" " + str(tag) for tag in tags.values()) + "\n")
+            elif event == EMPTY:
+                lines.append('\n')
+        eq_(str(TaskPaperFile(text)), ''.join(lines))
+
+    def test_only_reads_what_is_needed(self):
+        def _lines():
+            yield "- First @a\n"
+            yield "\t- Child\n"
+            yield "- Second\n"
+            raise AssertionError("Read too far")
+        matches = filter_events(iter_events(_lines()), "@a")
+        eq_((1, "- First"), next(matches)[::3])
+
+    def test_filter(self):
+        for cmdline in ("@due", "@done", "@phone or @done", "o:-due @due",
+                "not @due and @done", "@due or @done l:2",
+                "@due or @done o:due l:3"):
+            eq_([(o.lineno, o.text) for o in self.tpf.filter(cmdline)],
+                [(m[0], m[3]) for m in
+                 filter_events(iter_events(self.text), cmdline)])
+
+    def test_filter_without_file_item(self):
+        eq_([self.tpf], self.tpf.filter("not @done"))
+        eq_([(1, "Work:"), (7, "- Call Bob"), (9, "Home:")],
+            [(m[0], m[3]) for m in
+             filter_events(iter_events(self.text), "not @done")])
+
+    def test_timeline(self):
+        eq_(Timeline().days(self.tpf, self.today),
+            timeline_days(iter_events(self.text), self.today))
+
+    def test_timeline_error(self):
+        try:
+            timeline_days(iter_events("- A @due(soon)\n"), self.today)
+        except RuntimeError, e:
+            ok_("line 1: - A!" in str(e))
+        else:
+            ok_(False, "No error")
+
+    def test_finished(self):
+        new_tpf, done_items = take_finished(self.tpf, self.today)
+        rest = StringIO()
+        finished = list(iter_finished(iter_events(self.text), self.today,
+            rest))
+        eq_(str(new_tpf), rest.getvalue())
+        eq_([(dt.date(2011, 03, 30), ["\t- Work • Done @due(2011-03-01) "
+              "@done(2011-03-30)\n"]),
+             (self.today, ["\t- Work • Done • Nested @done\n"])],
+            finished)
+        eq_(sorted((day, list(o.iter_lines())) for day, items in
+                done_items.items() for o in items), sorted(finished))
+# End: Events  }}}
 
 
 
 #######################################
 # Tests on Complete File (Read Write) #
 #######################################
+# Incremental Reparse  {{{
+class _ReparseBase(unittest.TestCase):
+    text = \
+"""One project: @home
+	- Task one
+		A comment
+	- Task two @today
+
+	Subproject:
+		- Task three @due(2011-04-01)
+Another project:
+	- Task four @today
+"""
+
+    def _shape(self, tpf):
+        return [(o.lineno, o.indent, o.text, o.parent.lineno,
+                 o._trailing_empty_lines, len(o.childs)) for o in tpf.childs] + \
+               [(o.lineno, o.indent, o.text, o.parent.lineno,
+                 o._trailing_empty_lines, len(o.childs))
+                for c in tpf.childs for o in c if o is not c]
+
+    def runTest(self):
+        old = self.text.splitlines()
+        new = old[:self.start - 1] + self.lines + old[self.end - 1:]
+        tpf = TaskPaperFile(old)
+        kept = tpf.at_line(len(old))
+        tpf.reparse(new, self.start, self.end, len(new) - len(old))
+
+        full = TaskPaperFile(new)
+        eq_(str(full), str(tpf))
+        eq_(self._shape(full), self._shape(tpf))
+        eq_([o and o.text for o in full._lines], [o and o.text for o in tpf._lines])
+        eq_([o.lineno for o in full.tag_index.items("@today")],
+            [o.lineno for o in tpf.tag_index.items("@today")])
+        eq_(self.keeps_last_item, kept is tpf.at_line(len(new)))
+
+class TestReparse_ChangeTag(_ReparseBase):
+    start, end, lines = 2, 3, ["\t- Task one @today"]
+    keeps_last_item = True
+
+class TestReparse_InsertLines(_ReparseBase):
+    start, end, lines = 4, 4, ["\t- New task @today", "\t\tWith a comment"]
+    keeps_last_item = True
+
+class TestReparse_DeleteLines(_ReparseBase):
+    start, end, lines = 2, 4, []
+    keeps_last_item = True
+
+class TestReparse_IndentAdoptsFollowingLines(_ReparseBase):
+    start, end, lines = 4, 5, ["\t\t- Task two @today"]
+    keeps_last_item = True
+
+class TestReparse_DedentChangesParents(_ReparseBase):
+    start, end, lines = 6, 7, ["Subproject:"]
+    keeps_last_item = True
+
+class TestReparse_RemoveProject(_ReparseBase):
+    start, end, lines = 8, 9, ["\tNot a project anymore"]
+    keeps_last_item = False
+
+class TestReparse_AppendAtEnd(_ReparseBase):
+    start, end, lines = 10, 10, ["", "Third project:"]
+    keeps_last_item = False
+# End: Incremental Reparse  }}}
 # Reordering of Tags  {{{
 class _ReorderingOfTagsBase(_TPFBaseTest):
     def runTest(self):
@@ -574,3 +1991,288 @@ class TestTagReordering_realWorldExample(_ReorderingOfTagsBase):
 # End: Reordering of Tags  }}}
 
 
+
+################
+# Vim Helpers  #
+################
+# Buffer Write Back  {{{
+from vim_utils import _line_hunks, _merge_changes
+
+class TestLineHunks(unittest.TestCase):
+    old = ["Project:", "\t- one", "\t- two", "\t- three", "Other:", "\t- four"]
+
+    def _apply(self, new):
+        buf = list(self.old)
+        hunks = _line_hunks(self.old, new)
+        for i1, i2, j1, j2 in reversed(hunks):
+            buf[i1:i2] = new[j1:j2]
+        eq_(new, buf)
+        return hunks
+
+    def test_unchanged(self):
+        eq_([], self._apply(list(self.old)))
+
+    def test_changed_lines(self):
+        new = list(self.old)
+        new[1] += " @done"
+        new[3] += " @done"
+        eq_([(1, 2, 1, 2), (3, 4, 3, 4)], self._apply(new))
+
+    def test_deleted_lines(self):
+        eq_([(2, 4, 2, 2)], self._apply(self.old[:2] + self.old[4:]))
+
+    def test_inserted_and_changed(self):
+        new = ["Project: @home"] + self.old[1:3] + ["\t- new"] + self.old[3:]
+        eq_([(0, 1, 0, 1), (3, 3, 3, 4)], self._apply(new))
+
+class TestMergeChanges(unittest.TestCase):
+    def test_single(self):
+        eq_((3, 5, 1), _merge_changes([(3, 5, 1)]))
+
+    def test_append_then_delete(self):
+        eq_((2, 2, 1), _merge_changes([(2, 2, 2), (3, 4, -1)]))
+
+    def test_later_change_before(self):
+        eq_((1, 6, 0), _merge_changes([(5, 6, 0), (1, 2, 0)]))
+
+from vim_utils import _buffer_tpf, _buffer_trees, _forget_on_error
+
+class TestBufferTrees(unittest.TestCase):
+    bufnr = -1
+
+    def setUp(self):
+        self.buf = ["Project:", "\t- one", "\t- two"]
+        self.tpf = _buffer_tpf(self.bufnr, self.buf, 1, None)
+
+    def tearDown(self):
+        _buffer_trees.pop(self.bufnr, None)
+
+    def test_same_tick(self):
+        ok_(self.tpf is _buffer_tpf(self.bufnr, self.buf, 1, None))
+
+    def test_new_tick_without_listener(self):
+        self.buf[1] = "\t- one @done"
+        tpf = _buffer_tpf(self.bufnr, self.buf, 2, None)
+        ok_(tpf is not self.tpf)
+        eq_(["- one"], [o.text for o in tpf.filter("@done")])
+
+    def test_reported_changes(self):
+        self.buf[1] = "\t- one @done"
+        tpf = _buffer_tpf(self.bufnr, self.buf, 2, [(2, 3, 0)])
+        ok_(tpf is self.tpf)
+        eq_(["- one"], [o.text for o in tpf.filter("@done")])
+
+    def test_changes_that_miss_lines(self):
+        self.buf.append("\t- three @done")
+        tpf = _buffer_tpf(self.bufnr, self.buf, 2, [(2, 3, 0)])
+        ok_(tpf is not self.tpf)
+        eq_(["- three"], [o.text for o in tpf.filter("@done")])
+
+    def test_new_tick_without_changes(self):
+        self.buf[1] = "\t- one @done"
+        tpf = _buffer_tpf(self.bufnr, self.buf, 2, [])
+        eq_(["- one"], [o.text for o in tpf.filter("@done")])
+
+    def test_forget_on_error(self):
+        try:
+            with _forget_on_error(self.bufnr):
+                self.tpf.at_line(2).add_tag(Tag("@done"))
+                raise RuntimeError("E21: Cannot make changes")
+        except RuntimeError:
+            pass
+        ok_(self.bufnr not in _buffer_trees)
+        eq_([], _buffer_tpf(self.bufnr, self.buf, 1, None).filter("@done"))
+# End: Buffer Write Back  }}}
+# Results Window  {{{
+import vim_utils
+from vim_utils import _result_lines, _take_page, _pending_results, \
+        _show_results, show_more_results
+
+class TestResultLines(unittest.TestCase):
+    def test_lines(self):
+        tpf = TaskPaperFile("Project:\n\t- One @today\n\t- Two @today\n")
+        eq_(["todo|   2|- One @today", "todo|   3|- Two @today"],
+            list(_result_lines("todo.taskpaper", tpf.filter("@today"))))
+
+    def test_formatted_when_taken(self):
+        taken = []
+        def _matches():
+            for o in TaskPaperFile("- One\n- Two\n"):
+                if o.lineno:
+                    taken.append(o)
+                    yield o
+        lines = _result_lines("todo.taskpaper", _matches())
+        eq_("todo|   1|- One", next(lines))
+        eq_(1, len(taken))
+
+class _FakeBuffer(list):
+    number = -1
+
+    def append(self, lines):
+        self.extend(lines)
+
+class _FakeWindow(object):
+    cursor = None
+
+class _FakeVim(object):
+    """Just enough of Vim for the results window"""
+    def __init__(self):
+        self.current = self
+        self.buffer = _FakeBuffer()
+        self.window = _FakeWindow()
+        self.windows = []
+        self.commands = []
+        # The value of line('w$') + winheight(0)
+        self.end_in_sight = 0
+
+    def command(self, cmd):
+        self.commands.append(cmd)
+
+    def eval(self, expr):
+        if expr == "line('w$') + winheight(0)":
+            return str(self.end_in_sight)
+        return "0"
+
+class TestResultPages(unittest.TestCase):
+    def setUp(self):
+        self._page_size = vim_utils.RESULTS_PAGE_SIZE
+        vim_utils.RESULTS_PAGE_SIZE = 2
+        self._vim = getattr(vim_utils, "vim", None)
+        vim_utils.vim = self.vim = _FakeVim()
+        self.buf = self.vim.buffer
+
+    def tearDown(self):
+        vim_utils.RESULTS_PAGE_SIZE = self._page_size
+        vim_utils.vim = self._vim
+        _pending_results.pop(self.buf.number, None)
+
+    def _pages(self, n):
+        _pending_results[self.buf.number] = iter(range(n))
+        pages = [_take_page(self.buf.number)]
+        while self.buf.number in _pending_results:
+            pages.append(_take_page(self.buf.number))
+        return pages
+
+    def test_pages(self):
+        eq_([[]], self._pages(0))
+        eq_([[0]], self._pages(1))
+        eq_([[0, 1], []], self._pages(2))
+        eq_([[0, 1], [2]], self._pages(3))
+        eq_([[0, 1], [2, 3], []], self._pages(4))
+
+    def test_no_pending_lines(self):
+        eq_([], _take_page(self.buf.number))
+
+    def test_show_first_page(self):
+        _show_results((str(i) for i in range(5)), "jump()")
+        eq_(["0", "1"], self.buf)
+        eq_((1, 0), self.vim.window.cursor)
+        ok_("map <buffer> <cr> :py jump()<cr>" in self.vim.commands)
+
+    def test_show_more_when_scrolled_to_the_end(self):
+        _show_results((str(i) for i in range(5)), "jump()")
+        self.vim.end_in_sight = 1
+        show_more_results()
+        eq_(["0", "1"], self.buf)
+        self.vim.end_in_sight = 2
+        show_more_results()
+        eq_(["0", "1", "2", "3"], self.buf)
+        self.vim.end_in_sight = 4
+        show_more_results()
+        eq_(["0", "1", "2", "3", "4"], self.buf)
+        ok_(self.buf.number not in _pending_results)
+        show_more_results()
+        eq_(["0", "1", "2", "3", "4"], self.buf)
+
+    def test_show_nothing(self):
+        _show_results([], "jump()")
+        eq_([], self.buf)
+        ok_(self.buf.number not in _pending_results)
+# End: Results Window  }}}
+# Background Presave  {{{
+from presave import TimelineWriter, _changed_range
+
+class TestChangedRange(unittest.TestCase):
+    old = ["Project:", "\t- one", "\t- two", "\t- three"]
+
+    def test_unchanged(self):
+        eq_(None, _changed_range(self.old, list(self.old)))
+
+    def test_changed(self):
+        eq_((2, 4, 0), _changed_range(self.old,
+            ["Project:", "\t- one @done", "\t- two @done", "\t- three"]))
+
+    def test_inserted(self):
+        eq_((3, 3, 1), _changed_range(self.old, self.old[:2] + ["\t- new"] +
+            self.old[2:]))
+
+    def test_deleted_repeated_line(self):
+        eq_((3, 4, -1), _changed_range(["a", "b", "b"], ["a", "b"]))
+
+class _BlockingTimelineWriter(TimelineWriter):
+    """Does not start writing before it is released"""
+    def __init__(self, *args):
+        TimelineWriter.__init__(self, *args)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.updates = 0
+
+    def _update(self, lines):
+        self.started.set()
+        self.release.wait()
+        self.updates += 1
+        TimelineWriter._update(self, lines)
+
+class TestTimelineWriter(unittest.TestCase):
+    text = """Project:
+	- This is due tomorrow @due(2011-04-02)
+	- Not due
+"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "timeline.taskpaper")
+        self.today = dt.date(2011, 04, 01)
+        self.lines = self.text.splitlines()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _wanted(self, lines):
+        return extract_timeline(TaskPaperFile(lines), self.today)
+
+    def test_writes_timeline(self):
+        w = TimelineWriter(self.fn, self.today)
+        w.submit(self.lines)
+        w.wait()
+        eq_(self._wanted(self.lines), open(self.fn).read())
+
+        lines = self.lines + ["\t- Due now @due(2011-04-01)"]
+        w.submit(lines)
+        w.wait()
+        eq_(self._wanted(lines), open(self.fn).read())
+        eq_(None, w.error)
+
+    def test_saves_are_coalesced(self):
+        w = _BlockingTimelineWriter(self.fn, self.today)
+        w.submit(self.lines)
+        w.started.wait()
+        for i in range(3):
+            lines = self.lines + ["\t- New %i @due(2011-04-0%i)" % (i, i + 2)]
+            w.submit(lines)
+        w.release.set()
+        w.wait()
+        eq_(2, w.updates)
+        eq_(self._wanted(lines), open(self.fn).read())
+
+    def test_error_is_kept(self):
+        w = TimelineWriter(self.fn, self.today)
+        w.submit(["- Broken @due(tomorrow)"])
+        w.wait()
+        ok_(isinstance(w.error, RuntimeError))
+        w.error = None
+        w.submit(self.lines)
+        w.wait()
+        eq_(None, w.error)
+        eq_(self._wanted(self.lines), open(self.fn).read())
+# End: Background Presave  }}}
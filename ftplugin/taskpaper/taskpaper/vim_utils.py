@@ -9,22 +9,149 @@ and the TaskPaper Format
 """
 
 import re
+from contextlib import contextmanager
 import datetime as dt
+import difflib
+from itertools import islice
 
 try: import vim
 except ImportError: pass
 
 from taskpaper import *
-from config import LOGBOOK_FILENAME
+from config import LOGBOOK_FILENAME, RESULTS_PAGE_SIZE
+from presave import TimelineWriter
+from agenda import load_entries, merge_agenda
+from batch import find_files
+from parse_cache import ParseCache
+
+# The parse trees of buffers by buffer number, with the b:changedtick they
+# belong to
+_buffer_trees = {}
+
+# Writes the timeline of the todo file in the background
+_timeline_writer = TimelineWriter(TIMELINE_FILENAME)
+
+# The lines of the results windows that are not shown yet, by buffer number
+_pending_results = {}
+
+def _merge_changes(changes):
+    """Merge the (lnum, end, added) changes reported by a Vim listener, each
+    in the line numbers of its time, into a single one that covers them
+    all."""
+    start, old_end, new_end = None, None, None
+    for lnum, end, added in changes:
+        if start is None:
+            start, old_end, new_end = lnum, end, end + added
+            continue
+        # Both changes in the line numbers from before the new one
+        covered = max(new_end, end)
+        old_end += covered - new_end
+        new_end = covered + added
+        start = min(start, lnum)
+    return start, old_end, new_end - old_end
+
+def _buffer_tpf(bufnr, buf, tick, changes):
+    """The parse tree of the buffer 'bufnr' with the lines 'buf' at
+    b:changedtick 'tick'. 'changes' are the changes the listener reported
+    since the last call, None if there is no listener. The tree is kept
+    between calls and only the changed lines are parsed again, as long as
+    the changes account for all lines; otherwise the buffer is parsed
+    again."""
+    tpf = None
+    cached = _buffer_trees.get(bufnr)
+    if cached is not None:
+        old_tick, tpf = cached
+        if changes:
+            start, end, added = _merge_changes(changes)
+            if tpf.line_count + added == len(buf):
+                tpf.reparse(buf, start, end, added)
+            else:
+                tpf = None
+        elif old_tick != tick:
+            tpf = None
+    if tpf is None:
+        tpf = TaskPaperFile(buf)
+
+    _buffer_trees[bufnr] = (tick, tpf)
+    return tpf
+
+def _current_tpf():
+    """The parse tree of the current buffer, see _buffer_tpf()"""
+    buf = vim.current.buffer
+    tick = int(vim.eval("b:changedtick"))
+    changes = None
+    if int(vim.eval("exists('b:taskpaper_changes')")):
+        vim.command("call listener_flush()")
+        changes = [[int(v) for v in c] for c in vim.eval("b:taskpaper_changes")]
+        vim.command("let b:taskpaper_changes = []")
+    return _buffer_tpf(buf.number, buf, tick, changes)
+
+@contextmanager
+def _forget_on_error(bufnr):
+    """Forget the parse tree of the buffer 'bufnr' if the block fails. The
+    tree was changed to be written back and may no longer be what the
+    buffer holds."""
+    try:
+        yield
+    except:
+        forget_buffer(bufnr)
+        raise
+
+def forget_buffer(bufnr):
+    _buffer_trees.pop(bufnr, None)
+
+def _line_hunks(old, new):
+    """The differences between the lists of lines 'old' and 'new' as (i1, i2,
+    j1, j2) tuples: old[i1:i2] has to be replaced by new[j1:j2]."""
+    # Most edits only touch a few lines, so strip the common ends first
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    old_mid = old[prefix:len(old) - suffix]
+    new_mid = new[prefix:len(new) - suffix]
+
+    if len(old_mid) == len(new_mid):
+        # Lines were changed in place, like when tags are toggled
+        hunks = []
+        for i, (a, b) in enumerate(zip(old_mid, new_mid)):
+            if a == b: continue
+            if hunks and hunks[-1][1] == prefix + i:
+                hunks[-1][1] += 1
+                hunks[-1][3] += 1
+            else:
+                hunks.append([prefix + i, prefix + i + 1,
+                              prefix + i, prefix + i + 1])
+        return [tuple(h) for h in hunks]
+
+    sm = difflib.SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+    return [(i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix)
+            for tag, i1, i2, j1, j2 in sm.get_opcodes() if tag != "equal"]
 
 def _tpf_to_current_buffer(tpf):
     cursor = vim.current.window.cursor
 
-    new_text = str(tpf).strip()
-    old_text = '\n'.join(vim.current.buffer[:])
-    if old_text != new_text:
-        vim.current.buffer[:] = new_text.splitlines()
-        vim.current.window.cursor = min(cursor[0], len(vim.current.buffer)), cursor[1]
+    new_lines = [l.rstrip('\n') for l in tpf.iter_lines()]
+    while new_lines and not new_lines[-1].strip():
+        new_lines.pop()
+    first = 0
+    while first < len(new_lines) and not new_lines[first].strip():
+        first += 1
+    new_lines = new_lines[first:]
+
+    # Only touch the lines that changed, so that marks, folds and undo stay
+    # intact. Going backwards keeps the earlier line numbers valid.
+    buf = vim.current.buffer
+    hunks = _line_hunks(buf[:], new_lines)
+    for i1, i2, j1, j2 in reversed(hunks):
+        buf[i1:i2] = new_lines[j1:j2]
+
+    if hunks:
+        vim.current.window.cursor = min(cursor[0], len(buf)), cursor[1]
 
 _DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
 _NUM = re.compile(r"\d+")
@@ -67,75 +194,199 @@ def toggle_done(last_line):
     def _toggle_done(c):
         was_done = c.tags.pop('@done', None)
         if not was_done:
-            c.tags['@done'] = Tag('@done', date2str(dt.date.today()))
+            c.add_tag(Tag('@done', date2str(dt.date.today())))
 
-    tpf = TaskPaperFile('\n'.join(vim.current.buffer))
-    for i in range(line, last_line):
-        c = tpf.at_line(i)
-        if isinstance(c, (Task, Project)):
-            _toggle_done(c)
+    with _forget_on_error(vim.current.buffer.number):
+        tpf = _current_tpf()
+        for c in tpf.at_lines(line, last_line):
+            if isinstance(c, (Task, Project)):
+                _toggle_done(c)
 
-    _tpf_to_current_buffer(tpf)
+        _tpf_to_current_buffer(tpf)
 
 def log_current_dones():
-    tpf, new_logbook = log_finished(TaskPaperFile('\n'.join(vim.current.buffer)))
+    with _forget_on_error(vim.current.buffer.number):
+        tpf, done_items = take_finished(_current_tpf())
+
+        _tpf_to_current_buffer(tpf)
 
-    _tpf_to_current_buffer(tpf)
+    open_logbook_store().log(done_items)
 
-    open(LOGBOOK_FILENAME, "w").write(
-        str(TaskPaperFile('\n'.join(str(c) for c in new_logbook.childs)))
-    )
+def export_logbook():
+    with open(LOGBOOK_FILENAME, "w") as f:
+        open_logbook_store().export(f)
+
+def _echo_error(msg):
+    vim.command("echohl ErrorMsg | echomsg '%s' | echohl None" %
+            msg.replace("'", "''"))
+
+def _goto_file(fn):
+    """Make the window that shows the file 'fn' the current one. If there is
+    none, the file is opened above the current window."""
+    fn = os.path.abspath(fn)
+    for idx,win in enumerate(vim.windows, 1):
+        if win.buffer.name and os.path.abspath(win.buffer.name) == fn:
+            vim.command("%iwincmd w" % idx)
+            return
+    vim.command("aboveleft split %s" % vim.eval("fnameescape('%s')" % fn.replace("'", "''")))
 
 def filter_jump(fn):
     line = int(vim.current.line.split('|', 2)[1])
-    for idx,win in enumerate(vim.windows, 1):
-        vim.command("%iwincmd w" % idx)
-        if vim.eval("expand('%')").startswith(fn):
-            break
+    _goto_file(fn)
 
     vim.current.window.cursor = line, 0
     vim.command('normal ^')
 
+def _result_lines(filename, matches):
+    """The lines of the results window for the filter 'matches' in the file
+    'filename'. They are only formatted when they are shown."""
+    base = os.path.splitext(filename)[0]
+    for o in matches:
+        yield "%s|%4i|%s" % (base, o.lineno, o.text_with_tags.strip())
 
 def filter_taskpaper(cmdline):
-    all_windows = [ w for w in vim.windows ]
-    cwind = all_windows.index(vim.current.window)
+    # Filter the file the results came from, not the results
+    if int(vim.eval("exists('b:taskpaper_results')")):
+        vim.command("wincmd p")
 
-    def _close_all():
-        for idx,win in enumerate(vim.windows, 1):
-            vim.command("%iwincmd w" % idx)
-            if "nofile" in vim.eval("&buftype"):
-                vim.command(":bwipeout")
-                return _close_all()
-    _close_all()
-    vim.command("%iwincmd w" % cwind)
-
-    f = TaskPaperFile('\n'.join(vim.current.buffer))
+    f = _current_tpf()
     cf = vim.eval("expand('%')")
 
-    matches = f.filter(cmdline)
+    try:
+        matches = f.iter_filter(cmdline)
+    except FilterSyntaxError, e:
+        _echo_error(str(e))
+        return
 
-    # new vim buffer
-    cfb = os.path.splitext(cf)[0]
-    vim.command("rightbelow new")
-    vim.current.buffer[:] = [ "%s|%4i|%s" % (cfb, o.lineno, o.text_with_tags.strip()) for o in matches ]
+    _show_results(_result_lines(cf, matches), "filter_jump('%s')" % cf)
 
+def filter_cache_stats():
+    """Show how often :Filter found its results in the cache of the current
+    buffer"""
+    vim.command("echo '%s'" % str(_current_tpf().filter_cache).replace(
+        "'", "''"))
+
+def _results_window():
+    """Make the results window the current one, it is opened below the
+    current window if there is none"""
+    for idx,win in enumerate(vim.windows, 1):
+        if int(vim.eval("getbufvar(%i, 'taskpaper_results', 0)" %
+                win.buffer.number)):
+            vim.command("%iwincmd w" % idx)
+            return
+
+    vim.command("rightbelow new")
     vim.command("resize 15")
     vim.command("setlocal winfixheight")
     vim.command("setlocal buftype=nofile")
+    vim.command("setlocal bufhidden=wipe")
     vim.command("setlocal ft=qf")
     vim.command("setlocal nomodifiable")
-    vim.command("map <buffer> <cr> :py filter_jump('%s')<cr>" % cf)
+    vim.command("let b:taskpaper_results = 1")
+    vim.command("autocmd CursorMoved <buffer> py show_more_results()")
+    if int(vim.eval("exists('##WinScrolled')")):
+        vim.command("autocmd WinScrolled <buffer> py show_more_results()")
+    vim.command("autocmd BufWipeout <buffer> "
+            "py forget_results(int(vim.eval('expand(\"<abuf>\")')))")
+
+def forget_results(bufnr):
+    _pending_results.pop(bufnr, None)
+
+def _take_page(bufnr):
+    """The next page of the lines of the results buffer 'bufnr' that are not
+    shown yet, at most RESULTS_PAGE_SIZE of them. The lines are forgotten
+    once the last one is taken."""
+    lines = _pending_results.get(bufnr)
+    if lines is None:
+        return []
+    page = list(islice(lines, RESULTS_PAGE_SIZE))
+    if len(page) < RESULTS_PAGE_SIZE:
+        del _pending_results[bufnr]
+    return page
+
+def _show_results(lines, jump):
+    """Show 'lines' in the results window, <cr> runs the Python code 'jump'.
+    'lines' can be any iterable; the first RESULTS_PAGE_SIZE lines are shown
+    right away, the others a page at a time when they are scrolled to."""
+    _results_window()
+    buf = vim.current.buffer
+    _pending_results[buf.number] = iter(lines)
+
+    vim.command("setlocal modifiable")
+    buf[:] = _take_page(buf.number)
+    vim.command("setlocal nomodifiable")
+    vim.current.window.cursor = 1, 0
+    vim.command("map <buffer> <cr> :py %s<cr>" % jump)
+
+def show_more_results():
+    """Add the next page of the results window if its end is in sight"""
+    buf = vim.current.buffer
+    if buf.number not in _pending_results:
+        return
+    if int(vim.eval("line('w$') + winheight(0)")) < len(buf):
+        return
+
+    page = _take_page(buf.number)
+    if page:
+        vim.command("setlocal modifiable")
+        buf.append(page)
+        vim.command("setlocal nomodifiable")
+
+def _agenda_files():
+    filenames = [fn for fn in AGENDA_FILENAMES if os.path.exists(fn)]
+    if os.path.isdir(PROJECTS_DIRECTORY):
+        filenames += [fn for fn in find_files([PROJECTS_DIRECTORY])
+                      if fn not in filenames]
+    return filenames
+
+def _agenda_lines(entries):
+    """The lines of the results window for the AgendaEntry 'entries', made
+    when they are taken"""
+    last_day = None
+    for e in entries:
+        if e.day != last_day:
+            yield e.heading.rstrip()
+            last_day = e.day
+        yield "%s|%4i|%s" % (e.filename, e.lineno, e.lines[0].strip())
+
+def show_agenda():
+    """Show the due items of all agenda files, as they are saved, sorted by
+    day"""
+    cache = ParseCache(CACHE_DIRECTORY, CACHE_MAX_SIZE)
+    streams = [load_entries(fn, cache.load) for fn in _agenda_files()]
+    _show_results(_agenda_lines(merge_agenda(streams)), "agenda_jump()")
+
+def agenda_jump():
+    parts = vim.current.line.split('|', 2)
+    if len(parts) < 3:
+        return
+    fn, line = parts[0], int(parts[1])
+
+    _goto_file(fn)
+
+    vim.current.window.cursor = line, 0
+    vim.command('normal ^')
 
 def run_presave():
-    tpf = TaskPaperFile('\n'.join(vim.current.buffer))
+    with _forget_on_error(vim.current.buffer.number):
+        tpf = _current_tpf()
 
-    reorder_tags(tpf)
+        reorder_tags(tpf)
 
-    if os.path.basename(vim.current.buffer.name) == os.path.basename(TODO_FILENAME):
-        open(TIMELINE_FILENAME, "w").write(extract_timeline(tpf))
+        _tpf_to_current_buffer(tpf)
 
-    _tpf_to_current_buffer(tpf)
+    # Everything else is done in the background, on the lines as they are
+    # saved
+    if os.path.basename(vim.current.buffer.name) == os.path.basename(TODO_FILENAME):
+        if _timeline_writer.error is not None:
+            _echo_error(str(_timeline_writer.error))
+            _timeline_writer.error = None
+        _timeline_writer.submit(vim.current.buffer[:])
+
+def finish_presave():
+    """Wait for the background work of run_presave, Vim calls this before
+    it exits"""
+    _timeline_writer.wait()
 
 
 